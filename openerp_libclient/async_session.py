@@ -0,0 +1,601 @@
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    Copyright (c) 2015 P. Christeas <xrg@hellug.gr>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+#.apidoc title: async_session - Session for asyncio applications
+
+""" A Session whose calls are coroutines, for applications that run an
+    asyncio event loop (with `trollius`, the asyncio of Python 2).
+
+    Unlike `session.Session`, which needs one thread per in-flight call,
+    a single thread can drive as many concurrent calls as the loop can
+    handle. Each in-flight call still needs its own HTTP connection, so
+    `session_limit` shall be raised accordingly.
+
+    Example::
+
+        import trollius as asyncio
+        from trollius import From
+        from openerp_libclient.async_session import AsyncSession
+
+        @asyncio.coroutine
+        def main():
+            sess = AsyncSession()
+            yield From(sess.open('http', host='localhost', port=8069,
+                        dbname='test', user='admin', passwd='admin'))
+            yield From(sess.login())
+            names = yield From(asyncio.gather(*[
+                        sess.call_orm('res.partner', 'name_get', [[i]])
+                        for i in range(1000)]))
+
+    Only the HTTP-based protocols, RPC-JSON and XML-RPC (v2 and v1), are
+    available here. Over https, the server's certificate is verified,
+    unless `open()` is given `ssl_verify=False`.
+
+    `trollius` is not required by the rest of the library; install it
+    with the "async" extra of setup.py.
+"""
+
+import logging
+import re
+import sys
+import base64
+import zlib
+import json
+import xmlrpclib
+from collections import deque
+
+import trollius as asyncio
+from trollius import From, Return
+
+import errors
+import json_helpers
+from errors import RpcException, RpcProtocolException, RpcNoProtocolException, \
+        RpcServerException, RpcNetworkException
+from interface import RPCNotifier
+from session import PasswdAuth
+from protocol_rpcjson import RpcJServerException
+import protocol_xmlrpc
+__hush_pyflakes = [ protocol_xmlrpc ] # for the Binary wrapper of xmlrpclib
+
+class _StaleConnection(Exception):
+    """ Internal: a kept-alive connection had been closed by the server
+    """
+    pass
+
+class AsyncHTTPConnection(object):
+    """ A persistent HTTP/1.1 connection, over asyncio streams
+    """
+    user_agent = "openerp-libclient (asyncio)"
+
+    def __init__(self, host, port, ssl_context=None, loop=None):
+        """
+            @param ssl_context an `ssl.SSLContext` for https, None for plain http
+        """
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self._loop = loop
+        self._reader = None
+        self._writer = None
+        self.requests = 0
+
+    def is_open(self):
+        return self._writer is not None and not self._reader.at_eof()
+
+    @asyncio.coroutine
+    def connect(self):
+        self._reader, self._writer = yield From(asyncio.open_connection(
+                    self.host, self.port, ssl=self.ssl_context, loop=self._loop))
+        self.requests = 0
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    @asyncio.coroutine
+    def request(self, url, body, headers):
+        """ POST `body` to `url`, read the full response
+
+            @param headers a list of (name, value) pairs
+            @return (status, reason, headers, body) of the response, the
+                headers as a dict with lowercase names
+        """
+        if self._writer is None:
+            yield From(self.connect())
+        reused = self.requests > 0
+        self.requests += 1
+        lines = ['POST %s HTTP/1.1' % url, 'Host: %s:%s' % (self.host, self.port),
+                'User-Agent: %s' % self.user_agent,
+                'Accept-Encoding: gzip',
+                'Content-Length: %d' % len(body)]
+        for k, v in headers:
+            lines.append('%s: %s' % (k, v))
+        try:
+            self._writer.write('\r\n'.join(lines) + '\r\n\r\n' + body)
+            yield From(self._writer.drain())
+            status_line = yield From(self._reader.readline())
+        except EnvironmentError:
+            self.close()
+            if reused:
+                raise _StaleConnection()
+            raise
+        if not status_line:
+            self.close()
+            if reused:
+                raise _StaleConnection()
+            raise RpcProtocolException("Server closed the connection")
+
+        try:
+            try:
+                parts = status_line.split(None, 2)
+                version, status = parts[0], int(parts[1])
+                reason = (len(parts) > 2) and parts[2].strip() or ''
+            except (ValueError, IndexError):
+                raise RpcProtocolException("Bad status line: %r" % status_line)
+
+            rheaders = {}
+            while True:
+                line = yield From(self._reader.readline())
+                if line in ('\r\n', '\n', ''):
+                    break
+                k, v = line.split(':', 1)
+                rheaders[k.strip().lower()] = v.strip()
+
+            if rheaders.get('transfer-encoding', '').lower() == 'chunked':
+                chunks = []
+                while True:
+                    line = yield From(self._reader.readline())
+                    size = int(line.split(';', 1)[0], 16)
+                    if not size:
+                        while (yield From(self._reader.readline())) not in ('\r\n', '\n', ''):
+                            pass # trailers
+                        break
+                    chunks.append((yield From(self._reader.readexactly(size))))
+                    yield From(self._reader.readexactly(2))
+                rbody = ''.join(chunks)
+            elif 'content-length' in rheaders:
+                rbody = yield From(self._reader.readexactly(int(rheaders['content-length'])))
+            else:
+                rbody = yield From(self._reader.read())
+                self.close()
+        except asyncio.IncompleteReadError:
+            self.close()
+            raise RpcProtocolException("Incomplete response from server")
+        except Exception:
+            self.close()
+            raise
+
+        if rheaders.get('connection', '').lower() == 'close' or version == 'HTTP/1.0':
+            self.close()
+        if rheaders.get('content-encoding') == 'gzip':
+            rbody = zlib.decompress(rbody, 16 + zlib.MAX_WBITS)
+        raise Return((status, reason, rheaders, rbody))
+
+class AsyncProtocol(object):
+    """ Marshalling of calls for one RPC protocol, over HTTP
+
+        Like the `interface.Connection` classes, but only encodes requests
+        and decodes responses. The I/O is done by the `AsyncSession`.
+    """
+    name = "Unknown"
+    content_type = None
+    http_auth = True # credentials go in HTTP Basic authentication
+
+    def __init__(self, session):
+        self._session = session
+
+    def encode(self, obj, method, args, auth_level):
+        """ @return (url, body) of the request
+        """
+        raise NotImplementedError()
+
+    def encode_orm(self, model, method, args, kwargs):
+        """ @return (url, body) of an ORM request
+        """
+        if kwargs:
+            if 'exec_dict' not in self._session.server_options:
+                raise RpcProtocolException("The server we are connected doesn't support keyword arguments.")
+            return self.encode('/object', 'exec_dict', (model, method, list(args), kwargs), 'db')
+        return self.encode('/object', 'execute', [model, method] + list(args), 'db')
+
+    def decode(self, body, req_id):
+        """ @return the result, or raise the server's exception
+        """
+        raise NotImplementedError()
+
+class AsyncJsonProtocol(AsyncProtocol):
+    name = "RPC-JSON"
+    content_type = "application/json"
+
+    def __init__(self, session):
+        super(AsyncJsonProtocol, self).__init__(session)
+        self._req_counter = 1
+
+    def _request(self, path, method, args, kwargs=None):
+        req_id = str(self._req_counter)
+        self._req_counter += 1
+        req_struct = { "version": "1.1", "id": req_id, "method": str(method) }
+        if not kwargs:
+            req_struct["params"] = list(args)
+        else:
+            req_struct['params'] = kwargs.copy()
+            if args:
+                req_struct['params'].update(dict(enumerate(args)))
+        url = '/json/' + '/'.join(map(str, path))
+        return url, json.dumps(req_struct, cls=json_helpers.JsonEncoder2) + "\n", req_id
+
+    def encode(self, obj, method, args, auth_level):
+        if auth_level in ('db', 'login'):
+            path = ['db', self._session.auth_proxy.dbname]
+        else:
+            path = [auth_level]
+        path.append(obj.lstrip('/'))
+        if auth_level == 'login':
+            apr = self._session.auth_proxy
+            args = (apr.dbname, apr.user, apr.passwd)
+        return self._request(path, method, args)
+
+    def encode_orm(self, model, method, args, kwargs):
+        path = ['orm', self._session.auth_proxy.dbname, model]
+        return self._request(path, method, args, kwargs)
+
+    def decode(self, body, req_id):
+        try:
+            res = json.loads(body, object_hook=json_helpers.json_hook)
+        except Exception, e:
+            raise RpcProtocolException(unicode(e))
+        if res.get('version') not in ('1.0', '1.1', '1.2'):
+            raise RpcProtocolException("Invalid JSON version: %s" % \
+                    res.get('version', '<unknown>'))
+        if res.get('id') != req_id:
+            raise RpcProtocolException("Protocol Out of order: %r != %r" %\
+                    (res.get('id'), req_id))
+        if res.get('error'):
+            raise RpcJServerException(res['error'])
+        return res.get('result', None)
+
+class AsyncXmlRpc2Protocol(AsyncProtocol):
+    name = "XML-RPCv2"
+    content_type = "text/xml"
+    _exception_class = errors.Rpc2ServerException
+
+    def _url(self, obj, auth_level):
+        if auth_level in ('db', 'login'):
+            return '/xmlrpc2/db/%s%s' % (self._session.auth_proxy.dbname, obj)
+        return '/xmlrpc2/%s%s' % (auth_level, obj)
+
+    def _args(self, auth_level, args):
+        if auth_level == 'login':
+            apr = self._session.auth_proxy
+            return (apr.dbname, apr.user, apr.passwd)
+        return tuple(args)
+
+    def encode(self, obj, method, args, auth_level):
+        body = xmlrpclib.dumps(self._args(auth_level, args), method)
+        return self._url(obj, auth_level), body, None
+
+    def decode(self, body, req_id):
+        parser, unmarshaller = xmlrpclib.getparser()
+        try:
+            parser.feed(body)
+            parser.close()
+            return unmarshaller.close()[0]
+        except xmlrpclib.Fault, err:
+            raise self._exception_class(err.faultCode, err.faultString)
+        except Exception, e:
+            raise RpcProtocolException(unicode(e))
+
+class AsyncXmlRpcProtocol(AsyncXmlRpc2Protocol):
+    name = "XML-RPCv1"
+    _exception_class = RpcServerException
+    http_auth = False
+
+    def _url(self, obj, auth_level):
+        return '/xmlrpc' + obj
+
+    def _args(self, auth_level, args):
+        apro = self._session.auth_proxy
+        if auth_level == 'login':
+            cargs = (apro.dbname, apro.user, apro.passwd)
+        elif auth_level == 'db':
+            cargs = (apro.dbname, apro.uid, apro.passwd)
+        elif auth_level == 'root':
+            cargs = (apro.superpass,)
+        else:
+            cargs = ()
+        return cargs + tuple(args)
+
+class AsyncSession(object):
+    """ A session to an OpenERP server, with coroutine calls
+
+        The counterpart of `session.Session` for asyncio, with the same
+        authentication proxies, notifier and exceptions. `open()`,
+        `login()`, `call()` and `call_orm()` are coroutines.
+
+        Connections are kept alive and reused, up to `session_limit` of
+        them. Calls beyond that wait for a free one.
+    """
+    session_limit = 30
+    conn_timeout = 30.0 # limit of seconds to wait for a free connection
+    proto_handlers = [ AsyncJsonProtocol, AsyncXmlRpc2Protocol, AsyncXmlRpcProtocol ]
+    """ Protocols to try at `open()`, in order """
+    auth_handlers = [ PasswdAuth, ]
+    _version_re = re.compile(r'([0-9]{1,2}(?:[\.0-9]+))')
+
+    def __init__(self, notifier=None, loop=None):
+        self.state = False # = not ready
+        self.context = {}
+        self.conn_url = None  #: only for display purposes
+        self.auth_proxy = None
+        self.server_version = (None, )
+        self.server_options = []
+        self._notifier = notifier or RPCNotifier()
+        self._loop = loop or asyncio.get_event_loop()
+        self._proto = None
+        self._host = None
+        self._port = None
+        self._ssl_context = None
+        self._idle = deque()
+        self._slots = None
+        self._log = logging.getLogger('RPC.AsyncSession')
+
+    def _auth_header(self, auth_level):
+        apr = self.auth_proxy
+        if auth_level in ('db', 'login'):
+            creds = '%s:%s' % (apr.user, apr.passwd)
+        elif auth_level == 'root' and apr.superpass:
+            creds = 'root:%s' % apr.superpass
+        else:
+            return []
+        return [('Authorization', 'Basic ' + base64.b64encode(creds))]
+
+    @asyncio.coroutine
+    def _request(self, url, body, auth_level):
+        """ Send a request over a free connection, get the response body
+
+            A connection that the server has closed while idle is replaced
+            once, transparently.
+        """
+        headers = [('Content-Type', self._proto.content_type)]
+        if self._proto.http_auth:
+            headers += self._auth_header(auth_level)
+        yield From(asyncio.wait_for(self._slots.acquire(), self.conn_timeout, loop=self._loop))
+        try:
+            for retry in (True, False):
+                conn = None
+                while self._idle and conn is None:
+                    conn = self._idle.pop()
+                    if not conn.is_open():
+                        conn.close()
+                        conn = None
+                if conn is None:
+                    conn = AsyncHTTPConnection(self._host, self._port, self._ssl_context,
+                                loop=self._loop)
+                try:
+                    status, reason, rheaders, rbody = yield From(conn.request(url, body, headers))
+                except _StaleConnection:
+                    if retry:
+                        continue
+                    raise RpcProtocolException("Server closed the connection")
+                except EnvironmentError, err:
+                    conn.close()
+                    if err.errno in errors.ENONET:
+                        raise RpcNetworkException(err.strerror, err.errno)
+                    raise RpcProtocolException(err)
+                except Exception:
+                    conn.close()
+                    raise
+                if conn.is_open():
+                    self._idle.append(conn)
+                break
+        finally:
+            self._slots.release()
+
+        if status == 404:
+            raise RpcNoProtocolException(reason)
+        elif status != 200:
+            raise RpcProtocolException("%s %s: %s" % (status, reason, url))
+        raise Return(rbody)
+
+    @asyncio.coroutine
+    def _call(self, url, body, req_id, auth_level):
+        rbody = yield From(self._request(url, body, auth_level))
+        raise Return(self._proto.decode(rbody, req_id))
+
+    def _make_ssl_context(self, ctx, verify):
+        import ssl
+        if ctx is None:
+            ctx = ssl.create_default_context()
+        if not verify:
+            self._log.warning("Will not verify the SSL certificate of %s", self._host)
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+        return ctx
+
+    @asyncio.coroutine
+    def open(self, proto, **kwargs):
+        """ Open the session to some server, find a protocol it speaks
+
+            @param proto "http" or "https"
+            @param kwargs like the ones of `Session.open()`: host, port,
+                dbname, user, passwd, superpass and, optionally,
+                allowed_handlers
+            @param ssl_context (https) an `ssl.SSLContext` to use, instead of
+                the default one, which verifies the server's certificate
+                against the system CAs
+            @param ssl_verify (https) pass False to connect without verifying
+                the server's certificate or host name. Insecure, only for
+                test servers with self-signed certificates.
+        """
+        if self.state:
+            raise RuntimeError("Session already open()ed, please create a new one!")
+        if proto not in ('http', 'https'):
+            raise ValueError("Protocol %s is not available for asyncio" % proto)
+
+        auth_kwd = kwargs.get('auth', False)
+        for klass in self.auth_handlers:
+            if auth_kwd and klass.codename != auth_kwd:
+                continue
+            try:
+                nah = klass(kwargs)
+                break
+            except (ValueError, KeyError, AttributeError):
+                self._log.debug("Error trying to use %s authentication" % klass.__name__, exc_info=True)
+        else:
+            raise ValueError("Cannot use authentication of %s type!" % (auth_kwd or 'any'))
+        self.auth_proxy = nah
+        self._slots = asyncio.Semaphore(self.session_limit, loop=self._loop)
+        self._host = kwargs['host']
+        self._port = kwargs['port']
+        self._ssl_context = None
+        if proto == 'https':
+            self._ssl_context = self._make_ssl_context(kwargs.get('ssl_context'),
+                                        kwargs.get('ssl_verify', True))
+
+        for pklass in self.proto_handlers:
+            if 'allowed_handlers' in kwargs \
+                    and pklass.name not in kwargs['allowed_handlers']:
+                continue
+            self._proto = pklass(self)
+            try:
+                sv = yield From(self._call(*self._proto.encode('/db', 'server_version', (), 'pub'),
+                                auth_level='pub'))
+            except RpcNetworkException, e:
+                self._notifier.handleException(e.info, exc_info=sys.exc_info())
+                raise
+            except RpcNoProtocolException:
+                self._log.warning("Cannot use %s protocol, continuing", pklass.name)
+                continue
+            except RpcProtocolException, exc:
+                self._notifier.handleWarning("Cannot use %s protocol for %s:%s: %s.",
+                    pklass.name, self._host, self._port, exc.info, auto_close=True)
+                continue
+            break
+        else:
+            self._proto = None
+            self._notifier.handleError("No protocol could handle %s connection", proto)
+            raise RpcException("Cannot open")
+
+        vm = self._version_re.match(sv)
+        if not vm:
+            raise ValueError("Invalid format of server's version: %s" %  sv)
+        self.server_version = tuple(map(int, vm.group(1).split('.')))
+        try:
+            server_options = yield From(self._call(*self._proto.encode('/common', 'get_options', (), 'pub'),
+                                auth_level='pub'))
+            if not isinstance(server_options, (list, tuple)):
+                raise TypeError("server options are %s, expected list" % type(server_options))
+            self.server_options = server_options
+        except Exception:
+            self._log.info("Could not get server's options", exc_info=True)
+            self.server_options = []
+        self.conn_url = '%s://%s:%s' % (proto, self._host, self._port)
+        self.state = 'open'
+        raise Return(True)
+
+    @asyncio.coroutine
+    def login(self):
+        """ execute the remote login() call, enable session to perform authenticated requests
+
+            @return the uid of the connected user
+        """
+        if not self.state:
+            self._notifier.handleError("Not connected")
+            raise RpcException('Not connnected')
+        try:
+            res = yield From(self._call(*self._proto.encode('/common', 'login', (), 'login'),
+                                auth_level='login'))
+            if not res:
+                self.state = 'nologin'
+                self._notifier.handleError("Cannot login to %s", self.conn_url)
+            else:
+                self.state = 'login'
+                self.auth_proxy.uid = res
+                self._log.info("Logged in to %s", self.conn_url)
+                self.context = (yield From(self.call('/object', 'execute',
+                            ('res.users', 'context_get')))) or {}
+            raise Return(res)
+        except Return:
+            raise
+        except Exception:
+            self.state = 'nologin'
+            self._notifier.handleException("Could not login", exc_info=sys.exc_info())
+            raise
+
+    def logged(self):
+        return self.state == 'login'
+
+    @asyncio.coroutine
+    def call(self, obj, method, args, auth_level='db', notify=True):
+        """ Calls the specified method on the given object on the server.
+
+            See `Session.call()`
+        """
+        if (not self.state) or (auth_level == 'db' and self.state !='login'):
+            if notify:
+                self._notifier.handleError("Not logged in")
+            raise RpcException('Not logged in')
+        try:
+            url, body, req_id = self._proto.encode(obj, method, args, auth_level)
+            res = yield From(self._call(url, body, req_id, auth_level))
+        except RpcServerException, e:
+            if notify:
+                self._notifier.handleRemoteException("Failed to call %s/%s: %s", obj, method, e.args[0], exc_info=sys.exc_info())
+            raise
+        except Exception:
+            if notify:
+                self._notifier.handleException("Failed to call %s/%s", obj, method, exc_info=sys.exc_info())
+            raise
+        raise Return(res)
+
+    @asyncio.coroutine
+    def call_orm(self, model, method, args, kwargs=None, notify=True):
+        """ variant of call(), focused on ORM object calls
+
+            See `Session.call_orm()`
+        """
+        if (not self.state) or (self.state !='login'):
+            if notify:
+                self._notifier.handleError("Not logged in")
+            raise RpcException('Not logged in')
+        try:
+            url, body, req_id = self._proto.encode_orm(model, method, args, kwargs)
+            res = yield From(self._call(url, body, req_id, 'db'))
+        except RpcServerException, e:
+            if notify:
+                self._notifier.handleRemoteException("Failed to call orm.%s/%s: %s", \
+                        model, method, e.args[0], exc_info=sys.exc_info())
+            raise
+        except Exception:
+            if notify:
+                self._notifier.handleException("Failed to call %s/%s", \
+                        model, method, exc_info=sys.exc_info())
+            raise
+        raise Return(res)
+
+    def close(self):
+        """ Close the idle connections, log out
+        """
+        self.state = None
+        while self._idle:
+            self._idle.pop().close()
+
+#eof
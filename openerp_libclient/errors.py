@@ -100,6 +100,18 @@ class RpcServerException(RpcException):
             return self.args[1]
         return ''
 
+class RpcMapException(RpcException):
+    """ Raised by `Session.map()`, when some of the calls have failed
+
+        All the calls are done before this is raised. `results` has the
+        result of each chunk, the exception for the failed ones, and
+        `errors` is a dict of {chunk index: exception}
+    """
+    def __init__(self, results, errors):
+        super(RpcMapException, self).__init__("%d of %d calls failed" % (len(errors), len(results)))
+        self.results = results
+        self.errors = errors
+
 class RpcNetworkException(RpcException):
     """This means network has failed, server unreachable etc.
     
@@ -25,6 +25,7 @@ import logging
 import re
 from dict_tools import dict_filter
 from errors import RpcProtocolException, RpcServerException, RpcNetworkException
+from tools import convert_strings, convert_strings_inplace
 import traceback
 
 #.apidoc title: interface - Base abstract classes
@@ -32,11 +33,18 @@ import traceback
 """This module provides the essential interface classes
 """
 
+def _utf8_decode(s):
+    return unicode(s, 'utf-8')
+
+def _utf8_encode(s):
+    return s.encode('utf-8')
+
 class Connection(object):
     """ The Connection class provides an abstract interface for a RPC protocol
     """
     name = "Unknown"
     codename = "baseclass"
+    traced = False #: the transport marks the phases of spans, see `set_traced()`
     _version_re = re.compile(r'([0-9]{1,2}(?:[\.0-9]+))')
 
     def __init__(self, session):
@@ -54,6 +62,32 @@ class Connection(object):
     def establish(self, kwargs, do_init=False):
         raise NotImplementedError()
 
+    def close(self):
+        """ Release the (network) resources of this connection
+
+            Called when the session drops the connection from its pool.
+            The connection shall not be used after that.
+        """
+        pass
+
+    def set_traced(self, traced):
+        """ Turn the tracing hooks of the transport on or off
+
+            Called by the session, which knows if it has a tracer. Off, the
+            transport does not look for the current span at all.
+        """
+        self.traced = traced
+
+    def warm_up(self):
+        """ Prepare a newly established connection for its first call
+
+            Called on the idle connections that the session keeps ready,
+            see `Session.min_idle`. Protocols that negotiate something
+            (like the HTTP authentication) on the first call shall do that
+            here.
+        """
+        pass
+
     def _establish_int(self):
         """ setup the connection, get the trivial data.
         """
@@ -108,15 +142,58 @@ class Connection(object):
 
                 object/exec_dict(model, args, kwargs)
         """
+        return self.call(*self._orm_as_call(model, method, args, kwargs))
+
+    def call_orm_iter(self, model, method, args, kwargs):
+        """ Perform an ORM call, iterate over the elements of its result
+
+            Protocols that can decode the response incrementally yield each
+            element as it arrives. This implementation gets the whole result
+            first.
+        """
+        res = self.call_orm(model, method, args, kwargs)
+        if isinstance(res, (list, tuple)):
+            return iter(res)
+        elif res:
+            return iter([res,])
+        return iter([])
+
+    def _orm_as_call(self, model, method, args, kwargs):
+        """ Translate an ORM call to the (obj, method, args) of `call()`
+        """
         if kwargs:
             if 'exec_dict' not in self._session.server_options:
                 # There is no safe way to convert back to positional arguments,
                 # so just report that to caller.
                 raise RpcProtocolException("The server we are connected doesn't support keyword arguments.")
-            return self.call('/object', 'exec_dict',
-                                (model, method, list(args), kwargs))
-        return self.call('/object', 'execute',
-                            [model, method] + list(args) )
+            return '/object', 'exec_dict', (model, method, list(args), kwargs)
+        return '/object', 'execute', [model, method] + list(args)
+
+    def call_many(self, calls):
+        """ Perform a list of calls, in as few requests as the server allows
+
+            @param calls a list of tuples, each one like::
+
+                ('call', obj, method, args, auth_level)
+                ('orm', model, method, args, kwargs)
+
+            @return a list with the result of each call, or the
+                RpcServerException instance it raised, in its place.
+                Other exceptions abort the whole list.
+
+            This implementation just issues the calls one by one. Protocols
+            that can batch them shall override it.
+        """
+        ret = []
+        for c in calls:
+            try:
+                if c[0] == 'orm':
+                    ret.append(self.call_orm(*c[1:]))
+                else:
+                    ret.append(self.call(*c[1:]))
+            except RpcServerException, e:
+                ret.append(e)
+        return ret
 
     def get_security(self):
         """ Retrieve info about security of connection
@@ -136,35 +213,23 @@ class Connection(object):
         """
         return False
 
-    def stringToUnicode(self, result):
-        if isinstance(result, str):
-            return unicode( result, 'utf-8' )
-        elif isinstance(result, list):
-            return [self.stringToUnicode(x) for x in result]
-        elif isinstance(result, tuple):
-            return tuple([self.stringToUnicode(x) for x in result])
-        elif isinstance(result, dict):
-            newres = {}
-            for i in result.keys():
-                newres[i] = self.stringToUnicode(result[i])
-            return newres
-        else:
-            return result
+    def stringToUnicode(self, result, inplace=False):
+        """ Decode all (utf-8) strings of `result` to unicode
+
+            @param inplace modify the lists and dicts of `result`, rather
+                than copying them. Only for results that nobody else holds.
+        """
+        if inplace:
+            return convert_strings_inplace(result, str, _utf8_decode)
+        return convert_strings(result, str, _utf8_decode)
 
     def unicodeToString(self, result):
-        if isinstance(result, unicode):
-            return result.encode( 'utf-8' )
-        elif isinstance(result, list):
-            return [self.unicodeToString(x) for x in result]
-        elif isinstance(result, tuple):
-            return tuple([self.unicodeToString(x) for x in result])
-        elif isinstance(result, dict):
-            newres = {}
-            for i in result.keys():
-                newres[i] = self.unicodeToString(result[i])
-            return newres
-        else:
-            return result
+        """ Encode all unicode strings of `result` to utf-8
+
+            The `result` is not modified, only the containers that hold
+            unicode strings are copied.
+        """
+        return convert_strings(result, unicode, _utf8_encode)
 
     def prettyUrl(self):
         return "%s://" % self.codename
@@ -254,4 +319,12 @@ class RPCNotifier(object):
         """
         self.logger.info(msg, *args)
 
+    def handleProgress(self, done, total, msg, *args):
+        """ Report the progress of a long operation, like `Session.map()`
+
+            @param total the number of steps, or None if not known
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(msg + ": %d/%s", *(args + (done, total or '?')))
+
 #eof
\ No newline at end of file
@@ -27,6 +27,7 @@ from types import Binary
 import datetime
 import json
 import base64
+import re
 
 class JsonEncoder2(json.JSONEncoder):
     _browse_null_type = type(None)
@@ -56,4 +57,124 @@ def json_hook(dct):
     else:
         return dct
 
-#eof
\ No newline at end of file
+_ws_match = re.compile(r'[ \t\n\r]*').match
+
+class JsonResultStream(object):
+    """ Incremental decoder of a JSON response, like {"id": .., "result": [..]}
+
+        Text is fed in chunks, as it arrives. The elements of the `stream_key`
+        array are decoded as soon as they are complete and returned by
+        `feed()`, so that only one of them, plus a chunk of text, needs to
+        be in memory. The other members of the object end up in `header`.
+        If `stream_key` is not an array, it is decoded as a whole into
+        `header`, too.
+    """
+    def __init__(self, stream_key='result', object_hook=None):
+        self.stream_key = stream_key
+        self.header = {}
+        self._decoder = json.JSONDecoder(object_hook=object_hook)
+        self._buf = ''
+        self._pos = 0
+        self._state = 'start'
+        self._key = None
+
+    def feed(self, data):
+        """ Add some text, return the list of array elements it completes
+        """
+        if self._pos:
+            self._buf = self._buf[self._pos:] + data
+            self._pos = 0
+        else:
+            self._buf += data
+        ret = []
+        while self._step(ret):
+            pass
+        return ret
+
+    def close(self):
+        """ Check that the whole object has been read
+        """
+        if self._state != 'end':
+            raise ValueError("Incomplete JSON response")
+        if _ws_match(self._buf, self._pos).end() < len(self._buf):
+            raise ValueError("Extra data after JSON response")
+
+    def _decode(self, pos, need_more):
+        """ Decode one value at `pos`, if it is complete
+
+            A value could be truncated (like a number), so, with `need_more`,
+            it only counts once the delimiter after it has arrived.
+            @return (value, end) or None
+        """
+        try:
+            val, end = self._decoder.raw_decode(self._buf, pos)
+        except ValueError:
+            return None
+        if need_more:
+            nxt = _ws_match(self._buf, end).end()
+            if nxt >= len(self._buf) or self._buf[nxt] not in ',]}':
+                return None
+        return val, end
+
+    def _step(self, ret):
+        """ Advance by one token or value, if available
+
+            @return True if progress was made
+        """
+        buf = self._buf
+        pos = _ws_match(buf, self._pos).end()
+        if pos >= len(buf):
+            return False
+        c = buf[pos]
+        state = self._state
+        if state == 'start':
+            if c != '{':
+                raise ValueError("Expected a JSON object, got %r" % c)
+            self._state = 'key'
+            self._pos = pos + 1
+        elif state == 'key':
+            if c == '}':
+                self._state = 'end'
+                self._pos = pos + 1
+                return False
+            if c == ',':
+                self._pos = pos + 1
+                return True
+            res = self._decode(pos, False)
+            if res is None:
+                return False
+            self._key, end = res
+            end = _ws_match(buf, end).end()
+            if end >= len(buf):
+                return False
+            if buf[end] != ':':
+                raise ValueError("Expected ':' after %r" % self._key)
+            self._pos = end + 1
+            self._state = 'value'
+        elif state == 'value':
+            if self._key == self.stream_key and c == '[':
+                self._state = 'array'
+                self._pos = pos + 1
+                return True
+            res = self._decode(pos, True)
+            if res is None:
+                return False
+            self.header[self._key], self._pos = res
+            self._state = 'key'
+        elif state == 'array':
+            if c == ']':
+                self._state = 'key'
+                self._pos = pos + 1
+            elif c == ',':
+                self._pos = pos + 1
+            else:
+                res = self._decode(pos, True)
+                if res is None:
+                    return False
+                val, self._pos = res
+                ret.append(val)
+        else:
+            raise ValueError("Extra data after JSON response")
+        return True
+
+#eof
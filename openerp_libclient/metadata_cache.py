@@ -0,0 +1,305 @@
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    Copyright (c) 2015 P. Christeas <xrg@hellug.gr>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+#.apidoc title: metadata_cache - On-disk cache of model definitions
+
+""" Keeps `fields_get`, `fields_view_get` and `context_get` results on disk
+
+    Short-lived scripts ask for the same model definitions at every start.
+    With a `MetadataCache` as the `orm_cache` of their session, these come
+    from disk, after the first run.
+
+    The entries are stored per host, database, user, server version, set
+    of installed modules (and their versions) and language. Installing or
+    upgrading a module thus starts a fresh set, and so does a new server
+    version. Finding the installed modules costs one round trip, once per
+    session, at the first `fields_get` or `fields_view_get`. The
+    `context_get` entry does not depend on the modules, but expires soon,
+    so that login needs no extra call.
+
+    Example::
+
+        sess = Session()
+        sess.orm_cache = MetadataCache(sess, parent=OrmCache())
+        sess.open(...)
+        sess.login()    # context_get comes from disk, next time
+
+    Other calls are passed to the `parent` cache, if any.
+"""
+
+import cPickle
+import errno
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from errors import RpcServerException
+from orm_cache import _freeze
+
+def default_cache_dir():
+    """ The directory for the cache, under XDG_CACHE_HOME
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'openerp_libclient', 'metadata')
+
+class MetadataCache(object):
+    """ Persistent cache of model definitions, for one session
+
+        Entries do not expire, except those of the methods in `ttls` (in
+        seconds). Any write to one of the `metadata_models` through the
+        session drops all of them.
+    """
+    methods = frozenset(['fields_get', 'fields_view_get', 'context_get'])
+    metadata_models = frozenset(['ir.model', 'ir.model.fields', 'ir.ui.view',
+                'ir.ui.menu', 'res.users', 'res.groups', 'res.lang'])
+    ttls = {'context_get': 600}
+
+    def __init__(self, session, path=None, parent=None):
+        """
+            @param session the Session this cache will belong to
+            @param path the directory of the cache, default under ~/.cache
+            @param parent another cache (like an OrmCache) for the other
+                methods
+        """
+        self._session = session
+        self.path = path or default_cache_dir()
+        self.parent = parent
+        self._log = logging.getLogger('RPC.MetadataCache')
+        self._lock = threading.Lock()
+        self._base_ns = None
+        self._ns_dirs = {}
+        self._generation = 0
+        self.invalidating = frozenset(['write', 'create', 'unlink'])
+        if parent is not None:
+            self.invalidating = self.invalidating | parent.invalidating
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        if self.parent is not None:
+            self.parent.reset_stats()
+
+    def stats(self):
+        """ Return a dict of hit/miss counters, with those of the parent
+        """
+        ret = {'disk_hits': self.hits, 'disk_misses': self.misses,
+                'disk_errors': self.errors}
+        if self.parent is not None:
+            ret.update(self.parent.stats())
+        return ret
+
+    def _get_modules_hash(self):
+        """ A hash of the installed modules and their versions
+        """
+        sess = self._session
+        domain = [('state', '=', 'installed')]
+        fields = ['name', 'latest_version']
+        try:
+            mods = sess.call_orm('ir.module.module', 'search_read', [domain, fields], {},
+                        notify=False, cache=False)
+        except RpcServerException:
+            # older servers, without search_read
+            mids = sess.call_orm('ir.module.module', 'search', [domain], {},
+                        notify=False, cache=False)
+            mods = sess.call_orm('ir.module.module', 'read', [mids, fields], {},
+                        notify=False, cache=False)
+        mods = sorted((m['name'], m['latest_version'] or '') for m in mods)
+        return hashlib.sha1(repr(mods)).hexdigest()
+
+    def _get_login_ns(self):
+        """ The part of the namespace that needs no call to find
+        """
+        sess = self._session
+        if sess.state != 'login':
+            return None
+        return (sess.conn_args.get('host'), sess.conn_args.get('port'),
+                sess.auth_proxy.dbname, sess.auth_proxy.user,
+                tuple(sess.server_version))
+
+    def _get_base_ns(self):
+        """ The part of the namespace that does not depend on the context
+        """
+        if self._base_ns is None:
+            login_ns = self._get_login_ns()
+            if login_ns is None:
+                return None
+            with self._lock:
+                if self._base_ns is None:
+                    try:
+                        modules = self._get_modules_hash()
+                    except Exception:
+                        self._log.warning("Cannot list the installed modules, will not cache metadata", exc_info=True)
+                        modules = False
+                    if not modules:
+                        self._base_ns = False
+                    else:
+                        self._base_ns = login_ns + (modules,)
+        return self._base_ns or None
+
+    def _ns_dir(self, method):
+        """ The directory for entries of `method`, or None if not available
+        """
+        if method == 'context_get':
+            ns = self._get_login_ns()
+        else:
+            ns = self._get_base_ns()
+            if ns is not None:
+                ns = ns + (self._session.context.get('lang'),)
+        if ns is None:
+            return None
+        ndir = self._ns_dirs.get(ns)
+        if ndir is None:
+            ndir = os.path.join(self.path, hashlib.sha1(repr(ns)).hexdigest())
+            try:
+                os.makedirs(ndir, 0700)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    self._log.warning("Cannot create cache directory %s: %s", ndir, e)
+                    return None
+            self._ns_dirs[ns] = ndir
+        return ndir
+
+    def _entry_path(self, key):
+        ndir = self._ns_dir(key[1])
+        if ndir is None:
+            return None
+        return os.path.join(ndir, hashlib.sha1(repr(key)).hexdigest())
+
+    def is_cached(self, model, method):
+        if method in self.methods:
+            return True
+        return self.parent is not None and self.parent.is_cached(model, method)
+
+    def make_key(self, model, method, args, kwargs):
+        if method not in self.methods:
+            if self.parent is None:
+                return None
+            return self.parent.make_key(model, method, args, kwargs)
+        try:
+            key = (model, method, _freeze(args), _freeze(kwargs or {}))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def generation(self, model):
+        if self.parent is not None:
+            return (self._generation, self.parent.generation(model))
+        return (self._generation, None)
+
+    def get(self, key):
+        if key[1] not in self.methods:
+            if self.parent is None:
+                return False, None
+            return self.parent.get(key)
+        fname = self._entry_path(key)
+        if fname is None:
+            self.misses += 1
+            return False, None
+        try:
+            ttl = self.ttls.get(key[1])
+            if ttl and os.stat(fname).st_mtime + ttl < time.time():
+                os.unlink(fname)
+                self.misses += 1
+                return False, None
+            fp = open(fname, 'rb')
+            try:
+                stored_key, value = cPickle.load(fp)
+            finally:
+                fp.close()
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                self.errors += 1
+            self.misses += 1
+            return False, None
+        except Exception:
+            self._log.debug("Cannot load cache entry %s", fname, exc_info=True)
+            self.errors += 1
+            self.misses += 1
+            return False, None
+        if stored_key != key:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, value
+
+    def put(self, key, value, generation=None):
+        if key[1] not in self.methods:
+            if self.parent is None:
+                return
+            if generation is not None:
+                generation = generation[1]
+            return self.parent.put(key, value, generation)
+        if generation is not None and generation[0] != self._generation:
+            return
+        fname = self._entry_path(key)
+        if fname is None:
+            return
+        tmpname = None
+        try:
+            # write, then rename, so that other processes never see a
+            # partial entry
+            fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(fname))
+            fp = os.fdopen(fd, 'wb')
+            try:
+                cPickle.dump((key, value), fp, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                fp.close()
+            os.rename(tmpname, fname)
+            tmpname = None
+        except (IOError, OSError), e:
+            self._log.warning("Cannot store cache entry: %s", e)
+            self.errors += 1
+        except Exception:
+            self._log.debug("Cannot store cache entry %s", fname, exc_info=True)
+            self.errors += 1
+        finally:
+            if tmpname is not None:
+                try:
+                    os.unlink(tmpname)
+                except OSError:
+                    pass
+
+    def invalidate(self, model=None):
+        """ Drop the entries of `model`, or all of them
+
+            Only writes to the `metadata_models` affect the disk entries.
+        """
+        if self.parent is not None:
+            self.parent.invalidate(model)
+        if model is not None and model not in self.metadata_models:
+            return
+        self._generation += 1
+        for ndir in self._ns_dirs.values():
+            try:
+                for fname in os.listdir(ndir):
+                    os.unlink(os.path.join(ndir, fname))
+            except OSError, e:
+                self._log.warning("Cannot clear cache directory %s: %s", ndir, e)
+
+    def clear(self):
+        self.invalidate()
+
+#eof
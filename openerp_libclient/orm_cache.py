@@ -0,0 +1,210 @@
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    Copyright (c) 2015 P. Christeas <xrg@hellug.gr>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+#.apidoc title: orm_cache - Cache of ORM call results
+
+""" A read-through cache of ORM results, for slowly changing models
+
+    It is opt-in: assign an `OrmCache` to `Session.orm_cache`, and the
+    results of the `methods` it knows (read, fields_get etc.) will be kept
+    for a while. Any `invalidating` call (write, create, unlink) through the
+    same session drops all the entries of its model. Changes made by other
+    clients are only seen after the TTL of the model.
+
+    Example::
+
+        cache = OrmCache(ttl=60.0, max_size=16*1024*1024)
+        cache.set_ttl('res.country', 3600)
+        cache.set_ttl('res.partner', 0) # never cache partners
+        session.orm_cache = cache
+        ...
+        print cache.stats()
+"""
+
+import cPickle
+import threading
+import time
+from collections import OrderedDict
+
+class _Entry(object):
+    __slots__ = ('data', 'expires')
+
+    def __init__(self, data, expires):
+        self.data = data
+        self.expires = expires
+
+def _freeze(value):
+    """ A hashable equivalent of `value`, made of tuples
+    """
+    if isinstance(value, dict):
+        return ('__dict__',) + tuple(sorted((k, _freeze(v)) for k, v in value.iteritems()))
+    elif isinstance(value, (list, tuple)):
+        return tuple([_freeze(v) for v in value])
+    elif isinstance(value, set):
+        return ('__set__',) + tuple(sorted(_freeze(v) for v in value))
+    return value
+
+class OrmCache(object):
+    """ LRU cache of ORM results, with per-model TTL
+
+        Results are stored pickled: each hit gets its own copy (which the
+        caller may modify) and the memory of the cache can be bounded by
+        `max_size` bytes, as well as `max_entries`.
+    """
+    methods = frozenset(['read', 'name_get', 'fields_get', 'fields_view_get', 'default_get'])
+    invalidating = frozenset(['write', 'create', 'unlink'])
+
+    def __init__(self, ttl=60.0, max_entries=10000, max_size=32*1024*1024):
+        """
+            @param ttl default time-to-live of entries, in seconds
+            @param max_entries, max_size limits of the cache, in number of
+                entries and total bytes of their (pickled) results
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self._ttls = {}
+        self._entries = OrderedDict() # in LRU order, most recent last
+        self._models = {} # model: set of keys
+        self._generations = {} # model: count of invalidations
+        self._generation = 0 # count of full invalidations
+        self._size = 0
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def set_ttl(self, model, ttl):
+        """ Set the time-to-live of `model` entries, 0 not to cache it at all
+        """
+        self._ttls[model] = ttl
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def stats(self):
+        """ Return a dict of hit/miss counters and the current size
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_ratio': lookups and float(self.hits) / lookups or 0.0,
+                    'invalidations': self.invalidations,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'entries': len(self._entries), 'size': self._size }
+
+    def is_cached(self, model, method):
+        """ Tells if results of `model`.`method` shall be cached
+        """
+        return method in self.methods and self._ttls.get(model, self.ttl) > 0
+
+    def make_key(self, model, method, args, kwargs):
+        """ The key of a call, or None if the arguments cannot be hashed
+        """
+        try:
+            key = (model, method, _freeze(args), _freeze(kwargs or {}))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key):
+        """ Look up `key`
+
+            @return a tuple (True, result) on a hit, (False, None) otherwise
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry.expires < time.time():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            # move to the end, as most recently used
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            data = entry.data
+        return True, cPickle.loads(data)
+
+    def generation(self, model):
+        """ A token that changes whenever `model` is invalidated
+
+            Take it before the call, pass it to `put()`, so that a result
+            is not stored if a write has happened in the meanwhile.
+        """
+        return (self._generation, self._generations.get(model, 0))
+
+    def put(self, key, result, generation=None):
+        """ Store the `result` for `key`, evicting the least recently used
+        """
+        model = key[0]
+        data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_size:
+            return
+        expires = time.time() + self._ttls.get(model, self.ttl)
+        with self._lock:
+            if generation is not None and generation != self.generation(model):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(data, expires)
+            self._models.setdefault(model, set()).add(key)
+            self._size += len(data)
+            while self._entries and (len(self._entries) > self.max_entries \
+                        or self._size > self.max_size):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, model=None):
+        """ Drop the entries of `model`, or all of them
+        """
+        with self._lock:
+            if model is None:
+                keys = list(self._entries)
+                self._generation += 1
+            else:
+                keys = list(self._models.get(model, ()))
+                self._generations[model] = self._generations.get(model, 0) + 1
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+
+    def clear(self):
+        self.invalidate()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= len(entry.data)
+        keys = self._models.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._models[key[0]]
+
+    def __len__(self):
+        return len(self._entries)
+
+#eof
@@ -35,6 +35,9 @@ from errors import RpcProtocolException, RpcServerException
 from tools import ustr
 
 from interface import TCPConnection
+from protocol_xmlrpc import sock_is_stale
+from stats import count_sent, count_received
+from tracing import current_span
 import session
 
 class Myexception(Exception):
@@ -43,7 +46,15 @@ class Myexception(Exception):
         self.faultString = faultString
         self.args = (faultCode, faultString)
 
+class SocketClosed(RuntimeError):
+    """ The peer has closed the socket, before sending any response
+    """
+    pass
+
 class mysocket:
+    pickle_protocol = 0 #: used for the messages we send
+    traced = False #: mark the phases of the current span
+
     def __init__(self, sock=None):
         if sock is None:
             self.sock = socket.socket( socket.AF_INET, socket.SOCK_STREAM)
@@ -53,10 +64,17 @@ class mysocket:
         # prepare this socket for long operations: it may block for infinite
         # time, but should exit as soon as the net is down
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # don't let Nagle's algorithm hold back the end of a request,
+        # waiting for the ACK of the previous one
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     def connect(self, host, port=False):
         #if not port:
             #protocol, buf = host.split('//')
             #host, port = buf.split(':')
+        if self.traced:
+            span = current_span()
+            if span is not None:
+                span.phase('connect')
         self.sock.connect((host, int(port)))
     def disconnect(self):
         # on Mac, the connection is automatically shutdown when the server disconnect.
@@ -65,36 +83,54 @@ class mysocket:
             self.sock.shutdown(socket.SHUT_RDWR)
         self.sock.close()
     def mysend(self, msg, exception=False, traceback=None):
-        msg = cPickle.dumps([msg,traceback])
-        size = len(msg)
-        self.sock.send('%8d' % size)
-        self.sock.send(exception and "1" or "0")
-        totalsent = 0
-        while totalsent < size:
-            sent = self.sock.send(msg[totalsent:])
-            if sent == 0:
-                raise RuntimeError, "socket connection broken"
-            totalsent = totalsent + sent
+        msg = cPickle.dumps([msg,traceback], self.pickle_protocol)
+        count_sent(len(msg))
+        span = self.traced and current_span() or None
+        if span is not None:
+            span.phase('send')
+        # header and body in one go, that is a single packet for small ones
+        self.sock.sendall('%8d%s%s' % (len(msg), exception and "1" or "0", msg))
+        if span is not None:
+            span.phase('wait')
+
+    def _recv_into(self, buf):
+        """ Fill the bytearray `buf` from the socket
+
+            @return the number of bytes read, less than len(buf) only if
+                the peer has closed the socket
+        """
+        view = memoryview(buf)
+        size = len(buf)
+        pos = 0
+        while pos < size:
+            nbytes = self.sock.recv_into(view[pos:], size - pos)
+            if not nbytes:
+                break
+            pos += nbytes
+        return pos
+
     def myreceive(self):
-        buf=''
-        while len(buf) < 8:
-            chunk = self.sock.recv(8 - len(buf))
-            if not chunk:
-                raise RuntimeError, "socket connection broken"
-            buf += chunk
-        size = int(buf)
-        buf = self.sock.recv(1)
-        if buf != "0":
-            exception = buf
+        header = bytearray(9) # size, in 8 digits, and the exception flag
+        nbytes = self._recv_into(header)
+        if nbytes < 9:
+            if not nbytes:
+                raise SocketClosed("socket connection closed")
+            raise RuntimeError, "socket connection broken"
+        if self.traced:
+            span = current_span()
+            if span is not None:
+                span.phase('parse')
+        size = int(str(header[:8]))
+        if header[8] != ord("0"):
+            exception = chr(header[8])
         else:
             exception = False
-        msg = ''
-        while len(msg) < size:
-            chunk = self.sock.recv(size-len(msg))
-            if not chunk :
-                raise RuntimeError, "socket connection broken"
-            msg = msg + chunk
-        res = cPickle.loads(msg)
+        msg = bytearray(size)
+        if self._recv_into(msg) < size:
+            raise RuntimeError, "socket connection broken"
+        count_received(size)
+        # cPickle cannot load from a bytearray, but StringIO shares its buffer
+        res = cPickle.load(StringIO(msg))
         if isinstance(res[0],Exception):
             if exception:
                 raise Myexception(str(res[0]), str(res[1]))
@@ -102,47 +138,185 @@ class mysocket:
         else:
             return res[0]
 
+class _BrokenSocket(Exception):
+    """ Internal: the socket has failed before we got any response
+    """
+    pass
+
 ## @brief The SocketConnection class implements Connection for the OpenERP socket RPC protocol.
 #
 # The socket RPC protocol is usually opened at port 8070 on the server.
 class SocketConnection(TCPConnection):
+    """ Net-RPC connection, keeping its socket open across calls
+
+        The server reads requests in a loop, so the same socket can serve
+        many calls, saving a TCP handshake for each. A socket found closed
+        (by the server, while idle) is replaced, and the call retried.
+        The retry only happens when the server closed the socket without
+        sending a single byte of the response; any other failure could
+        come after the server has executed the call, which must not run
+        twice. If the server keeps closing the sockets after the first
+        call, we go back to one socket per call.
+
+        Requests are pickled with protocol 0 (ASCII), which any server can
+        read, unless the server advertises the "netrpc-pickle2" option.
+        Then, the binary protocol 2 is used, which is much smaller and
+        faster for binary data and long lists of numbers; the server
+        answers in the same protocol. A server that does not know about
+        the option never advertises it, so it keeps getting protocol 0,
+        and its responses are read in whatever protocol it uses, since
+        unpickling detects that. A `pickle_protocol` argument to
+        `Session.open()` overrides that negotiation.
+    """
     name = "Net-RPC"
     codename = 'socket'
+    persistent = True #: keep the socket open, across calls
+    _max_reuse_failures = 3
 
     def __init__(self, session):
         super(SocketConnection, self).__init__(session)
+        self._sock = None
+        self._sock_calls = 0
+        self._sock_warm = False # opened by warm_up(), before any call
+        self._reuse_failures = 0
+        self.pickle_protocol = self._session.conn_args.get('pickle_protocol', None)
 
-    def call(self, obj, method, args, auth_level='db'):
-        try:
+    def establish(self, kwargs, do_init=False):
+        if kwargs.get('pickle_protocol', None) is not None:
+            proto = int(kwargs['pickle_protocol'])
+            if proto < 0:
+                proto = cPickle.HIGHEST_PROTOCOL
+            elif proto > cPickle.HIGHEST_PROTOCOL:
+                raise ValueError("Pickle protocol %d is not supported, max is %d" % \
+                        (proto, cPickle.HIGHEST_PROTOCOL))
+            self.pickle_protocol = proto
+        return super(SocketConnection, self).establish(kwargs, do_init=do_init)
+
+    def setupArgs(self, kwargs):
+        ret = super(SocketConnection, self).setupArgs(kwargs)
+        if self.pickle_protocol is not None:
+            ret['pickle_protocol'] = self.pickle_protocol
+        return ret
+
+    def _get_pickle_protocol(self):
+        """ The pickle protocol for our requests, configured or negotiated
+        """
+        if self.pickle_protocol is not None:
+            return self.pickle_protocol
+        if 'netrpc-pickle2' in self._session.server_options:
+            return 2
+        return 0
+
+    def _get_socket(self):
+        self.check()
+        if self._sock is None:
             s = mysocket()
-            s.connect(self.host, self.port )
-        except socket.error, err:
-            raise RpcProtocolException( ustr(err.strerror) )
-        try:
-            # Remove leading slash (ie. '/object' -> 'object')
-            obj = obj[1:]
-            encodedArgs = tuple(self.unicodeToString( args ))
-            apro = self._session.auth_proxy
-            if auth_level == 'login':
-                cargs = (obj, method, apro.dbname, apro.user, apro.passwd)
-            elif auth_level == 'db':
-                cargs = (obj, method, apro.dbname, apro.uid, apro.passwd)
-            elif auth_level == 'root':
-                cargs = (obj, method, apro.superpass)
-            else:
-                cargs = (obj, method)
-            s.mysend( cargs + encodedArgs)
-            result = s.myreceive()
-        except socket.error, err:
-            # print err.strerror
-            raise RpcProtocolException( ustr(err.strerror) )
-        except Myexception, err:
-            faultCode = ustr( err.faultCode)
-            faultString = ustr( err.faultString)
-            raise RpcServerException( faultCode, faultString )
-        finally:
-            s.disconnect()
-        return self.stringToUnicode( result )
+            s.traced = self.traced
+            try:
+                s.connect(self.host, self.port)
+            except socket.error, err:
+                s.sock.close()
+                raise RpcProtocolException( ustr(err.strerror) )
+            self._sock = s
+            self._sock_calls = 0
+            self._sock_warm = False
+        # server options may have arrived since the socket was opened
+        self._sock.pickle_protocol = self._get_pickle_protocol()
+        self._sock.traced = self.traced
+        return self._sock
+
+    def _drop_socket(self):
+        if self._sock is not None:
+            try:
+                self._sock.disconnect()
+            except socket.error:
+                pass
+            self._sock = None
+
+    def _reuse_failed(self):
+        """ Note that the server closed a socket, after a single call
+        """
+        if self._sock_calls != 1:
+            return
+        self._reuse_failures += 1
+        if self._reuse_failures >= self._max_reuse_failures:
+            self._log.info("Server closes Net-RPC sockets after each call, will not keep them")
+            self.persistent = False
+
+    def check(self):
+        """ Drop the socket, if the server has closed it
+
+            The connection itself remains usable, with a new socket.
+        """
+        if self._sock is not None and sock_is_stale(self._sock.sock):
+            self._log.debug("Net-RPC socket has been closed by the server")
+            self._reuse_failed()
+            self._drop_socket()
+        return True
+
+    def close(self):
+        self._drop_socket()
+
+    def warm_up(self):
+        """ Open the socket, so that the first call saves the handshake
+        """
+        if self.persistent:
+            self._get_socket()
+            self._sock_warm = True
+
+    def call(self, obj, method, args, auth_level='db'):
+        # Remove leading slash (ie. '/object' -> 'object')
+        obj = obj[1:]
+        encodedArgs = tuple(self.unicodeToString( args ))
+        apro = self._session.auth_proxy
+        if auth_level == 'login':
+            cargs = (obj, method, apro.dbname, apro.user, apro.passwd)
+        elif auth_level == 'db':
+            cargs = (obj, method, apro.dbname, apro.uid, apro.passwd)
+        elif auth_level == 'root':
+            cargs = (obj, method, apro.superpass)
+        else:
+            cargs = (obj, method)
+
+        for retry in (True, False):
+            s = self._get_socket()
+            try:
+                try:
+                    s.mysend( cargs + encodedArgs)
+                    result = s.myreceive()
+                except SocketClosed:
+                    if retry and (self._sock_calls or self._sock_warm):
+                        # an old socket, closed by the server before
+                        # it could answer
+                        raise _BrokenSocket()
+                    raise
+                if self._sock_calls:
+                    self._reuse_failures = 0
+                self._sock_calls += 1
+            except _BrokenSocket:
+                self._reuse_failed()
+                self._drop_socket()
+                continue
+            except socket.error, err:
+                # print err.strerror
+                self._drop_socket()
+                raise RpcProtocolException( ustr(err.strerror) )
+            except RuntimeError, err:
+                self._drop_socket()
+                raise RpcProtocolException( ustr(err) )
+            except Myexception, err:
+                self._sock_calls += 1
+                faultCode = ustr( err.faultCode)
+                faultString = ustr( err.faultString)
+                raise RpcServerException( faultCode, faultString )
+            except Exception:
+                # the stream may be out of sync
+                self._drop_socket()
+                raise
+            finally:
+                if not self.persistent:
+                    self._drop_socket()
+            return self.stringToUnicode(result, inplace=True)
 
 session.Session.proto_handlers.append(SocketConnection)
 # eof
@@ -27,7 +27,6 @@
 
 """
 
-import gzip
 # import errno
 import socket
 import json
@@ -39,7 +38,7 @@ from interface import TCPConnection
 import httplib
 
 from protocol_xmlrpc import PersistentAuthTransport, SafePersistentAuthTransport, \
-        BasicAuthClient
+        BasicAuthClient, iter_response
 
 try:
     from cStringIO import StringIO
@@ -66,21 +65,12 @@ class JSON_add_transport:
         """
         self._check_return_type(response)
 
-        respdata = StringIO()
-        while not response.isclosed():
-            rdata = response.read(1024)
-            if not rdata:
-                break
-            respdata.write(rdata)
-        respdata.seek(0)
-
-        if response.msg.get('content-encoding') == 'gzip':
-            rbuffer = gzip.GzipFile(mode='rb', fileobj=respdata)
-        else:
-            rbuffer = respdata
+        # The json module can only parse a complete document, so collect
+        # the decompressed chunks and join them once.
+        respdata = ''.join(iter_response(response, self._read_chunk, self._read_chunk_max))
 
         try:
-            return json.load(rbuffer, object_hook=json_helpers.json_hook)
+            return json.loads(respdata, object_hook=json_helpers.json_hook)
         except Exception, e:
             raise errors.RpcProtocolException(unicode(e))
 
@@ -142,6 +132,7 @@ class RpcJsonConnection(TCPConnection):
             self.port = kwargs['port']
         send_gzip = True
         self._transport = self._TransportClass(send_gzip=send_gzip)
+        self._transport.traced = self.traced
         uri = '%s:%s' % (self.host, self.port)
         self._prepare_transport()
         self._transport.make_connection(uri)
@@ -150,6 +141,48 @@ class RpcJsonConnection(TCPConnection):
 
         return True
 
+    def check(self):
+        return bool(self._transport) and self._transport.check()
+
+    def set_traced(self, traced):
+        self.traced = traced
+        if self._transport:
+            self._transport.set_traced(traced)
+
+    def close(self):
+        if self._transport:
+            self._transport.close()
+
+    def warm_up(self):
+        """ Perform a trivial call, which gets the HTTP authentication done
+        """
+        self.call_orm('res.users', 'context_get', [], {})
+
+    def _req_struct(self, method, args, kwargs=None):
+        """ Build the JSON request of one call
+
+            @return (id, request dict)
+        """
+        req_id = str(self._req_counter)
+        self._req_counter += 1
+        req_struct = { "version": "1.1",
+            "id": req_id,
+            "method": str(method),
+            }
+
+        if not kwargs:
+            req_struct["params"] = list(args)
+        else:
+            req_struct['params'] = kwargs.copy()
+            if args:
+                req_struct['params'].update(dict(enumerate(args)))
+        return req_id, req_struct
+
+    def _check_res(self, res):
+        if not isinstance(res, dict) or res.get('version') not in ('1.0', '1.1', '1.2'):
+            raise errors.RpcProtocolException("Invalid JSON version: %s" % \
+                    (isinstance(res, dict) and res.get('version') or '<unknown>'))
+
     def _do_request(self, path, method, args, kwargs=None):
         """ Request, including the marshalling of parameters
 
@@ -158,36 +191,65 @@ class RpcJsonConnection(TCPConnection):
 
             @param path a list of path components
         """
+        req_id, req_struct = self._req_struct(method, args, kwargs)
+        res = self._post(path, req_struct, method, args)
+        if res.get('id') != req_id:
+            raise errors.RpcProtocolException("Protocol Out of order: %r != %r" %\
+                    (res.get('id'), req_id))
+        if res.get('error'):
+            raise RpcJServerException(res['error'])
+        return res.get('result', None)
+
+    def _do_batch(self, path, reqs):
+        """ Request a list of calls to the same `path`, as one JSON batch
+
+            @param reqs a list of (method, args, kwargs)
+            @return a list of results, or RpcJServerException instances
+        """
+        ids = []
+        structs = []
+        for method, args, kwargs in reqs:
+            req_id, req_struct = self._req_struct(method, args, kwargs)
+            ids.append(req_id)
+            structs.append(req_struct)
+        res = self._post(path, structs, 'batch', reqs)
+        if not isinstance(res, list):
+            raise errors.RpcProtocolException("Server did not return a batch response")
+        by_id = {}
+        for r in res:
+            self._check_res(r)
+            by_id[r.get('id')] = r
+        ret = []
+        for req_id in ids:
+            r = by_id.get(req_id)
+            if r is None:
+                raise errors.RpcProtocolException("No response for request %s of batch" % req_id)
+            if r.get('error'):
+                ret.append(RpcJServerException(r['error']))
+            else:
+                ret.append(r.get('result', None))
+        return ret
+
+    def _post(self, path, req_struct, method, args, stream=False):
+        """ Send a request (or a batch), get the decoded response
+
+            Also decode possible Exceptions to the appropriate RpcException
+            classes. `method` and `args` are only used for logging.
+            @param stream if True, return the open HTTP response, instead
+        """
         try:
             url = '/json/' + '/'.join(map(str, path))
-            req_id = str(self._req_counter)
-            self._req_counter += 1
             # self._log.debug("path: %s", url)
-            req_struct = { "version": "1.1",
-                "id": req_id,
-                "method": str(method),
-                }
-
-            if not kwargs:
-                req_struct["params"] = list(args)
-            else:
-                req_struct['params'] = kwargs.copy()
-                if args:
-                    req_struct['params'].update(dict(enumerate(args)))
             req_body = json.dumps(req_struct, cls=json_helpers.JsonEncoder2)
             # makes it little more readable:
             req_body += "\n"
             del req_struct
             host = '%s:%s' % (self.host, self.port)
+            if stream:
+                return self._transport._open_request(host, url, req_body)
             res = self._transport.request(host, url, req_body)
-            if res.get('version') not in ('1.0', '1.1', '1.2'):
-                raise errors.RpcProtocolException("Invalid JSON version: %s" % \
-                        res.get('version', '<unknown>'))
-            if res.get('id') != req_id:
-                raise errors.RpcProtocolException("Protocol Out of order: %r != %r" %\
-                        (res.get('id'), req_id))
-            if res.get('error'):
-                raise RpcJServerException(res['error'])
+            if not isinstance(res, list):
+                self._check_res(res)
 
         except socket.error, err:
             if err.errno in errors.ENONET:
@@ -215,7 +277,7 @@ class RpcJsonConnection(TCPConnection):
             self._log.exception("Exception:")
             raise
 
-        return res.get('result', None)
+        return res
 
     def call(self, obj, method, args, auth_level='db'):
         """ Call a remote function of the OpenERP server
@@ -271,6 +333,95 @@ class RpcJsonConnection(TCPConnection):
 
         return result
 
+    def call_orm_iter(self, model, method, args, kwargs):
+        """ Variant of call_orm(), yielding the elements of the result list
+
+            The response is decoded incrementally, so each element is
+            yielded as soon as it has arrived, and the full list is never
+            held in memory.
+        """
+        path = ['orm', self._session.auth_proxy.dbname, model]
+        self._transport._auth_realm = "OpenERP User"
+        req_id, req_struct = self._req_struct(method, args, kwargs)
+        resp = self._post(path, req_struct, method, args, stream=True)
+        stream = json_helpers.JsonResultStream(object_hook=json_helpers.json_hook)
+        complete = False
+        try:
+            self._transport._check_return_type(resp)
+            try:
+                for rdata in iter_response(resp, self._transport._read_chunk,
+                            self._transport._read_chunk_max):
+                    for rec in stream.feed(rdata):
+                        yield rec
+                stream.close()
+            except ValueError, e:
+                raise errors.RpcProtocolException(unicode(e))
+            except socket.error, err:
+                if err.errno in errors.ENONET:
+                    raise errors.RpcNetworkException(err.strerror, err.errno)
+                raise errors.RpcProtocolException(err)
+            except httplib.HTTPException, err:
+                raise errors.RpcProtocolException(err.args and err.args[0] or err)
+            complete = True
+        finally:
+            resp.close()
+            if not complete:
+                # the rest of the response would confuse the next request
+                self._transport.close()
+
+        res = stream.header
+        self._check_res(res)
+        if res.get('id') != req_id:
+            raise errors.RpcProtocolException("Protocol Out of order: %r != %r" %\
+                    (res.get('id'), req_id))
+        if res.get('error'):
+            raise RpcJServerException(res['error'])
+        if res.get('result'):
+            # not a list, after all
+            yield res['result']
+
+    def call_many(self, calls):
+        """ Perform the calls as JSON batches, if the server supports that
+
+            Calls to the same path (and authentication realm) are sent in
+            one request.
+        """
+        if 'json-batch' not in self._session.server_options:
+            return super(RpcJsonConnection, self).call_many(calls)
+        groups = {}
+        group_keys = []
+        for i, c in enumerate(calls):
+            if c[0] == 'orm':
+                model, method, args, kwargs = c[1:]
+                path = ('orm', self._session.auth_proxy.dbname, model)
+                realm = "OpenERP User"
+            else:
+                obj, method, args, auth_level = c[1:]
+                kwargs = None
+                assert auth_level != 'login', "Cannot login in a batch"
+                if auth_level == 'db':
+                    path = ('db', self._session.auth_proxy.dbname)
+                    realm = "OpenERP User"
+                else:
+                    path = (auth_level,)
+                    realm = (auth_level == 'root') and "OpenERP Admin" or None
+                path += (obj.lstrip('/'),)
+            key = (path, realm)
+            if key not in groups:
+                groups[key] = []
+                group_keys.append(key)
+            groups[key].append((i, (method, args, kwargs)))
+
+        ret = [None] * len(calls)
+        for key in group_keys:
+            path, realm = key
+            if realm:
+                self._transport._auth_realm = realm
+            results = self._do_batch(list(path), [r for i, r in groups[key]])
+            for (i, r), res in zip(groups[key], results):
+                ret[i] = res
+        return ret
+
 
 class RpcJsonSConnection(RpcJsonConnection):
     """Implement RPC-JSON connection over HTTPS (secure)
@@ -26,12 +26,16 @@ import logging
 import gzip
 import errno
 import socket
+import select
+import zlib
 from xmlrpclib import Transport,ProtocolError, ServerProxy, Fault
 import xmlrpclib
 import errors
 from interface import TCPConnection
 import httplib
 from tools import ustr
+from stats import count_sent, count_received
+from tracing import current_span
 
 #.apidoc title: protocol_xmlrpc - XML-RPC v1 and v2 client
 
@@ -146,6 +150,86 @@ class _fileobject2(object):
                 #assert buf_len == buf.tell()
             return buf.getvalue()
 
+def sock_is_stale(sock):
+    """ Tell if an idle socket has been closed (or written to) by the peer
+
+        Polls the socket without blocking. Since we expect nothing from
+        the server between requests, a readable socket means it has been
+        closed (EOF) or is out of sync, and shall not be used again.
+        @return False for a healthy socket, or when there is none
+    """
+    if sock is None:
+        return False
+    try:
+        if getattr(sock, 'pending', None) and sock.pending():
+            return True # SSL has buffered data
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(sock, select.POLLIN | select.POLLPRI)
+            return bool(poller.poll(0)) # also gets POLLHUP, POLLERR
+        rd, wr, ex = select.select([sock], [], [sock], 0)
+        return bool(rd or ex)
+    except (select.error, socket.error, ValueError):
+        # closed socket, bad fd
+        return True
+
+def iter_response(response, chunk_size=65536, max_chunk=1048576):
+    """ Iterate over the body of an HTTP response, decompressed, in chunks
+
+        gzip-encoded bodies are decompressed as they are read, and no chunk
+        is longer than `max_chunk`, so that a large response is never held
+        in memory, compressed or not.
+
+        Reads start at `chunk_size` and double, up to `max_chunk`, while
+        the body is still longer than them. With a Content-Length, the
+        last read asks for exactly the remaining bytes. So, a large body
+        takes a few reads, a small one a single read.
+    """
+    encoding = response.msg.get('content-encoding')
+    if encoding == 'gzip':
+        decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding and encoding != 'identity':
+        raise errors.RpcProtocolException("Unsupported Content-Encoding: %s" % encoding)
+    else:
+        decomp = None
+
+    size = chunk_size
+    wire_bytes = raw_bytes = 0
+    try:
+        while not response.isclosed():
+            if response.length is not None:
+                # httplib keeps the remaining length of the body here
+                if response.length <= 0:
+                    break
+                size = min(size, response.length)
+            rdata = response.read(size)
+            if not rdata:
+                break
+            wire_bytes += len(rdata)
+            if len(rdata) == size and size < max_chunk:
+                size = min(size * 2, max_chunk)
+            if decomp is None:
+                raw_bytes += len(rdata)
+                yield rdata
+                continue
+            while rdata:
+                try:
+                    ddata = decomp.decompress(rdata, max_chunk)
+                except zlib.error, e:
+                    raise errors.RpcProtocolException("Cannot decompress response: %s" % e)
+                if ddata:
+                    raw_bytes += len(ddata)
+                    yield ddata
+                rdata = decomp.unconsumed_tail
+
+        if decomp is not None:
+            ddata = decomp.flush()
+            if ddata:
+                raw_bytes += len(ddata)
+                yield ddata
+    finally:
+        count_received(raw_bytes, wire_bytes)
+
 class HTTPResponse2(httplib.HTTPResponse):
     def __init__(self, sock, debuglevel=0, strict=0, method=None):
         self.fp = _fileobject2(sock.makefile('rb'))
@@ -166,18 +250,32 @@ class HTTPResponse2(httplib.HTTPResponse):
         self.will_close = httplib._UNKNOWN      # conn will close at end of response
 
 
+
 class HTTPConnection2(httplib.HTTPConnection):
     _http_vsn = 11
     _http_vsn_str = 'HTTP/1.1'
     response_class = HTTPResponse2
+    traced = False #: mark the phases of the current span, set by the transport
 
     def is_idle(self):
         return self._HTTPConnection__state == httplib._CS_IDLE
     
     def connect(self):
+        if self.traced:
+            span = current_span()
+            if span is not None:
+                span.phase('connect')
         httplib.HTTPConnection.connect(self)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, True)
 
+    def getresponse(self, buffering=False):
+        resp = httplib.HTTPConnection.getresponse(self, buffering)
+        if self.traced:
+            span = current_span()
+            if span is not None:
+                span.phase('parse')
+        return resp
+
 
 try:
     if sys.version_info[0:2] < (2,6):
@@ -189,6 +287,7 @@ try:
         _http_vsn = 11
         _http_vsn_str = 'HTTP/1.1'
         response_class = HTTPResponse2
+        traced = False
 
         def __init__(self, *args, **kwargs):
             if sys.version_info[0:3] >= (2,7,9) and kwargs.get('context', None) is None:
@@ -200,7 +299,19 @@ try:
             # Still, we have a problem here, because we cannot tell if the connection is
             # closed.
 
+        def getresponse(self, buffering=False):
+            resp = httplib.HTTPSConnection.getresponse(self, buffering)
+            if self.traced:
+                span = current_span()
+                if span is not None:
+                    span.phase('parse')
+            return resp
+
         def connect(self):
+            if self.traced:
+                span = current_span()
+                if span is not None:
+                    span.phase('connect')
             try:
                 ret = httplib.HTTPSConnection.connect(self)
                 self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, True)
@@ -221,6 +332,9 @@ class PersistentTransport(Transport):
     """Handles an HTTP transaction to an XML-RPC server, persistently."""
     
     _content_type = "text/xml"
+    _read_chunk = 65536 #: bytes of the first read of a response
+    _read_chunk_max = 1048576 #: bytes read at a time, from large responses
+    traced = False #: mark the phases of the current span, see `set_traced()`
 
     def __init__(self, use_datetime=0, send_gzip=False):
         Transport.__init__(self)
@@ -243,6 +357,7 @@ class PersistentTransport(Transport):
         if (not self._http_conn) or (self._http_host != host):
             host, extra_headers, x509 = self.get_host_info(host)
             self._http_conn = HTTPConnection2(host)
+            self._http_conn.traced = self.traced
             self._http_conn.connect()
             self._log.info("New connection to %s", host)
             self._http_host = host
@@ -250,6 +365,24 @@ class PersistentTransport(Transport):
 
         return self._http_conn
 
+    def check(self):
+        """ Tell if the HTTP connection is usable for the next request
+
+            A connection dropped by the server (at keep-alive timeout) is
+            detected here, rather than costing a failed request.
+        """
+        if self._http_conn and sock_is_stale(self._http_conn.sock):
+            return False
+        return True
+
+    def close(self):
+        """ Close the underlying HTTP connection, if any
+        """
+        if self._http_conn:
+            self._http_conn.close()
+            self._http_conn = None
+            self._common_headers_sent = {}
+
     def get_host_info(self, host):
         host, extra_headers, x509 = Transport.get_host_info(self,host)
         if extra_headers == None:
@@ -263,41 +396,21 @@ class PersistentTransport(Transport):
         """ read response from input file/socket, and parse it
             We are persistent, so it is important to only parse
             the right amount of input
+
+            The body is decompressed and fed to the parser chunk by chunk,
+            so that we never hold the whole of it.
         """
 
         p, u = self.getparser()
         self._check_return_type(response)
 
-        if response.msg.get('content-encoding') == 'gzip':
-            gzdata = StringIO()
-            while not response.isclosed():
-                rdata = response.read(1024)
-                if not rdata:
-                    break
-                gzdata.write(rdata)
-            gzdata.seek(0)
-            rbuffer = gzip.GzipFile(mode='rb', fileobj=gzdata)
-            while True:
-                respdata = rbuffer.read()
-                if not respdata:
-                    break
-                try:
-                    p.feed(respdata)
-                except Exception, e:
-                    raise errors.RpcProtocolException(unicode(e))
-        else:
-            while not response.isclosed():
-                rdata = response.read(1024)
-                if not rdata:
-                    break
-                if self.verbose:
-                    print "body:", repr(response)
-                try:
-                    p.feed(rdata)
-                except Exception, e:
-                    raise errors.RpcProtocolException(unicode(e))
-                if len(rdata)<1024:
-                    break
+        for rdata in iter_response(response, self._read_chunk, self._read_chunk_max):
+            if self.verbose:
+                print "body:", repr(rdata)
+            try:
+                p.feed(rdata)
+            except Exception, e:
+                raise errors.RpcProtocolException(unicode(e))
 
         p.close()
         return u.close()
@@ -351,14 +464,30 @@ class PersistentTransport(Transport):
             Transport.send_user_agent(self, h)
             self._common_headers_sent['user_agent'] = True
 
+    def set_traced(self, traced):
+        """ Turn the tracing hooks on or off, for this and its HTTP connection
+
+            Off, they cost nothing, not even a look for the current span.
+        """
+        self.traced = traced
+        if self._http_conn is not None:
+            self._http_conn.traced = traced
+
     def send_content(self, connection, request_body):
+        span = self.traced and current_span() or None
+        if span is not None and span.tracer.inject_headers:
+            for name, value in span.tracer.headers(span):
+                connection.putheader(name, value)
         if not request_body:
             connection.putheader("Content-Length",'0')
             connection.putheader("Accept-Encoding",'gzip')
             connection.endheaders()
+            if span is not None:
+                span.phase('wait')
             return
 
         connection.putheader("Content-Type", self._content_type)
+        raw_len = len(request_body)
 
         if self._send_gzip and len(request_body) > 200:
             sbuffer = StringIO()
@@ -373,10 +502,13 @@ class PersistentTransport(Transport):
 
         connection.putheader("Content-Length", str(len(request_body)))
         connection.putheader("Accept-Encoding",'gzip')
+        count_sent(raw_len, len(request_body))
         if sys.version_info[0:2] >= (2,7):
             connection.endheaders(request_body)
         else:
             self.__send_all_headers(connection, request_body)
+        if span is not None:
+            span.phase('wait')
 
     def __send_all_headers(self, conn, message_body):
         """ the equivalent of conn.endheaders(...)
@@ -403,6 +535,10 @@ class PersistentTransport(Transport):
             conn.send(message_body)
 
     def send_request(self, connection, handler, request_body):
+        if self.traced:
+            span = current_span()
+            if span is not None:
+                span.phase('send')
         connection.putrequest("POST", handler, skip_accept_encoding=1)
 
 class SafePersistentTransport(PersistentTransport):
@@ -422,6 +558,7 @@ class SafePersistentTransport(PersistentTransport):
         if (not self._http_conn) or (self._http_host != host):
             host, extra_headers, x509 = self.get_host_info(host)
             self._http_conn = HTTPSConnection2(host, None, **(x509 or {}))
+            self._http_conn.traced = self.traced
             self._http_conn.connect()
             self._http_host = host
             self._log.info("New connection to %s", host)
@@ -523,11 +660,24 @@ class addAuthTransport:
 
     def request(self, host, handler, request_body, verbose=0):
         # issue XML-RPC request
+        resp = self._open_request(host, handler, request_body, verbose)
+        try:
+            return self._parse_response(resp)
+        finally:
+            resp.close()
+
+    def _open_request(self, host, handler, request_body, verbose=0):
+        """ Issue the request, negotiating authentication
+
+            @return the response, successful and open, for the caller to
+                read its body and close it
+        """
         max_tries = getattr(self, "_auth_tries", 3)
         tries = 0
         h = None
 
         while(tries < max_tries):
+            ret = None
             try:
                 resp = None
                 if not h:
@@ -561,6 +711,10 @@ class addAuthTransport:
                 if self._auth_client:
                     aresp = self._auth_client.parseResponse(resp, self, host+handler)
                     if resp.status == 401 and aresp:
+                        if self.traced:
+                            span = current_span()
+                            if span is not None:
+                                span.phase('auth')
                         continue
 
                 if resp.status == 401:
@@ -573,9 +727,11 @@ class addAuthTransport:
                         resp.status, resp.reason, resp.msg )
 
                 self.verbose = verbose
-                return self._parse_response(resp)
+                ret = resp
+                return ret
             finally:
-                if resp: resp.close()
+                if resp and resp is not ret:
+                    resp.close()
 
         raise ProtocolError(host+handler, 403, "No authentication",'')
 
@@ -615,6 +771,7 @@ class XmlRpcConnection(TCPConnection):
             self.port = kwargs['port']
         send_gzip = 'xmlrpc-gzip' in self._session.server_options
         self._transport = self._TransportClass(send_gzip=send_gzip)
+        self._transport.traced = self.traced
         uri = '%s:%s' % (self.host, self.port)
         self._prepare_transport()
         self._transport.make_connection(uri)
@@ -628,6 +785,18 @@ class XmlRpcConnection(TCPConnection):
                 self._log.debug("Going gzip for %s..", self.prettyUrl())
         return True
 
+    def check(self):
+        return bool(self._transport) and self._transport.check()
+
+    def set_traced(self, traced):
+        self.traced = traced
+        if self._transport:
+            self._transport.set_traced(traced)
+
+    def close(self):
+        self._ogws = {}
+        if self._transport:
+            self._transport.close()
 
     def gw(self,obj):
         """ Return the persistent gateway for some object
@@ -644,21 +813,31 @@ class XmlRpcConnection(TCPConnection):
         
         return self._ogws[obj]
 
+    def _proxy(self, obj, auth_level):
+        return self.gw(obj)
+
+    def _call_args(self, auth_level, args):
+        """ Full arguments of a call, with the credentials that v1 needs
+        """
+        apro = self._session.auth_proxy
+        if auth_level == 'login':
+            cargs = (apro.dbname, apro.user, apro.passwd)
+        elif auth_level == 'db':
+            cargs = (apro.dbname, apro.uid, apro.passwd)
+        elif auth_level == 'root':
+            cargs = (apro.superpass,)
+        else:
+            cargs = ()
+        return cargs + tuple(args)
+
+    def _fault_exception(self, fault):
+        return errors.RpcServerException(fault.faultCode, fault.faultString)
+
     def call(self, obj, method, args, auth_level='db'):
         remote = self.gw(obj)
         function = getattr(remote, method)
         try:
-            apro = self._session.auth_proxy
-            if auth_level == 'login':
-                cargs = (apro.dbname, apro.user, apro.passwd)
-            elif auth_level == 'db':
-                cargs = (apro.dbname, apro.uid, apro.passwd)
-            elif auth_level == 'root':
-                cargs = (apro.superpass,)
-            else:
-                cargs = ()
-            cargs += tuple(args)
-            result = function( *cargs )
+            result = function( *self._call_args(auth_level, args) )
         except socket.error, err:
             if err.errno in errors.ENONET:
                 raise errors.RpcNetworkException(err.strerror, err.errno)
@@ -678,6 +857,59 @@ class XmlRpcConnection(TCPConnection):
             raise
         return result
 
+    def call_many(self, calls):
+        """ Perform the calls through `system.multicall`, if available
+
+            Calls to the same endpoint are sent in one request, so a list
+            of ORM calls takes a single round trip.
+        """
+        if 'xmlrpc-multicall' not in self._session.server_options:
+            return super(XmlRpcConnection, self).call_many(calls)
+        groups = {}
+        group_keys = [] # keep the order of requests
+        for i, c in enumerate(calls):
+            if c[0] == 'orm':
+                obj, method, args = self._orm_as_call(*c[1:])
+                auth_level = 'db'
+            else:
+                obj, method, args, auth_level = c[1:]
+            assert auth_level != 'login', "Cannot login in a multicall"
+            key = (obj, auth_level)
+            if key not in groups:
+                groups[key] = []
+                group_keys.append(key)
+            groups[key].append((i, {'methodName': method,
+                        'params': self._call_args(auth_level, args)}))
+
+        ret = [None] * len(calls)
+        for key in group_keys:
+            obj, auth_level = key
+            idxs = [i for i, mc in groups[key]]
+            try:
+                results = self._proxy(obj, auth_level).system.multicall(
+                            [mc for i, mc in groups[key]])
+            except socket.error, err:
+                if err.errno in errors.ENONET:
+                    raise errors.RpcNetworkException(err.strerror, err.errno)
+                self._log.error("socket error: %s" % err)
+                raise errors.RpcProtocolException( err )
+            except ProtocolError, err:
+                if err.errcode == 404:
+                    raise errors.RpcNoProtocolException(err.errmsg)
+                raise errors.RpcProtocolException(err.errmsg)
+            except Fault, err:
+                # the multicall itself has failed
+                raise self._fault_exception(err)
+            if len(results) != len(idxs):
+                raise errors.RpcProtocolException("Multicall returned %d results for %d calls" % \
+                        (len(results), len(idxs)))
+            for i, res in zip(idxs, results):
+                if isinstance(res, dict):
+                    ret[i] = self._fault_exception(Fault(res.get('faultCode'), res.get('faultString', '')))
+                else:
+                    ret[i] = res[0]
+        return ret
+
 class XmlRpcSConnection(XmlRpcConnection):
     """@brief The XmlRpcConnection class implements Connection class for XML-RPC Secure.
 
@@ -716,6 +948,21 @@ class XmlRpc2Connection(XmlRpcConnection):
         if update:
             self._transport.setAuthClient(self._authclient)
 
+    def warm_up(self):
+        """ Perform a trivial call, which gets the HTTP authentication done
+        """
+        self.call('/object', 'execute', ('res.users', 'context_get'), auth_level='db')
+
+    def _proxy(self, obj, auth_level):
+        return self.gw(obj, auth_level)
+
+    def _call_args(self, auth_level, args):
+        # credentials go in the HTTP authentication
+        return tuple(args)
+
+    def _fault_exception(self, fault):
+        return errors.Rpc2ServerException(fault.faultCode, fault.faultString)
+
     def gw(self, obj, auth_level):
         """ Return the persistent gateway for some object
         
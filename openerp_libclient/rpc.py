@@ -30,10 +30,15 @@
 ##############################################################################
 
 import logging
+import sys
+import threading
+import time
 import session
 import protocols
 __hush_pyflakes = [ protocols, ]
 from errors import RpcProtocolException, RpcException
+from orm_cache import _freeze
+from tracing import current_span, call_in_span
 
 #.apidoc title: rpc - Object-like RPC interface to server
 
@@ -72,11 +77,29 @@ class RpcProxy(object):
 
     For example:
     @code obj = RpcProxy('ir.values')
+
+    A `priority` may be set for all calls through this proxy, see
+    `Session.priority()`
+
+    Large results can be iterated, rather than loaded at once:
+    @code for rec in obj.search_read.iter([], ['name']):
+
+    or fetched page by page, see `iter_search_read()`.
+
+    If the session has an `orm_cache`, read-like calls go through it,
+    unless `cache` is False.
+
+    With a `coalescer` (a `ReadCoalescer`, which may be shared by many
+    proxies), concurrent reads from many threads are merged.
     """
-    def __init__(self, resource, session=None, notify=True):
+    def __init__(self, resource, session=None, notify=True, priority=None, cache=True,
+                coalescer=None):
         global default_session
         self.resource = resource
         self.notify = notify
+        self.priority = priority
+        self.cache = cache
+        self.coalescer = coalescer
         self.session = session or default_session
         self.__attrs = {}
 
@@ -85,6 +108,80 @@ class RpcProxy(object):
             self.__attrs[name] = RpcFunction(self, name)
         return self.__attrs[name]
 
+    def iter_search_read(self, domain=None, fields=None, page_size=500, order=None,
+                context=None, prefetch=True):
+        """ Iterate over the records matching `domain`, page by page
+
+            The ids are searched once, then read in chunks of `page_size`.
+            While the caller consumes one page, the next one is fetched
+            (over another connection of the pool), so that at most two
+            pages are held in memory.
+            The records come in the `order` of the search, and they
+            bypass the `orm_cache` of the session.
+
+            The pages that are fetched in the background get the priority
+            and the tracing span that the caller had, when it called this.
+
+            @param prefetch fetch the next page in the background
+        """
+        return self._iter_search_read(domain, fields, page_size, order, context, prefetch,
+                        self.session.get_priority(self.priority), current_span())
+
+    def _iter_search_read(self, domain, fields, page_size, order, context, prefetch,
+                priority, span):
+        call_orm = self.session.call_orm
+        ids = call_orm(self.resource, 'search', [domain or [], 0, None, order, context], {},
+                        notify=self.notify, priority=priority, cache=False)
+
+        def read_page(chunk):
+            recs = call_orm(self.resource, 'read', [chunk, fields, context], {},
+                        notify=self.notify, priority=priority, cache=False)
+            # the server returns them in the default order of the model
+            by_id = dict((rec['id'], rec) for rec in recs)
+            return [by_id[i] for i in chunk if i in by_id]
+
+        chunks = [ids[i:i+page_size] for i in range(0, len(ids), page_size)]
+        del ids
+        if not prefetch:
+            for chunk in chunks:
+                for rec in read_page(chunk):
+                    yield rec
+            return
+
+        pending = chunks and _PagePrefetch(read_page, chunks[0], span)
+        for n in range(len(chunks)):
+            page = pending.get()
+            if n + 1 < len(chunks):
+                pending = _PagePrefetch(read_page, chunks[n + 1], span)
+            for rec in page:
+                yield rec
+            del page
+
+class _PagePrefetch(object):
+    """ Fetch a page in a background thread, within `span` (if any)
+    """
+    def __init__(self, fn, chunk, span=None):
+        self._fn = fn
+        self._result = None
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run, args=(chunk, span))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, chunk, span):
+        try:
+            self._result = call_in_span(span, self._fn, chunk)
+        except Exception:
+            self._exc_info = sys.exc_info()
+
+    def get(self):
+        """ Wait for the page, return it or raise its exception
+        """
+        self._thread.join()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        ret, self._result = self._result, None
+        return ret
 
 class RpcFunction(object):
     """ emulate a server-side method call
@@ -97,18 +194,165 @@ class RpcFunction(object):
         self.func = func_name
 
     def __call__(self, *args, **kwargs):
-        return self.proxy.session.call_orm(self.proxy.resource, self.func, list(args), kwargs, notify=self.proxy.notify)
+        proxy = self.proxy
+        if proxy.coalescer is not None and self.func in proxy.coalescer.methods:
+            return proxy.coalescer.call(proxy.session, proxy.resource, self.func, list(args), kwargs,
+                        notify=proxy.notify, priority=proxy.priority, cache=proxy.cache)
+        return proxy.session.call_orm(proxy.resource, self.func, list(args), kwargs,
+                        notify=proxy.notify, priority=proxy.priority, cache=proxy.cache)
+
+    def iter(self, *args, **kwargs):
+        """ Call the method, iterate over the elements of its result
+
+            See `Session.call_orm_iter()`
+        """
+        return self.proxy.session.call_orm_iter(self.proxy.resource, self.func, list(args), kwargs,
+                        notify=self.proxy.notify, priority=self.proxy.priority)
+
+class _ReadBatch(object):
+    """ The ids that concurrent callers want, for a single call
+    """
+    __slots__ = ('ids', 'callers', 'done', 'index', 'failed')
+
+    def __init__(self):
+        self.ids = set()
+        self.callers = 0
+        self.done = threading.Event()
+        self.index = None
+        self.failed = False
+
+class ReadCoalescer(object):
+    """ Merges concurrent `read()` and `name_get()` calls on the same model
+
+        The first caller waits for `window` seconds, while other threads
+        that read the same model, fields and context add their ids. Then,
+        a single call fetches the union of ids, and each caller gets the
+        records it asked for, in its order. The first caller does not wait
+        when the session has a free connection and no other merged call
+        is pending, because then its call would not queue behind others.
+
+        Use it through `RpcProxy(model, coalescer=...)`, sharing one
+        coalescer among the threads. If the merged call fails (ie. one
+        of the ids is not readable), each caller repeats its own call,
+        so that it gets its own result or exception.
+    """
+    methods = ('read', 'name_get')
+
+    def __init__(self, window=0.005, max_ids=1000):
+        """
+            @param window seconds to wait for other callers
+            @param max_ids the limit of ids in a merged call
+        """
+        self.window = window
+        self.max_ids = max_ids
+        self._lock = threading.Lock()
+        self._batches = {}
+        self.requests = 0
+        self.server_calls = 0
+
+    def stats(self):
+        """ Number of calls requested and of calls made to the server
+        """
+        return {'requests': self.requests, 'server_calls': self.server_calls}
+
+    def _parse_args(self, method, args, kwargs):
+        """ Split the ids from the other arguments of `method`
+
+            @return (ids, other args), or None if the call cannot be merged
+        """
+        if method == 'read':
+            names = ('ids', 'fields', 'context')
+        else:
+            names = ('ids', 'context')
+        if len(args) > len(names):
+            return None
+        for k in kwargs:
+            if k not in names[len(args):]:
+                return None
+        values = list(args) + [kwargs.get(k, None) for k in names[len(args):]]
+        while len(values) > 1 and values[-1] is None:
+            values.pop()
+        return values[0], tuple(values[1:])
+
+    def call(self, session, model, method, args, kwargs, notify=True, priority=None, cache=True):
+        """ Perform the call, merged with any concurrent ones
+        """
+        parsed = self._parse_args(method, args, kwargs)
+        if parsed is not None:
+            ids, extra = parsed
+            single = isinstance(ids, (int, long))
+            if single:
+                ids = [ids]
+            try:
+                key = (id(session), model, method, _freeze(extra))
+                hash(key)
+            except TypeError:
+                parsed = None
+        if parsed is None or not ids or not isinstance(ids, (list, tuple)):
+            return session.call_orm(model, method, args, kwargs, notify=notify,
+                        priority=priority, cache=cache)
+
+        leader = False
+        with self._lock:
+            self.requests += 1
+            batch = self._batches.get(key, None)
+            if batch is None or len(batch.ids) + len(ids) > self.max_ids:
+                batch = self._batches[key] = _ReadBatch()
+                leader = True
+                busy = len(self._batches) > 1
+            batch.ids.update(ids)
+            batch.callers += 1
+
+        if leader:
+            try:
+                if busy or not session.connections.count_free():
+                    time.sleep(self.window)
+                with self._lock:
+                    if self._batches.get(key) is batch:
+                        del self._batches[key]
+                    self.server_calls += 1
+                # a lone caller can have its own call, as usual
+                res = session.call_orm(model, method, [sorted(batch.ids)] + list(extra), {},
+                            notify=notify and batch.callers == 1, priority=priority, cache=cache)
+                if method == 'read':
+                    batch.index = dict((rec['id'], rec) for rec in res)
+                else:
+                    batch.index = dict((pair[0], pair) for pair in res)
+            except Exception:
+                if batch.callers == 1:
+                    raise
+                batch.failed = True
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.failed:
+            with self._lock:
+                self.server_calls += 1
+            return session.call_orm(model, method, args, kwargs, notify=notify,
+                        priority=priority, cache=cache)
+        index = batch.index
+        if method == 'read':
+            # copies, because other callers may get the same records
+            ret = [dict(index[i]) for i in ids if i in index]
+            if single:
+                return ret and ret[0] or False
+        else:
+            ret = [index[i] for i in ids if i in index]
+        return ret
 
 class RpcCustomProxy(object):
     """ A lower-level proxy, for custom RPC methods
     """
 
-    def __init__(self, path, session=None, auth_level='pub', notify=True):
+    def __init__(self, path, session=None, auth_level='pub', notify=True, priority=None):
         global default_session
         self.path = path
         self.session = session or default_session
         self.auth_level = auth_level
         self.notify = notify
+        self.priority = priority
         self.__attrs = {}
 
     def __getattr__(self, name):
@@ -123,6 +367,7 @@ class RpcCustomFunction(object):
 
     def __call__(self, *args):
         return self.proxy.session.call(self.proxy.path, self.func, args,
-                        auth_level=self.proxy.auth_level, notify=self.proxy.notify)
+                        auth_level=self.proxy.auth_level, notify=self.proxy.notify,
+                        priority=self.proxy.priority)
 
 #eof
\ No newline at end of file
@@ -22,12 +22,18 @@
 ##############################################################################
 
 from utils import Pool
-from errors import RpcException, RpcNetworkException, RpcProtocolException, RpcNoProtocolException, RpcServerException
+from errors import RpcException, RpcNetworkException, RpcProtocolException, RpcNoProtocolException, \
+            RpcServerException, RpcMapException
 from interface import Connection, RPCNotifier
+from stats import CallStats
+from tracing import activate_span, deactivate_span, current_span, call_in_span
 import logging
 import sys
 import time
 import socket
+import threading
+from contextlib import contextmanager
+from Queue import Queue
 
 #.apidoc title: session - Connection to server
 
@@ -37,6 +43,13 @@ import socket
     credentials, behave like a single communication trunk (multi-threaded)
     """
 
+PRIO_BATCH = -10
+PRIO_NORMAL = 0
+PRIO_INTERACTIVE = 10
+""" Priority classes of calls, see `Session.priority()`. Any integer may
+    be used, higher ones are served first
+"""
+
 class AbstractAuthProxy(object):
     """Provides authentication source for connections
     """
@@ -56,6 +69,43 @@ class PasswdAuth(AbstractAuthProxy):
         self.superpass = conn_params.get('superpass', None)
 
 
+class CallBatch(object):
+    """ Collector of calls, see `Session.batch()`
+
+        Each call returns its index in `results`, which are available after
+        `execute()`.
+    """
+    def __init__(self, session, notify=True, priority=None):
+        self._session = session
+        self._notify = notify
+        self._priority = priority
+        self.calls = []
+        self.results = None
+
+    def call(self, obj, method, args, auth_level='db'):
+        self.calls.append(('call', obj, method, args, auth_level))
+        return len(self.calls) - 1
+
+    def call_orm(self, model, method, args, kwargs=None):
+        self.calls.append(('orm', model, method, args, kwargs or {}))
+        return len(self.calls) - 1
+
+    def execute(self):
+        """ Perform the collected calls, return their results
+        """
+        calls, self.calls = self.calls, []
+        self.results = self._session.call_many(calls, notify=self._notify,
+                        priority=self._priority)
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.execute()
+        return False
+
 class Session(object):
     """ Main class for OpenERP connectivity
 
@@ -77,10 +127,44 @@ class Session(object):
 
             expirer = loopthread.LoopThread(mysess.conn_expire, mysess.loop_once)
             expirer.start()
+
+        With `min_idle`, the same loop will also keep that many idle
+        connections established (and authenticated) for the next calls, so
+        that a burst of calls does not pay for connecting. Call `loop_once()`
+        once after `login()` to have them ready at start. Connections that
+        the pool drops (expired, trimmed, failing their check) are closed
+        right away; with `conn_max_age`, they are also replaced after that
+        many seconds, even if they are busy all the time.
+
+        Calls may have a priority, passed to `call()`, `call_orm()` or set
+        for the current thread with `priority()`. When all connections are
+        busy, the higher priority calls get the first free one. With
+        `reserve_connections()`, some connections can be kept available
+        for urgent calls only, so that batch jobs cannot starve them.
+
+        With an `orm_cache` (see `orm_cache.OrmCache`), the results of
+        read-like ORM calls are cached, and writes through this session
+        invalidate the entries of their model. A `MetadataCache` keeps
+        the model definitions on disk, across runs.
+
+        With `enable_stats()`, the latency and bytes of the calls are
+        counted, per protocol, path or model and method. See `stats()`.
+        The connection pool is always counted, see `pool_stats()`.
+
+        A `tracer` (see `tracing.Tracer`) gets a span for each call, with
+        the time of its phases, and passes the trace id to the server.
     """
     session_limit = 30
     conn_timeout = 30.0 # limit of seconds to wait for a free connection
     conn_expire = 60.0 # seconds after which a connection shall close
+    min_idle = 0 # idle connections to keep established, by `loop_once()`
+    max_idle = None # if set, close idle connections beyond that number
+    conn_max_age = None # if set, seconds after which a connection is replaced
+    batch_limit = 200 # calls per request, in `call_many()`
+    orm_cache = None # an OrmCache, for the results of `call_orm()`
+    call_stats = None # a CallStats, set by `enable_stats()`
+    pool_stats_interval = None # if set, seconds between logs of `pool_stats()`
+    _tracer = None # see the `tracer` property
     proto_handlers = []
     """ A list of classes like [XmlRpcConnection, ...] that handle each protocol
     """
@@ -93,6 +177,7 @@ class Session(object):
             return None # but don't break the loop
         newconn = self.__conn_klass(self)
         assert isinstance(newconn, Connection)
+        newconn.traced = self.tracer is not None
         try:
             if not newconn.establish(self.conn_args, do_init=False):
                 return None
@@ -134,6 +219,9 @@ class Session(object):
     def _check_connection(self, conn):
         return conn.check()
 
+    def _close_connection(self, conn):
+        conn.close()
+
     def __init__(self, notifier=None):
         self.state = False # = not ready
         self.conn_args = {} # as in host:port
@@ -145,11 +233,82 @@ class Session(object):
         self.server_version = (None, )
         self.server_options = []
         self._notifier = notifier or RPCNotifier()
+        self._local = threading.local()
         self.connections = Pool(iter(self.__create_connection_int, NotImplemented),
-                                self._check_connection)
+                                self._check_connection, fifo=True,
+                                close_fn=self._close_connection)
         self._log = logging.getLogger('RPC.Session')
+        self._pool_stats_logged = time.time()
+
+    @property
+    def tracer(self):
+        """ A tracing.Tracer, for spans around the calls, or None
+        """
+        return self._tracer
+
+    @tracer.setter
+    def tracer(self, tracer):
+        self._tracer = tracer
+        # the connections learn it here, so that lending them costs nothing
+        for conn in self.connections.resources():
+            conn.set_traced(tracer is not None)
+
+    @contextmanager
+    def priority(self, level):
+        """ Context manager, setting the priority of calls in this thread
+
+            Example::
+
+                with session.priority(PRIO_BATCH):
+                    session.call_orm('res.partner', 'search_read', ...)
+        """
+        old_level = getattr(self._local, 'priority', PRIO_NORMAL)
+        self._local.priority = level
+        try:
+            yield
+        finally:
+            self._local.priority = old_level
+
+    def reserve_connections(self, count, min_priority=PRIO_INTERACTIVE):
+        """ Keep `count` of the `session_limit` connections for urgent calls
+
+            Calls with lower priority than `min_priority` will have to wait,
+            rather than use the last `count` connections.
+        """
+        if count >= self.session_limit:
+            raise ValueError("Cannot reserve %d of %d connections" % (count, self.session_limit))
+        self.connections.set_reserve(count, min_priority, capacity=self.session_limit)
+
+    def get_priority(self, priority=None):
+        """ The priority that a call from this thread would get
+
+            That is `priority`, if not None, or the one of `priority()`.
+            Work handed to other threads shall carry this value.
+        """
+        if priority is None:
+            priority = getattr(self._local, 'priority', PRIO_NORMAL)
+        return priority
 
-    def call(self, obj, method, args, auth_level='db', notify=True):
+    def _borrow_connection(self, priority=None):
+        """ Get a connection from the pool, for `priority` or the thread's one
+        """
+        if priority is None:
+            priority = getattr(self._local, 'priority', PRIO_NORMAL)
+        return self.connections.borrow(self.conn_timeout, priority=priority)
+
+    def _borrow_traced(self, span, priority=None):
+        """ Get a connection, for a call traced by `span`
+        """
+        span.phase('pool')
+        try:
+            conn = self._borrow_connection(priority)
+        except Exception, e:
+            span.tracer.end_span(span, e)
+            raise
+        span.phase('serialize')
+        return conn
+
+    def call(self, obj, method, args, auth_level='db', notify=True, priority=None):
         """ Calls the specified method on the given object on the server.
 
             If there is an error during the call it simply rises an exception. See
@@ -158,14 +317,25 @@ class Session(object):
             @param obj Object name (string) that contains the method
             @param method Method name (string) to call
             @param args Argument list for the given method
+            @param priority of the call, default is the one of `priority()`
         """
         if (not self.state) or (auth_level == 'db' and self.state !='login'):
             if notify:
                 self._notifier.handleError("Not logged in")
             raise RpcException('Not logged in')
-        conn = self.connections.borrow(self.conn_timeout)
+        tracer = self.tracer
+        if tracer is None:
+            conn = self._borrow_connection(priority)
+        else:
+            span = tracer.start_span('call', {'path': obj, 'method': method})
+            conn = self._borrow_traced(span, priority)
+        call_stats = self.call_stats
+        if call_stats is not None:
+            stats_token = call_stats.begin()
+        failed = True
         try:
             value = conn.call(obj, method, args, auth_level=auth_level)
+            failed = False
         except RpcServerException, e:
             import inspect
             if notify:
@@ -179,9 +349,13 @@ class Session(object):
             raise
         finally:
             self.connections.free(conn)
+            if call_stats is not None:
+                call_stats.end(stats_token, conn.name, obj, method, failed)
+            if tracer is not None:
+                tracer.end_span(span, failed and sys.exc_info()[1] or None)
         return value
 
-    def call_orm(self, model, method, args, kwargs, notify=True):
+    def call_orm(self, model, method, args, kwargs, notify=True, priority=None, cache=True):
         """ variant of call(), focused on ORM object calls
 
             Since we end up calling object.execute(method, [params]) most of the
@@ -193,14 +367,35 @@ class Session(object):
             @param method the method, like read, search, write etc.
             @param args positional arguments
             @param kwargs keyword arguments. Not all servers support that.
+            @param priority of the call, default is the one of `priority()`
+            @param cache use the `orm_cache` (if any) for this call
         """
         if (not self.state) or (self.state !='login'):
             if notify:
                 self._notifier.handleError("Not logged in")
             raise RpcException('Not logged in')
-        conn = self.connections.borrow(self.conn_timeout)
+        orm_cache = self.orm_cache
+        key = None
+        if cache and orm_cache is not None and orm_cache.is_cached(model, method):
+            key = orm_cache.make_key(model, method, args, kwargs)
+            if key is not None:
+                hit, value = orm_cache.get(key)
+                if hit:
+                    return value
+                generation = orm_cache.generation(model)
+        tracer = self.tracer
+        if tracer is None:
+            conn = self._borrow_connection(priority)
+        else:
+            span = tracer.start_span('call_orm', {'model': model, 'method': method})
+            conn = self._borrow_traced(span, priority)
+        call_stats = self.call_stats
+        if call_stats is not None:
+            stats_token = call_stats.begin()
+        failed = True
         try:
             value = conn.call_orm(model, method, args, kwargs)
+            failed = False
         except RpcServerException, e:
             import inspect
             if notify:
@@ -216,8 +411,302 @@ class Session(object):
             raise
         finally:
             self.connections.free(conn)
+            if call_stats is not None:
+                call_stats.end(stats_token, conn.name, model, method, failed)
+            if tracer is not None:
+                tracer.end_span(span, failed and sys.exc_info()[1] or None)
+            if self.orm_cache is not None and method in self.orm_cache.invalidating:
+                self.orm_cache.invalidate(model)
+        if key is not None:
+            orm_cache.put(key, value, generation)
         return value
 
+    def call_orm_iter(self, model, method, args, kwargs, notify=True, priority=None):
+        """ variant of call_orm(), iterating over the elements of the result
+
+            With RPC-JSON, the response is decoded as it arrives, so that a
+            large `search_read` never needs the full list in memory. Other
+            protocols get the full result, first.
+
+            A connection is held until the iteration is over: exhaust the
+            iterator or close() it.
+        """
+        if (not self.state) or (self.state !='login'):
+            if notify:
+                self._notifier.handleError("Not logged in")
+            raise RpcException('Not logged in')
+        tracer = self.tracer
+        if tracer is None:
+            conn = self._borrow_connection(priority)
+        else:
+            span = tracer.start_span('call_orm_iter', {'model': model, 'method': method})
+            conn = self._borrow_traced(span, priority)
+        call_stats = self.call_stats
+        if call_stats is not None:
+            # counts the time until the end of the iteration
+            stats_token = call_stats.begin()
+        failed = True
+        try:
+            for rec in conn.call_orm_iter(model, method, args, kwargs):
+                if tracer is not None:
+                    # the caller's code, between records, is not ours
+                    deactivate_span(span)
+                yield rec
+                if tracer is not None:
+                    activate_span(span)
+            failed = False
+        except RpcServerException, e:
+            if notify:
+                self._notifier.handleRemoteException("Failed to call orm.%s/%s: %s", \
+                        model, method, e.args[0], exc_info=sys.exc_info())
+            raise
+        except Exception, e:
+            if notify:
+                self._notifier.handleException("Failed to call %s/%s", \
+                        model, method, exc_info=sys.exc_info())
+            raise
+        finally:
+            self.connections.free(conn)
+            if call_stats is not None:
+                call_stats.end(stats_token, conn.name, model, method, failed)
+            if tracer is not None:
+                tracer.end_span(span, failed and sys.exc_info()[1] or None)
+            if self.orm_cache is not None and method in self.orm_cache.invalidating:
+                self.orm_cache.invalidate(model)
+
+    def imap_unordered(self, model, method, chunks, args=(), kwargs=None, concurrency=None,
+                notify=True, priority=None, progress=True):
+        """ Call `model`.`method` for each of `chunks`, concurrently
+
+            Each call is like::
+
+                call_orm(model, method, [chunk] + list(args), kwargs)
+
+            and they run in up to `concurrency` threads, by default as many
+            as the `session_limit`, each borrowing its own connection.
+
+            @param chunks an iterable of the first argument of each call,
+                like lists of ids
+            @param progress report each completed call to the notifier,
+                through `handleProgress()`
+            @return an iterator of (index, result) tuples, in the order
+                that the calls complete. A failed call has its exception
+                as the result.
+
+            The calls get the priority and the tracing span of the caller,
+            at the time this is called.
+        """
+        if (not self.state) or (self.state !='login'):
+            if notify:
+                self._notifier.handleError("Not logged in")
+            raise RpcException('Not logged in')
+        return self._imap_unordered(model, method, chunks, args, kwargs, concurrency,
+                        notify, self.get_priority(priority), progress, current_span())
+
+    def _imap_unordered(self, model, method, chunks, args, kwargs, concurrency,
+                notify, priority, progress, span):
+        total = None
+        if hasattr(chunks, '__len__'):
+            total = len(chunks)
+        concurrency = min(concurrency or self.session_limit, self.session_limit)
+        if total is not None:
+            concurrency = min(concurrency, total)
+        args = list(args)
+        kwargs = kwargs or {}
+        source = enumerate(chunks)
+        lock = threading.Lock()
+        results = Queue()
+        stop = []
+
+        def worker():
+            try:
+                while not stop:
+                    with lock:
+                        if stop:
+                            break
+                        try:
+                            idx, chunk = next(source)
+                        except StopIteration:
+                            break
+                        except Exception:
+                            # the caller's iterable failed: no more chunks
+                            stop.append(True)
+                            results.put((None, sys.exc_info()))
+                            break
+                    try:
+                        res = call_in_span(span, self.call_orm, model, method,
+                                    [chunk] + args, kwargs, notify=notify, priority=priority)
+                    except Exception, e:
+                        res = e
+                    results.put((idx, res))
+            finally:
+                results.put(None)
+
+        for i in range(concurrency):
+            t = threading.Thread(target=worker, name="Session.map %s/%s" % (model, method))
+            t.daemon = True
+            t.start()
+
+        try:
+            running = concurrency
+            done = 0
+            while running:
+                item = results.get()
+                if item is None:
+                    running -= 1
+                    continue
+                if item[0] is None:
+                    exc_info = item[1]
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                done += 1
+                if progress:
+                    self._notifier.handleProgress(done, total, "%s/%s", model, method)
+                yield item
+        finally:
+            stop.append(True)
+
+    def map(self, model, method, chunks, args=(), kwargs=None, concurrency=None,
+                notify=True, priority=None, progress=True, return_errors=False):
+        """ Call `model`.`method` for each of `chunks`, concurrently
+
+            Like `imap_unordered()`, but returns the list of results, in
+            the order of `chunks`. Example::
+
+                ids = session.call_orm('res.partner', 'search', [[]], {})
+                chunks = [ids[i:i+500] for i in range(0, len(ids), 500)]
+                session.map('res.partner', 'write', chunks, args=({'active': True},))
+
+            @param return_errors put the exceptions of the failed calls in
+                the results, rather than raising an `RpcMapException`
+        """
+        results = {}
+        errors = {}
+        for idx, res in self.imap_unordered(model, method, chunks, args=args, kwargs=kwargs,
+                    concurrency=concurrency, notify=notify, priority=priority,
+                    progress=progress):
+            results[idx] = res
+            if isinstance(res, Exception):
+                errors[idx] = res
+        results = [results[i] for i in range(len(results))]
+        if errors and not return_errors:
+            raise RpcMapException(results, errors)
+        return results
+
+    def call_many(self, calls, notify=True, priority=None):
+        """ Perform many calls, in as few round trips as the server allows
+
+            With XML-RPC servers that support `system.multicall`, or RPC-JSON
+            ones that support batch requests, the calls are sent together.
+            Otherwise, they are issued one by one, over the same connection.
+
+            @param calls a list of tuples, each one like::
+
+                ('call', obj, method, args, auth_level)
+                ('orm', model, method, args, kwargs)
+
+            @return a list with the result of each call. A call that failed
+                at the server has its RpcServerException instance, instead.
+                Such failures are not notified, the caller shall check.
+
+            See also `batch()`
+        """
+        if (not self.state) or (self.state !='login'):
+            if notify:
+                self._notifier.handleError("Not logged in")
+            raise RpcException('Not logged in')
+        tracer = self.tracer
+        if tracer is None:
+            conn = self._borrow_connection(priority)
+        else:
+            span = tracer.start_span('call_many', {'calls': len(calls)})
+            conn = self._borrow_traced(span, priority)
+        call_stats = self.call_stats
+        if call_stats is not None:
+            stats_token = call_stats.begin()
+        failed = True
+        try:
+            ret = []
+            for i in range(0, len(calls), self.batch_limit):
+                ret += conn.call_many(calls[i:i+self.batch_limit])
+            failed = False
+        except Exception, e:
+            if notify:
+                self._notifier.handleException("Failed to call %d methods", \
+                        len(calls), exc_info=sys.exc_info())
+            raise
+        finally:
+            self.connections.free(conn)
+            if call_stats is not None:
+                call_stats.end(stats_token, conn.name, 'batch', 'call_many', failed)
+            if tracer is not None:
+                tracer.end_span(span, failed and sys.exc_info()[1] or None)
+            if self.orm_cache is not None:
+                for c in calls:
+                    if c[0] == 'orm' and c[2] in self.orm_cache.invalidating:
+                        self.orm_cache.invalidate(c[1])
+        return ret
+
+    def batch(self, notify=True, priority=None):
+        """ Collect calls, to perform them with `call_many()` at once
+
+            Example::
+
+                with session.batch() as batch:
+                    for pid, name in names:
+                        batch.call_orm('res.partner', 'write', [[pid], {'name': name}], {})
+                print batch.results
+
+            The calls are sent when the `with` block exits without an
+            exception.
+        """
+        return CallBatch(self, notify=notify, priority=priority)
+
+    def enable_stats(self, enabled=True):
+        """ Start (or stop) counting the latency and bytes of the calls
+        """
+        if not enabled:
+            self.call_stats = None
+        elif self.call_stats is None:
+            self.call_stats = CallStats()
+
+    def stats(self):
+        """ A snapshot of the call counters, see `stats.CallStats.snapshot()`
+
+            @return a list of dicts, one per protocol, path (or model) and
+                method. Empty if `enable_stats()` has not been called
+        """
+        if self.call_stats is None:
+            return []
+        return self.call_stats.snapshot()
+
+    def reset_stats(self):
+        """ Zero the call counters
+        """
+        if self.call_stats is not None:
+            self.call_stats.reset()
+
+    def pool_stats(self):
+        """ Telemetry of the connection pool, see `utils.Pool.stats()`
+
+            Adds the `limit` of connections and the `utilization`, the
+            average of used ones over that limit.
+        """
+        ret = self.connections.stats()
+        ret['limit'] = self.session_limit
+        ret['utilization'] = ret['avg_used'] / self.session_limit
+        return ret
+
+    def _log_pool_stats(self):
+        s = self.pool_stats()
+        self._log.info("Connections: %d used, %d free, %d max, %.0f%% utilization; "
+                "%d new, %d reused, %d discarded, %d expired; "
+                "%d waits, %.3fs avg, %.3fs max, %d timeouts",
+                s['used'], s['free'], s['high_water'], s['utilization'] * 100.0,
+                s['constructed'], s['reused'], s['discarded'],
+                s['expired'] + s['aged'] + s['trimmed'],
+                s['waits'], s['waits'] and (s['wait_time'] / s['waits']),
+                s['max_wait'], s['timeouts'])
+
     def open(self, proto, **kwargs):
         """Open the session, login() to some server, doing trivial checks
 
@@ -299,8 +788,15 @@ class Session(object):
         if not self.state:
             self._notifier.handleError("Not connected")
             raise RpcException('Not connnected')
+        tracer = self.tracer
+        if tracer is not None:
+            span = tracer.start_span('login')
+        failed = True
         try:
-            conn = self.connections.borrow(self.conn_timeout)
+            if tracer is None:
+                conn = self._borrow_connection()
+            else:
+                conn = self._borrow_traced(span)
             res = conn.call( '/common', 'login', (), auth_level='login')
             if not res:
                 self.state = 'nologin'
@@ -311,7 +807,8 @@ class Session(object):
                 self.auth_proxy.uid = res
                 self.conn_url = conn.prettyUrl()
                 self._log.info("Logged in to %s", self.conn_url )
-                self.context = conn.call('/object', 'execute', ('res.users', 'context_get'), auth_level='db') or {}
+                self.context = self._load_context(conn)
+            failed = False
             return res
         except Exception:
             self.state = 'nologin'
@@ -319,15 +816,33 @@ class Session(object):
             raise
         finally:
             self.connections.free(conn)
+            if tracer is not None and span.end is None:
+                tracer.end_span(span, failed and sys.exc_info()[1] or None)
+
+    def _load_context(self, conn, reload=False):
+        """ Get the context of the user, through the `orm_cache` if it has it
+        """
+        orm_cache = self.orm_cache
+        key = None
+        if orm_cache is not None and orm_cache.is_cached('res.users', 'context_get'):
+            key = orm_cache.make_key('res.users', 'context_get', [], {})
+            if key is not None and not reload:
+                hit, value = orm_cache.get(key)
+                if hit:
+                    return value
+        value = conn.call('/object', 'execute', ('res.users', 'context_get'), auth_level='db') or {}
+        if key is not None:
+            orm_cache.put(key, value)
+        return value
 
     def reloadContext(self):
         """Reloads the session context
 
             Useful when some user parameters such as language are changed
         """
-        conn = self.connections.borrow(self.conn_timeout)
+        conn = self._borrow_connection()
         try:
-            self.context = conn.call('/object', 'execute', ('res.users', 'context_get'), auth_level='db') or {}
+            self.context = self._load_context(conn, reload=True)
         finally:
             self.connections.free(conn)
 
@@ -353,10 +868,45 @@ class Session(object):
 
         This function may block for short periods (rfc?)
         """
-        if self.conn_expire:
-            self.connections.expire(self.conn_expire)
-            return time.time() + self.conn_expire
-        return False
+        if self.conn_expire or self.conn_max_age:
+            # read at each call, since they can be set on the instance
+            self.connections.expire(self.conn_expire, max_age=self.conn_max_age)
+        if self.max_idle is not None:
+            self.connections.trim(self.max_idle)
+        if self.min_idle and self.state == 'login':
+            self._replenish_idle()
+        next_time = False
+        if self.pool_stats_interval:
+            now = time.time()
+            if now >= self._pool_stats_logged + self.pool_stats_interval:
+                self._log_pool_stats()
+                self._pool_stats_logged = now
+            next_time = self._pool_stats_logged + self.pool_stats_interval
+        period = min(self.conn_expire or sys.maxint, self.conn_max_age or sys.maxint)
+        if period < sys.maxint:
+            next_time = min(next_time or sys.maxint, time.time() + period)
+        return next_time
+
+    def _replenish_idle(self):
+        """ Establish new connections, until `min_idle` ones are free
+
+            @return the number of connections added
+        """
+        added = 0
+        while self.connections.count_free() < self.min_idle:
+            try:
+                newconn = self.__create_connection_int()
+                if newconn is None:
+                    break # session_limit reached
+                newconn.warm_up()
+            except Exception:
+                self._log.warning("Cannot prepare an idle connection:", exc_info=True)
+                break
+            self.connections.push_free(newconn)
+            added += 1
+        if added:
+            self._log.debug("Established %d idle connections", added)
+        return added
 
     def get_uid(self):
         """ Get the authenticated user-id (from auth proxy)
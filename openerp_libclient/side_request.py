@@ -10,10 +10,11 @@ import logging
 import json
 import httplib
 import urllib
-import gzip
 from xmlrpclib import ProtocolError
 from openerp_libclient import json_helpers
 from openerp_libclient.session import Session
+from openerp_libclient.protocol_xmlrpc import iter_response
+from openerp_libclient.tracing import current_span
 
 #.apidoc title: Side-Channel HTTP requests on F3 server
 
@@ -59,6 +60,9 @@ class SideChannel(object):
                 h = trans.make_connection(host)
 
             tries += 1
+            span = trans.traced and current_span() or None
+            if span is not None:
+                span.phase('send')
             try:
                 h.putrequest(method, path+uparams, skip_accept_encoding=1)
                 trans.send_host(h, host)
@@ -86,6 +90,8 @@ class SideChannel(object):
                 if trans._auth_client:
                     aresp = trans._auth_client.parseResponse(resp, trans, host+path)
                     if resp.status == 401 and aresp:
+                        if span is not None:
+                            span.phase('auth')
                         continue
 
                 if resp.status == 401:
@@ -101,26 +107,16 @@ class SideChannel(object):
 
 
     def _decode_response(self, response):
-        if response.msg.get('content-encoding') == 'gzip':
-            gzdata = StringIO()
-            while not response.isclosed():
-                rdata = response.read(1024)
-                if not rdata:
-                    break
-                gzdata.write(rdata)
-            gzdata.seek(0)
-            rbuffer = gzip.GzipFile(mode='rb', fileobj=gzdata)
-        elif response.msg.get('content-encoding'):
-            raise NotImplementedError("Content-Encoding: %s" % response.msg.get('content-encoding'))
-        else:
-            rbuffer = response
+        encoding = response.msg.get('content-encoding')
+        if encoding and encoding not in ('gzip', 'identity'):
+            raise NotImplementedError("Content-Encoding: %s" % encoding)
         content_type = response.msg.get('content-type').split(';',1)[0]
         if content_type == 'application/json':
-            return json.load(rbuffer, object_hook=json_helpers.json_hook)
+            return json.loads(''.join(iter_response(response)), object_hook=json_helpers.json_hook)
         elif content_type == 'text/plain':
             if ';' in response.msg.get('content-type'):
                 raise NotImplementedError # encoding
-            return str(rbuffer.read()).decode('utf-8')
+            return ''.join(iter_response(response)).decode('utf-8')
         else:
             #while not response.isclosed():
             #    rdata = response.read(1024)
@@ -167,8 +163,16 @@ class SideChannel(object):
 
         resp = None
         saved_content_type = None
+        session = self.__session
+        tracer = session.tracer
+        if tracer is not None:
+            span = tracer.start_span('side_request', {'path': path, 'method': method})
+        error = None
         try:
-            conn = self.__session.connections.borrow(self.__session.conn_timeout)
+            if tracer is None:
+                conn = session._borrow_connection()
+            else:
+                conn = session._borrow_traced(span)
             # override the transport , restore later
             saved_content_type = conn._transport._content_type
             conn._transport._content_type = content_type
@@ -186,11 +190,16 @@ class SideChannel(object):
                                 resp.status, resp.reason, resp.msg )
 
                 return self._decode_response(resp)
+        except Exception, e:
+            error = e
+            raise
         finally:
             if conn and conn._transport:
                 conn._transport._content_type = saved_content_type
             if resp: resp.close()
             self.__session.connections.free(conn)
+            if tracer is not None and span.end is None:
+                tracer.end_span(span, error)
 
 
 #eof
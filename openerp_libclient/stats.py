@@ -0,0 +1,166 @@
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    Copyright (c) 2015 P. Christeas <xrg@hellug.gr>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+#.apidoc title: stats - Counters of RPC calls
+
+""" Latency and traffic counters of the calls of a session
+
+    Enabled with `Session.enable_stats()`. Each call is counted under its
+    protocol, path (or model) and method, with a histogram of its latency
+    and the bytes of its request and response bodies, both as sent over
+    the wire (compressed) and raw.
+
+    The transports report their bytes through `count_sent()` and
+    `count_received()`, which only cost a thread-local lookup when no
+    call of this thread is being counted.
+"""
+
+import math
+import threading
+import time
+
+_local = threading.local()
+
+def count_sent(raw, wire=None):
+    """ Count the bytes of a request body, raw and as sent (compressed)
+    """
+    counters = getattr(_local, 'counters', None)
+    if counters is not None:
+        counters[0] += raw
+        counters[1] += raw if wire is None else wire
+
+def count_received(raw, wire=None):
+    """ Count the bytes of a response body, raw and as received
+    """
+    counters = getattr(_local, 'counters', None)
+    if counters is not None:
+        counters[2] += raw
+        counters[3] += raw if wire is None else wire
+
+# latency buckets grow by 2^(1/4), from 0.1msec up to about 100sec
+_BUCKET_BASE = 0.0001
+_BUCKET_RATIO = math.log(2.0) / 4
+_NUM_BUCKETS = 81
+
+def _bucket(seconds):
+    if seconds <= _BUCKET_BASE:
+        return 0
+    return min(int(math.log(seconds / _BUCKET_BASE) / _BUCKET_RATIO) + 1, _NUM_BUCKETS - 1)
+
+def _bucket_limit(idx):
+    """ The upper limit of bucket `idx`, in seconds
+    """
+    return _BUCKET_BASE * math.exp(idx * _BUCKET_RATIO)
+
+class _KeyStats(object):
+    __slots__ = ('count', 'errors', 'total_time', 'max_time', 'buckets',
+                'sent', 'sent_wire', 'received', 'received_wire')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.buckets = [0] * _NUM_BUCKETS
+        self.sent = self.sent_wire = self.received = self.received_wire = 0
+
+    def percentile(self, pct):
+        """ The latency under which `pct` % of the calls are, approximately
+        """
+        limit = self.count * pct / 100.0
+        seen = 0
+        for idx, num in enumerate(self.buckets):
+            seen += num
+            if seen >= limit and num:
+                return min(_bucket_limit(idx), self.max_time)
+        return self.max_time
+
+class CallStats(object):
+    """ Counters of calls, per (protocol, path or model, method)
+    """
+    percentiles = (50, 95, 99)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = {}
+        self.since = time.time()
+
+    def begin(self):
+        """ Start counting a call, in this thread
+
+            @return a token for `end()`
+        """
+        counters = [0, 0, 0, 0]
+        prev = getattr(_local, 'counters', None)
+        _local.counters = counters
+        return (time.time(), counters, prev)
+
+    def end(self, token, protocol, path, method, error=False):
+        """ Finish counting a call, started by `begin()`
+        """
+        t0, counters, prev = token
+        if getattr(_local, 'counters', None) is counters:
+            _local.counters = prev
+        dt = time.time() - t0
+        key = (protocol, path, method)
+        with self._lock:
+            ks = self._keys.get(key, None)
+            if ks is None:
+                ks = self._keys[key] = _KeyStats()
+            ks.count += 1
+            if error:
+                ks.errors += 1
+            ks.total_time += dt
+            if dt > ks.max_time:
+                ks.max_time = dt
+            ks.buckets[_bucket(dt)] += 1
+            ks.sent += counters[0]
+            ks.sent_wire += counters[1]
+            ks.received += counters[2]
+            ks.received_wire += counters[3]
+
+    def snapshot(self):
+        """ The counters, as a list of dicts, the most time-consuming first
+
+            Latencies are in seconds, the percentiles like 'p95' are
+            approximate, within 20%.
+        """
+        ret = []
+        with self._lock:
+            for (protocol, path, method), ks in self._keys.items():
+                d = {'protocol': protocol, 'path': path, 'method': method,
+                    'count': ks.count, 'errors': ks.errors,
+                    'total_time': ks.total_time, 'max_time': ks.max_time,
+                    'avg_time': ks.total_time / ks.count,
+                    'sent_bytes': ks.sent, 'sent_wire_bytes': ks.sent_wire,
+                    'received_bytes': ks.received, 'received_wire_bytes': ks.received_wire,
+                    }
+                for pct in self.percentiles:
+                    d['p%d' % pct] = ks.percentile(pct)
+                ret.append(d)
+        ret.sort(key=lambda d: d['total_time'], reverse=True)
+        return ret
+
+    def reset(self):
+        with self._lock:
+            self._keys = {}
+            self.since = time.time()
+
+#eof
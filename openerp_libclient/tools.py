@@ -59,5 +59,111 @@ def _to_decode(s):
 
 ustr = _to_unicode
 
+_containers = (list, tuple, dict)
+_scalars = frozenset([int, long, float, bool, type(None)])
+
+def _items(obj):
+    if isinstance(obj, dict):
+        return obj.iteritems()
+    return enumerate(obj)
+
+def _rebuild(obj, changes):
+    """ A copy of container `obj`, with the `changes` {key: value} applied
+    """
+    if isinstance(obj, dict):
+        ret = dict(obj)
+        ret.update(changes)
+        return ret
+    ret = list(obj)
+    for k, v in changes.iteritems():
+        ret[k] = v
+    if isinstance(obj, tuple):
+        return tuple(ret)
+    return ret
+
+def _is_flat(seq):
+    for x in seq:
+        if isinstance(x, _containers):
+            return False
+    return True
+
+def convert_strings(value, src_type, fn):
+    """ Apply `fn` to all `src_type` strings in nested lists, tuples, dicts
+
+        The containers that hold no such string are not copied, and the
+        `value` is never modified, so that this is safe for the caller's
+        data, ie. the arguments of an RPC call.
+        Works iteratively, so arbitrarily deep structures are fine.
+
+        @return the converted value, `value` itself if there was nothing
+            to convert
+    """
+    if isinstance(value, src_type):
+        return fn(value)
+    if not isinstance(value, _containers):
+        return value
+    scalars = _scalars
+    # frames of [container, iterator of items, current key, changes]
+    root = [None, iter([(0, value)]), None, {}]
+    stack = [root]
+    while stack:
+        frame = stack[-1]
+        changes = frame[3]
+        for key, val in frame[1]:
+            if type(val) in scalars:
+                continue
+            if isinstance(val, src_type):
+                changes[key] = fn(val)
+            elif isinstance(val, tuple) and _is_flat(val):
+                # the common (id, name) pair, convert it right away
+                for x in val:
+                    if isinstance(x, src_type):
+                        changes[key] = tuple([fn(x) if isinstance(x, src_type) else x for x in val])
+                        break
+            elif isinstance(val, _containers) and val:
+                frame[2] = key
+                stack.append([val, _items(val), None, {}])
+                break
+        else:
+            stack.pop()
+            if changes and stack:
+                parent = stack[-1]
+                parent[3][parent[2]] = _rebuild(frame[0], changes)
+    return root[3].get(0, value)
+
+def convert_strings_inplace(value, src_type, fn):
+    """ Apply `fn` to all `src_type` strings in nested lists, tuples, dicts
+
+        Like `convert_strings()`, but modifies the lists and dicts in place
+        (tuples are rebuilt, of course). Use this only for data that is
+        not shared, like a result that was just decoded.
+
+        @return the converted value
+    """
+    scalars = _scalars
+    holder = [value]
+    stack = [holder]
+    tuples = []
+    while stack:
+        cont = stack.pop()
+        for key, val in _items(cont):
+            if type(val) in scalars:
+                continue
+            if isinstance(val, src_type):
+                cont[key] = fn(val)
+            elif isinstance(val, (list, dict)):
+                if val:
+                    stack.append(val)
+            elif isinstance(val, tuple) and val:
+                if _is_flat(val):
+                    cont[key] = tuple([fn(x) if isinstance(x, src_type) else x for x in val])
+                    continue
+                val = cont[key] = list(val)
+                tuples.append((cont, key))
+                stack.append(val)
+    # the inner tuples are found after their containers, so fix them first
+    for cont, key in reversed(tuples):
+        cont[key] = tuple(cont[key])
+    return holder[0]
 
 # vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
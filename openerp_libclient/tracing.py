@@ -0,0 +1,234 @@
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    Copyright (c) 2015 P. Christeas <xrg@hellug.gr>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+#.apidoc title: tracing - Spans around RPC calls
+
+""" Hooks to trace the RPC calls of a session
+
+    Assign a `Tracer` to `Session.tracer`, and each `call()`, `call_orm()`,
+    `call_many()`, login and `SideChannel.request()` becomes a `Span`.
+    While a span is active in a thread, the transports mark its phases:
+
+        pool       waiting for a free connection
+        serialize  encoding the request
+        connect    opening a new TCP (or SSL) connection
+        send       sending the request
+        auth       the request is repeated for HTTP authentication, the
+                   phases before this one were the rejected attempt
+        wait       waiting for the server to respond
+        parse      reading and decoding the response
+
+    Over HTTP, the trace and span ids are sent in a `traceparent` header
+    (W3C Trace Context), so that the server can continue the trace.
+
+    Example::
+
+        class LogTracer(Tracer):
+            def on_end(self, span):
+                log.info("%s took %.3fs: %r", span.name, span.duration, span.phases)
+
+        session.tracer = LogTracer()
+        with session.tracer.span('import partners'):
+            # calls are traced as children of this span
+            ...
+
+    Without a tracer, the session pays one attribute check per call. The
+    session turns the hooks of a connection's transport on or off, when it
+    lends it (see `Connection.set_traced()`), so that untraced transports
+    do not even look for the current span.
+"""
+
+import random
+import threading
+import time
+
+_local = threading.local()
+
+def current_span():
+    """ The span active in this thread, or None
+    """
+    return getattr(_local, 'span', None)
+
+class Span(object):
+    """ A traced operation
+
+        `phases` is a list of (name, seconds) tuples, in the order they
+        happened. `error` holds the exception that ended the span, if any.
+    """
+    __slots__ = ('tracer', 'name', 'trace_id', 'span_id', 'parent_id', 'attrs',
+                'start', 'end', 'phases', 'error', '_phase', '_phase_start', '_prev')
+
+    def __init__(self, tracer, name, trace_id, parent_id, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.attrs = attrs
+        self.start = self._phase_start = time.time()
+        self.end = None
+        self.phases = []
+        self.error = None
+        self._phase = None
+        self._prev = None
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def phase(self, name):
+        """ Start phase `name`, ending the previous one
+        """
+        now = time.time()
+        if self._phase is not None:
+            self.phases.append((self._phase, now - self._phase_start))
+        self._phase = name
+        self._phase_start = now
+
+    def _finish(self, error):
+        self.phase(None)
+        self.end = self._phase_start
+        self.error = error
+
+    def traceparent(self):
+        """ The value of the W3C `traceparent` header for this span
+        """
+        return '00-%s-%s-01' % (self.trace_id, self.span_id)
+
+class Tracer(object):
+    """ Creates the spans, calls `on_start()` and `on_end()` for each one
+
+        Override these, or pass callables for them. They are called in the
+        thread of the call, so they should be quick.
+    """
+    inject_headers = True #: send the `traceparent` header over HTTP
+
+    def __init__(self, on_start=None, on_end=None, inject_headers=None):
+        if on_start is not None:
+            self.on_start = on_start
+        if on_end is not None:
+            self.on_end = on_end
+        if inject_headers is not None:
+            self.inject_headers = inject_headers
+
+    def on_start(self, span):
+        pass
+
+    def on_end(self, span):
+        pass
+
+    def start_span(self, name, attrs=None, parent=None, activate=True):
+        """ Begin a span, as a child of `parent` or the active span
+
+            @param parent a Span, or a `traceparent` string from elsewhere
+            @param activate make it the active span of this thread, until
+                `end_span()`
+        """
+        if parent is None:
+            parent = getattr(_local, 'span', None)
+        if parent is None:
+            trace_id = '%032x' % random.getrandbits(128)
+            parent_id = None
+        elif isinstance(parent, basestring):
+            trace_id, parent_id = parent.split('-')[1:3]
+        else:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+        span = Span(self, name, trace_id, parent_id, attrs or {})
+        self.on_start(span)
+        if activate:
+            activate_span(span)
+        return span
+
+    def end_span(self, span, error=None):
+        """ Finish the span, restore the one that was active before it
+        """
+        deactivate_span(span)
+        span._finish(error)
+        self.on_end(span)
+
+    def span(self, name, parent=None, **attrs):
+        """ Context manager, tracing the calls of its block under a span
+        """
+        return _SpanContext(self, name, attrs, parent)
+
+    def headers(self, span):
+        """ The HTTP headers to send for a request within `span`
+
+            @return a list of (name, value)
+        """
+        return [('traceparent', span.traceparent())]
+
+class _SpanContext(object):
+    def __init__(self, tracer, name, attrs, parent):
+        self._tracer = tracer
+        self._args = (name, attrs, parent)
+        self.span = None
+
+    def __enter__(self):
+        self.span = self._tracer.start_span(*self._args)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._tracer.end_span(self.span, exc_value)
+
+def activate_span(span):
+    """ Make `span` the active one of this thread
+    """
+    span._prev = getattr(_local, 'span', None)
+    _local.span = span
+
+def deactivate_span(span):
+    """ Restore the span that was active before `span`, if still active
+    """
+    if getattr(_local, 'span', None) is span:
+        _local.span = span._prev
+
+def call_in_span(span, fn, *args, **kwargs):
+    """ Call `fn` with `span` active, like in the thread that started it
+
+        For work handed to another thread: the calls of `fn` are traced as
+        children of `span`. Unlike `activate_span()`, this leaves `span`
+        untouched, so that many threads can share it.
+    """
+    if span is None:
+        return fn(*args, **kwargs)
+    prev = getattr(_local, 'span', None)
+    _local.span = span
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _local.span = prev
+
+class RecordingTracer(Tracer):
+    """ Keeps the last `max_spans` finished spans, for inspection
+    """
+    def __init__(self, max_spans=1000, **kwargs):
+        super(RecordingTracer, self).__init__(**kwargs)
+        self.max_spans = max_spans
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def on_end(self, span):
+        with self._lock:
+            self.spans.append(span)
+            if len(self.spans) > self.max_spans:
+                del self.spans[:-self.max_spans]
+
+#eof
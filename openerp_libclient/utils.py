@@ -29,36 +29,145 @@
 #
 ##############################################################################
 
-from threading import Condition
+from threading import Condition, Event, Lock, Thread
+from collections import deque
+from itertools import count
+import heapq
+import logging
 import time
 
 #.apidoc title: utils - Utility classes
 
+class _Discard(Exception):
+    """ Internal: a free resource has failed its check
+    """
+    pass
+
+class _PoolWaiter(object):
+    """ A caller blocked in `Pool.borrow()`, in FIFO mode
+
+        It has its own condition (over the lock of the pool), so that
+        it can be woken alone.
+        The condition is waited for without a timeout, because a timed
+        `wait()` would poll with sleeps of up to 50msec. Timeouts are
+        rather enforced by the `_WaitTimer` of the pool.
+    """
+    __slots__ = ('cond', 'kind', 'seq', 'priority', 'res', 'retry', 'timed_out')
+
+    def __init__(self, mutex, kind, seq, priority):
+        self.cond = Condition(mutex)
+        self.kind = kind
+        self.seq = seq
+        self.priority = priority
+        self.res = None #: resource handed-off to this waiter
+        self.retry = False #: set when the waiter shall try again
+        self.timed_out = False
+
+    def pending(self):
+        return self.res is None and not (self.retry or self.timed_out)
+
+    def sort_key(self):
+        """ Waiters are served by higher priority, then older first
+        """
+        return (-self.priority, self.seq)
+
+class _WaitTimer(Thread):
+    """ Helper thread, that wakes the FIFO waiters of a pool at their deadline
+
+        It only lives while there are waiters with a deadline. It sleeps
+        until the earliest one, unless `wake()` tells it that an earlier
+        deadline has come.
+    """
+
+    def __init__(self, expire_fn):
+        Thread.__init__(self, name='Pool wait timer')
+        self.daemon = True
+        self._expire_fn = expire_fn
+        self._wake = Event()
+
+    def wake(self):
+        """ Look at the deadlines again, now
+        """
+        self._wake.set()
+
+    def run(self):
+        while True:
+            # cleared before looking, so that no wake() is missed
+            self._wake.clear()
+            next_t = self._expire_fn()
+            if next_t is None:
+                break
+            self._wake.wait(max(0.001, next_t - time.time()))
+
 class Pool(object):
     """ A pool of resources, which can be requested one at-a-time
 
         Since v0.3 the pool holds timestamps of *free* resources, so that
         they can easily be discarded.
 
+        Since v0.9 the pool is indexed: free resources are kept in one deque
+        per "kind", ordered by the time they were freed, used ones in a dict
+        and the number of used resources per kind is maintained, rather than
+        counted. So, `borrow()`, `free()` and `push_used()` do not need to
+        scan the lists any more.
+
         Usage with indexed resources
         ----------------------------
 
-        If `filter_fn`, `setter_fn` and optionally `limit` are set, then
-        the resource pool may resemble a dictionary, where any arbitrary
-        condition on the resource can group them together.
-
-        `filter_fn` will be used to only return a specific "kind" of res.
-        upon a call to `borrow()`
+        If `key_fn`, `setter_fn` and optionally `limit` are set, then
+        the resource pool may resemble a dictionary, where resources are
+        grouped by the "kind" that `key_fn` computes from the arguments
+        of `borrow()`.
 
         `setter_fn` will be used to set that "kind" on a new resource, after
         a call to iter_constr.next()
 
-        `limit` may help to limit the number of available resources, 
-        per "kind". However, if `limit` is used without `filter_fn()`, then
-        the limit will be a Pool-wide one.
+        `limit` may help to limit the number of available resources,
+        per "kind". However, if `limit` is used without `key_fn` or
+        `filter_fn`, then the limit will be a Pool-wide one.
+
+        The older `filter_fn` can still be used for an arbitrary condition
+        on the resources, but then the pool has to scan its free ones (and
+        used ones, for the limit) at each `borrow()`, like before.
+
+        FIFO mode
+        ---------
+
+        By default, a `free()` wakes all the callers that are blocked in
+        `borrow()`, which then compete for the resource. With `fifo=True`,
+        blocked callers are queued and a freed resource is handed directly
+        to the oldest waiter of its kind. When a resource is discarded
+        instead, the oldest waiter is woken to try constructing a new one.
+        See `wait_stats()` for the time callers spend blocked.
+
+        Closing resources
+        -----------------
+
+        When a `close_fn` is given, it is called on every resource that the
+        pool drops: the ones that expire, fail the `check_fn`, are trimmed or
+        cleared, so that they don't wait for the garbage collector.
+        Resources that are in use when cleared, or when they reach their
+        `max_age`, are closed as soon as they are freed.
+
+        Priorities
+        ----------
+
+        `borrow()` may be called with a `priority` (integer, higher is
+        more urgent). In FIFO mode, waiters are served by priority and then
+        in order. `set_reserve()` can also keep some resources for the
+        callers of a minimum priority, in both modes.
+
+        Telemetry
+        ---------
+
+        `stats()` tells how the pool is used: how many resources have
+        been constructed or reused, dropped for each reason, the high-water
+        mark and the average of the used ones, and the time callers spend
+        blocked in `borrow()`.
     """
 
-    def __init__(self, iter_constr, check_fn=None, filter_fn=None, setter_fn=None, limit=False):
+    def __init__(self, iter_constr, check_fn=None, filter_fn=None, setter_fn=None,
+                limit=False, key_fn=None, fifo=False, close_fn=None, max_age=None):
         """ Init the pool
 
             @param iter_constr is an iterable, that can construct a new
@@ -70,179 +179,767 @@ class Pool(object):
             @param filter_fn If set, a callable that will be called like:
                 `filter_fn(resource,**kwargs)` , where `kwargs` are the ones
                 supplied to `borrow()` and used to select /valid/ resources
-                for that `borrow()` call. See. `Usage with indexed resources`
-            @param setter_fn Strongly advised to use together with `filter_fn`,
+                for that `borrow()` call. Slow, prefer `key_fn`.
+            @param setter_fn Strongly advised to use together with `key_fn`,
                 in order to initialize new resource with our index.
                 Also called like: `setter_fn(resource, **kwargs)` in borrow
             @param limit If set, a positive integer of max resources that can
                 be allowed in "used" list, before call to `borrow()` will fail.
-                `limit` does use the `filter_fn`, if the latter is set, to
-                apply the limitation only to similar resources.
+                `limit` does use the `key_fn` (or `filter_fn`), if the latter
+                is set, to apply the limitation only to similar resources.
+            @param key_fn If set, a callable like `key_fn(**kwargs)`, which
+                shall return a hashable "kind" for the `kwargs` of `borrow()`.
+                See. `Usage with indexed resources`
+            @param fifo Serve blocked callers in order, handing freed
+                resources directly to them. See `FIFO mode`
+            @param close_fn A callable, `close_fn(res)`, to release the
+                resources that are dropped from the pool
+            @param max_age If set, seconds since their creation, after which
+                resources are dropped by `expire()`, even if they are used.
+                It is read at each `expire()`, so it may be changed later
         """
-        self.__free_ones = [] #: list of (resource, time) tuples
-        self.__used_ones = []
-        self.__lock = Condition()
+        assert not (fifo and filter_fn and not key_fn), \
+                "FIFO mode cannot work with filter_fn, please use key_fn"
+        self.__free_ones = {} #: kind: deque of (resource, time) tuples
+        self.__used_ones = {} #: resource: kind
+        self.__used_count = {} #: kind: number of used resources
+        self.__kinds = {} #: resource: kind, for all resources we know
+        self.__doomed = set() #: used resources, to be closed when freed
+        self.__births = {} #: resource: (creation time, seq), for `max_age`
+        self.__birth_heap = [] #: heap of (creation time, seq, resource)
+        self.__birth_seq = count()
+        self.__waiters = {} #: kind: heap of (sort_key, _PoolWaiter), in fifo mode
+        self.__waiter_seq = count()
+        self.__deadlines = [] #: heap of (deadline, seq, waiter)
+        self.__wait_timer = None
+        # not an RLock, which is much slower in python 2, and not needed
+        self.__mutex = Lock()
+        self.__lock = Condition(self.__mutex)
         self.__iterc = iter_constr
         assert self.__iterc
         self.__check_fn = check_fn
+        self.__close_fn = close_fn
+        self.max_age = max_age
+        self._log = logging.getLogger('RPC.Pool')
         self._filter_fn = filter_fn
         self._setter_fn = setter_fn
+        self._key_fn = key_fn
         self._limit = limit
+        self._fifo = fifo
+        self._reserved = 0
+        self._reserve_priority = 0
+        self._reserve_capacity = limit
+        self.__wstats = {'waits': 0, 'wait_time': 0.0, 'max_wait': 0.0,
+                'timeouts': 0, 'handoffs': 0 }
+        self.__reset_counters()
 
-    def borrow(self, blocking=False, **kwargs):
-        """Return the next free member of the pool
+    def __reset_counters(self):
+        self.__counters = dict.fromkeys(['constructed', 'reused', 'pushed', 'discarded',
+                'expired', 'aged', 'trimmed', 'cleared'], 0)
+        self.__high_water = len(self.__used_ones)
+        self.__since = self.__used_since = time.time()
+        self.__used_time = 0.0 #: integral of the number of used ones, over time
+
+    def __used_changing(self):
+        """ Account for the time spent at the current number of used ones
+
+            Call with the lock acquired, before that number changes
         """
-        self.__lock.acquire()
-        t2 = 0.0
-        while(True):
-            ret = None
-            idx = len(self.__free_ones)
-            while (idx > 0):
-                idx -= 1
-                if self._filter_fn:
-                    # Wrap around try block, because we want to test with the
-                    # lock acquired(), but must release on exception
-                    try:
-                        if not self._filter_fn(self.__free_ones[idx][0], **kwargs):
-                            continue
-                    except:
-                        self.__lock.release()
-                        raise
-                ret, tstamp = self.__free_ones.pop(idx)
-                if self.__check_fn is not None:
-                    self.__lock.release()
-                    if not self.__check_fn(ret):
-                        ret = None
-                    # An exception will also propagate from here,
-                    # with the lock released
-                    self.__lock.acquire()
-                if ret is None:
-                    continue # the while loop. Ret is at no list any more
-                self.__used_ones.append(ret)
-                self.__lock.release()
+        now = time.time()
+        self.__used_time += len(self.__used_ones) * (now - self.__used_since)
+        self.__used_since = now
+
+    def __get_kind(self, kwargs):
+        if self._key_fn is not None:
+            return self._key_fn(**kwargs)
+        return None
+
+    def __pop_free(self, kind, kwargs):
+        """ Pop the most recently freed resource of `kind`
+
+            Must be called with the lock acquired. May raise from `filter_fn`
+        """
+        frees = self.__free_ones.get(kind)
+        if not frees:
+            return None
+        if self._filter_fn is None or self._key_fn is not None:
+            return frees.pop()[0]
+        idx = len(frees)
+        while idx > 0:
+            idx -= 1
+            if self._filter_fn(frees[idx][0], **kwargs):
+                ret = frees[idx][0]
+                del frees[idx]
                 return ret
+        return None
 
+    def __count_used(self, kind, kwargs):
+        """ Number of used resources, that count against `limit`
+        """
+        if self._key_fn is None and self._filter_fn is not None:
             count = 0
-            # Before constructing a new one, count the limit
+            for res in self.__used_ones:
+                if self._filter_fn(res, **kwargs):
+                    count += 1
+            return count
+        return self.__used_count.get(kind, 0)
+
+    def __add_used(self, res, kind):
+        self.__used_changing()
+        self.__used_ones[res] = kind
+        self.__used_count[kind] = self.__used_count.get(kind, 0) + 1
+        if len(self.__used_ones) > self.__high_water:
+            self.__high_water = len(self.__used_ones)
+        if res not in self.__kinds:
+            self.__register(res, kind)
+
+    def __register(self, res, kind):
+        """ Index a new resource, lock acquired
+        """
+        self.__kinds[res] = kind
+        # always, since `max_age` may be set later
+        born = (time.time(), self.__birth_seq.next())
+        self.__births[res] = born
+        heap = self.__birth_heap
+        heapq.heappush(heap, born + (res,))
+        if len(heap) > 2 * len(self.__births) + 32:
+            # without `max_age`, the entries of forgotten ones pile up
+            births = self.__births
+            heap[:] = [e for e in heap if births.get(e[2]) == e[:2]]
+            heapq.heapify(heap)
+
+    def __forget(self, res):
+        """ Remove a (popped) resource from the index, lock acquired
+        """
+        self.__kinds.pop(res, None)
+        self.__births.pop(res, None)
+
+    def __close(self, victims):
+        """ Close the resources dropped from the pool
+
+            Must be called with the lock released
+        """
+        if self.__close_fn is None:
+            return
+        for res in victims:
             try:
-                if self._limit:
-                    for res in self.__used_ones:
-                        if self._filter_fn and not self._filter_fn(res, **kwargs):
-                            continue
-                        count += 1
+                self.__close_fn(res)
+            except Exception:
+                self._log.debug("Could not close %r:", res, exc_info=True)
+
+    def __reserve_allows(self, priority):
+        """ Tell if a caller of `priority` may use one more resource
+
+            Must be called with the lock acquired
+        """
+        if (not self._reserved) or priority >= self._reserve_priority:
+            return True
+        return len(self.__used_ones) + self._reserved < self._reserve_capacity
+
+    def __take_free(self, kind, kwargs, priority=0):
+        """ Take a free resource of `kind` and mark it as used
+
+            Must be called, and will return, with the lock acquired.
+            @return the resource or None, if no (valid) free one exists
+        """
+        indexed = self._filter_fn is None or self._key_fn is not None
+        while (not self._reserved) or self.__reserve_allows(priority):
+            ret = None
+            try:
+                if indexed:
+                    # the common case, inline
+                    frees = self.__free_ones.get(kind)
+                    if not frees:
+                        return None
+                    ret = frees.pop()[0]
+                else:
+                    ret = self.__pop_free(kind, kwargs)
+                    if ret is None:
+                        return None
+                if self.__check_fn is not None:
+                    self.__lock.release()
+                    try:
+                        if not self.__check_fn(ret):
+                            self.__close([ret])
+                            raise _Discard()
+                    finally:
+                        # An exception will also propagate from here,
+                        # with the lock acquired, again
+                        self.__lock.acquire()
+            except _Discard:
+                self.__forget(ret)
+                self.__counters['discarded'] += 1
+                continue # the while loop. Ret is at no list any more
             except:
-                self.__lock.release()
+                if ret is not None:
+                    self.__forget(ret)
                 raise
+            # like __add_used(), for a resource that is registered already
+            now = time.time()
+            used = self.__used_ones
+            self.__used_time += len(used) * (now - self.__used_since)
+            self.__used_since = now
+            used[ret] = kind
+            self.__used_count[kind] = self.__used_count.get(kind, 0) + 1
+            if len(used) > self.__high_water:
+                self.__high_water = len(used)
+            self.__counters['reused'] += 1
+            return ret
+        return None
 
-            # no free one, try to construct a new one
-            try:
-                self.__lock.release()
-                if self._limit and (count >= self._limit):
-                    raise StopIteration()
+    def __construct(self, kind, kwargs, priority=0):
+        """ Construct a new resource, if the `limit` allows
 
-                ret = self.__iterc.next()
-                if ret is not None and self._setter_fn:
-                    self._setter_fn(ret, **kwargs)
+            Must be called, and will return, with the lock acquired, but
+            releases it while the iterator works.
+            @return the resource or None, if the iterator cannot provide one
+                now, or raise StopIteration when the limit is reached
+        """
+        if self._limit and (self.__count_used(kind, kwargs) >= self._limit):
+            raise StopIteration()
+        if not self.__reserve_allows(priority):
+            raise StopIteration()
 
-                # the iterator may temporarily return None, which
-                # means we should wait and retry the operation.
-                self.__lock.acquire()
+        self.__lock.release()
+        try:
+            ret = self.__iterc.next()
+            if ret is not None and self._setter_fn:
+                self._setter_fn(ret, **kwargs)
+        finally:
+            self.__lock.acquire()
+
+        # the iterator may temporarily return None, which
+        # means we should wait and retry the operation.
+        if ret is not None:
+            self.__add_used(ret, kind)
+            self.__counters['constructed'] += 1
+        return ret
+
+    def __record_wait(self, t1):
+        """ Account for a caller that has been blocked since `t1`
+        """
+        dt = time.time() - t1
+        self.__wstats['waits'] += 1
+        self.__wstats['wait_time'] += dt
+        if dt > self.__wstats['max_wait']:
+            self.__wstats['max_wait'] = dt
+
+    def borrow(self, blocking=False, priority=0, **kwargs):
+        """Return the next free member of the pool
+
+            @param blocking if False, raise ValueError when no resource is
+                available. Otherwise, the number of seconds to wait for one.
+            @param priority of the caller, see `Priorities`
+        """
+        if self._fifo:
+            return self.__borrow_fifo(blocking, priority, kwargs)
+        self.__lock.acquire()
+        t0 = None
+        t2 = 0.0
+        try:
+            if self._key_fn is None:
+                kind = None
+            else:
+                kind = self._key_fn(**kwargs)
+            while(True):
+                ret = self.__take_free(kind, kwargs, priority)
                 if ret is not None:
-                    self.__used_ones.append(ret)
-                    self.__lock.release()
                     return ret
-            except StopIteration:
+
+                # no free one, try to construct a new one
+                try:
+                    ret = self.__construct(kind, kwargs, priority)
+                    if ret is not None:
+                        return ret
+                except StopIteration:
+                    if not blocking:
+                        raise ValueError("No free resource")
+                    # else pass
+
+                if isinstance(blocking, (int, float)):
+                    twait = blocking - t2
+                else:
+                    twait = None
+                if (not twait) and not self.__free_ones.get(kind):
+                    twait = 10.0 # must continue cycle at some point!
+                t1 = 0.0
+                if twait > 0.0:
+                    t1 = time.time()
+                    if t0 is None:
+                        t0 = t1
+                    self.__lock.wait(twait) # As condition
+                    t1 = time.time() - t1
+                if ((twait - t2) < 0) and not self.__free_ones.get(kind):
+                    self.__wstats['timeouts'] += 1
+                    raise ValueError("Timed out waiting for a free resource")
+                t2 += t1
+        finally:
+            if t0 is not None:
+                self.__record_wait(t0)
+            self.__lock.release()
+
+        raise RuntimeError("Should never reach here")
+
+    def __borrow_fifo(self, blocking, priority, kwargs):
+        """ Variant of `borrow()` that queues the callers, see `FIFO mode`
+        """
+        self.__lock.acquire()
+        t0 = None
+        try:
+            if self._key_fn is None:
+                kind = None
+            else:
+                kind = self._key_fn(**kwargs)
+            if isinstance(blocking, (int, float)) and not isinstance(blocking, bool):
+                deadline = time.time() + blocking
+            else:
+                deadline = None
+            head = False # been woken to retry, as the first waiter
+            seq = None
+            while True:
+                # Don't overtake the callers that already wait for this kind,
+                # unless we are more urgent than all of them
+                waiters = self.__waiters.get(kind)
+                if head or not waiters or waiters[0][1].priority < priority:
+                    ret = self.__take_free(kind, kwargs, priority)
+                    if ret is not None:
+                        break
+                    try:
+                        ret = self.__construct(kind, kwargs, priority)
+                        if ret is not None:
+                            break
+                    except StopIteration:
+                        pass
                 if not blocking:
                     raise ValueError("No free resource")
-                # else pass
-                self.__lock.acquire()
 
-            idx = len(self.__free_ones) # reset counter, scan all of them after waiting
-            if isinstance(blocking, (int, float)):
-                twait = blocking - t2
-            else:
-                twait = None
-            if (not twait) and not len(self.__free_ones):
-                twait = 10.0 # must continue cycle at some point!
-            if twait > 0.0:
-                t1 = time.time()
-                self.__lock.wait(twait) # As condition
-                t1 = time.time() - t1
-            if ((twait - t2) < 0) and not len(self.__free_ones):
-                self.__lock.release()
-                raise ValueError("Timed out waiting for a free resource")
-            t2 += t1
-            continue
+                if t0 is None:
+                    t0 = time.time()
+                    seq = self.__waiter_seq.next()
+                if deadline is not None and deadline <= time.time():
+                    self.__wstats['timeouts'] += 1
+                    raise ValueError("Timed out waiting for a free resource")
+                # A retrying waiter keeps its `seq`, thus its place in the queue
+                waiter = _PoolWaiter(self.__mutex, kind, seq, priority)
+                heapq.heappush(self.__waiters.setdefault(kind, []),
+                                (waiter.sort_key(), waiter))
+                if deadline is not None:
+                    heapq.heappush(self.__deadlines, (deadline, seq, waiter))
+                    if self.__wait_timer is None:
+                        self.__wait_timer = _WaitTimer(self.__expire_waiters)
+                        self.__wait_timer.start()
+                    elif self.__deadlines[0][2] is waiter:
+                        # ahead of the one the timer sleeps for
+                        self.__wait_timer.wake()
+                while waiter.pending():
+                    waiter.cond.wait()
 
-        raise RuntimeError("Should never reach here")
+                if waiter.res is not None:
+                    return waiter.res # already marked as used for us
+                elif waiter.timed_out:
+                    # already removed from the queue
+                    self.__wstats['timeouts'] += 1
+                    raise ValueError("Timed out waiting for a free resource")
+                # else, the waiter has been popped, try again
+                head = True
+
+            return ret
+        finally:
+            if t0 is not None:
+                self.__record_wait(t0)
+            self.__lock.release()
+
+    def __expire_waiters(self):
+        """ Wake the waiters whose deadline has passed
+
+            Called by the `_WaitTimer` thread
+            @return the next deadline, or None when the timer can stop
+        """
+        self.__lock.acquire()
+        try:
+            now = time.time()
+            deadlines = self.__deadlines
+            while deadlines and (deadlines[0][0] <= now or not deadlines[0][2].pending()):
+                waiter = heapq.heappop(deadlines)[2]
+                if not waiter.pending():
+                    continue
+                waiters = self.__waiters[waiter.kind]
+                waiters.remove((waiter.sort_key(), waiter))
+                if waiters:
+                    heapq.heapify(waiters)
+                else:
+                    del self.__waiters[waiter.kind]
+                waiter.timed_out = True
+                waiter.cond.notify()
+            if not deadlines:
+                self.__wait_timer = None
+                return None
+            return deadlines[0][0]
+        finally:
+            self.__lock.release()
+
+    def __pop_waiter(self, kind):
+        """ Pop the first waiter for `kind`, if any. Lock acquired
+
+            The waiter will not be returned if the reservation does not
+            allow it to use one more resource
+        """
+        waiters = self.__waiters.get(kind)
+        if not waiters:
+            return None
+        if not self.__reserve_allows(waiters[0][1].priority):
+            return None
+        waiter = heapq.heappop(waiters)[1]
+        if not waiters:
+            del self.__waiters[kind]
+        return waiter
+
+    def __signal_retry(self, count=None):
+        """ Wake the first `count` waiters (of any kind), to try again
+
+            Used when some resources have been discarded, so that new
+            ones may be constructed. Lock must be acquired
+        """
+        while self.__waiters and (count is None or count > 0):
+            first = min([w[0] for w in self.__waiters.values()])[1]
+            waiter = heapq.heappop(self.__waiters[first.kind])[1]
+            if not self.__waiters[first.kind]:
+                del self.__waiters[first.kind]
+            waiter.retry = True
+            waiter.cond.notify()
+            if count is not None:
+                count -= 1
 
     def free(self, res):
         self.__lock.acquire()
+        # like __used_changing(), inline
+        now = time.time()
+        used = self.__used_ones
+        self.__used_time += len(used) * (now - self.__used_since)
+        self.__used_since = now
         try:
-            self.__used_ones.remove(res)
-        except ValueError:
+            kind = used.pop(res)
+        except KeyError:
+            if res in self.__doomed:
+                # cleared while it was used
+                self.__doomed.discard(res)
+                self.__lock.release()
+                self.__close([res])
+                return
             self.__lock.release()
             raise RuntimeError("Strange, freed pool item that was not in the list")
+        self.__used_count[kind] -= 1
+        if res in self.__doomed:
+            self.__doomed.discard(res)
+            self.__discarded(res)
+            self.__lock.release()
+            self.__close([res])
+            return
         if self.__check_fn is not None:
             self.__lock.release()
-            if not self.__check_fn(res):
-                res = None
-                # not append to free ones, but issue notification
-            # An exception will also propagate from here,
-            # with the lock released
+            try:
+                good = self.__check_fn(res)
+            except:
+                # An exception will also propagate from here,
+                # with the lock released
+                self.__lock.acquire()
+                self.__discarded(res)
+                self.__counters['discarded'] += 1
+                self.__lock.release()
+                self.__close([res])
+                raise
             self.__lock.acquire()
-        if res is not None:
-            self.__free_ones.append((res, time.time()))
-        self.__lock.notify_all()
-        self.__lock.release()
+            if not good:
+                # not append to free ones, but issue notification
+                self.__discarded(res)
+                self.__counters['discarded'] += 1
+                self.__lock.release()
+                self.__close([res])
+                return
+        try:
+            self.__release(res, kind)
+        finally:
+            self.__lock.release()
+
+    def __release(self, res, kind):
+        """ Make `res` available: give it to a waiter or put to free ones
+
+            Must be called with the lock acquired
+        """
+        if self._fifo:
+            waiter = self.__pop_waiter(kind)
+            if waiter is not None:
+                self.__add_used(res, kind)
+                waiter.res = res
+                self.__wstats['handoffs'] += 1
+                self.__counters['reused'] += 1
+                waiter.cond.notify()
+                return
+        frees = self.__free_ones.get(kind)
+        if frees is None:
+            frees = self.__free_ones[kind] = deque()
+        frees.append((res, time.time()))
+        if not self._fifo:
+            self.__lock.notify_all()
+
+    def __discarded(self, res):
+        """ Forget `res`, which had been used, and let someone replace it
+        """
+        self.__forget(res)
+        if self._fifo:
+            self.__signal_retry(1)
+        else:
+            self.__lock.notify_all()
 
-    def push_used(self, res):
+    def push_used(self, res, **kwargs):
         """ Register a foreign resource as a used one, in the pool.
+
+            @param kwargs like the ones of `borrow()`, will determine the
+                kind of `res` if `key_fn` is used
         """
         self.__lock.acquire()
-        if (res in self.__used_ones):
+        try:
+            if res in self.__kinds:
+                raise RuntimeError("Resource already in pool")
+            self.__add_used(res, self.__get_kind(kwargs))
+            self.__counters['pushed'] += 1
+        finally:
             self.__lock.release()
-            raise RuntimeError("Resource already in pool")
-        for r, t in self.__free_ones:
-            if res == r:
-                self.__lock.release()
+
+    def push_free(self, res, **kwargs):
+        """ Register a foreign resource as a free one, in the pool.
+
+            Like `push_used()` and `free()` at once, without `check_fn`
+        """
+        self.__lock.acquire()
+        try:
+            if res in self.__kinds:
                 raise RuntimeError("Resource already in pool")
-        self.__used_ones.append(res)
-        self.__lock.release()
+            kind = self.__get_kind(kwargs)
+            self.__register(res, kind)
+            self.__counters['pushed'] += 1
+            self.__release(res, kind)
+        finally:
+            self.__lock.release()
+
+    def trim(self, max_free):
+        """ Forget the oldest free resources, so that `max_free` remain
+
+            @return the number of resources removed
+        """
+        victims = []
+        self.__lock.acquire()
+        try:
+            excess = self.count_free() - max_free
+            while excess > 0:
+                oldest = None
+                for kind, frees in self.__free_ones.items():
+                    if frees and (oldest is None or frees[0][1] < self.__free_ones[oldest][0][1]):
+                        oldest = kind
+                res = self.__free_ones[oldest].popleft()[0]
+                self.__forget(res)
+                victims.append(res)
+                if not self.__free_ones[oldest]:
+                    del self.__free_ones[oldest]
+                excess -= 1
+            self.__counters['trimmed'] += len(victims)
+        finally:
+            self.__lock.release()
+        self.__close(victims)
+        return len(victims)
+
+    def set_reserve(self, count, min_priority, capacity=None):
+        """ Reserve `count` resources for callers of `min_priority` or higher
+
+            Callers of a lower priority will only be given a resource while
+            at least `count` ones remain below `capacity`.
+            @param capacity the total number of resources, default is the
+                `limit` of the pool
+        """
+        capacity = capacity or self._limit
+        if count and not capacity:
+            raise ValueError("Cannot reserve resources without a capacity")
+        self.__lock.acquire()
+        try:
+            self._reserved = count
+            self._reserve_priority = min_priority
+            self._reserve_capacity = capacity
+            # with a new reservation, some waiter may be served now
+            if self._fifo:
+                if self.__waiters:
+                    self.__signal_retry(1)
+            else:
+                self.__lock.notify_all()
+        finally:
+            self.__lock.release()
+
+    def resources(self):
+        """ A list of all the resources of the pool, free and used
+        """
+        self.__lock.acquire()
+        try:
+            return self.__kinds.keys()
+        finally:
+            self.__lock.release()
 
     def __len__(self):
-        return len(self.__free_ones) + len(self.__used_ones)
+        return len(self.__kinds)
 
     def __nonzero__(self):
         return True
 
     def count_free(self):
-        return len(self.__free_ones)
+        return len(self.__kinds) - len(self.__used_ones)
+
+    def wait_stats(self):
+        """ Statistics about the callers blocked in `borrow()`
+
+            @return a dict with `waits` (number of callers that had to
+                block), `wait_time`, `max_wait` and `avg_wait` in seconds,
+                `timeouts`, `handoffs` (resources passed directly to a
+                waiter, in FIFO mode) and `waiting` (callers blocked now)
+        """
+        self.__lock.acquire()
+        try:
+            ret = self.__wstats.copy()
+            ret['avg_wait'] = ret['waits'] and (ret['wait_time'] / ret['waits'])
+            ret['waiting'] = sum(map(len, self.__waiters.values()))
+            return ret
+        finally:
+            self.__lock.release()
+
+    def stats(self):
+        """ Counters and gauges of the pool, see `Telemetry`
+
+            @return a dict with the `wait_stats()`, and:
+                `constructed`, `reused` (borrowed from the free ones, or
+                handed off), `pushed` (by `push_used()`, `push_free()`),
+                `discarded` (by `check_fn`), `expired` (idle), `aged` (by
+                `max_age`), `trimmed`, `cleared`: counts of resources;
+                `used`, `free`: the resources now; `high_water`: the most
+                used at once; `avg_used`: the average number of used ones;
+                `period`: seconds these have been counted, since the pool
+                was created or `reset_stats()`
+        """
+        ret = self.wait_stats()
+        self.__lock.acquire()
+        try:
+            self.__used_changing()
+            ret.update(self.__counters)
+            ret['used'] = len(self.__used_ones)
+            ret['free'] = len(self.__kinds) - len(self.__used_ones)
+            ret['high_water'] = self.__high_water
+            ret['period'] = time.time() - self.__since
+            ret['avg_used'] = ret['period'] and (self.__used_time / ret['period'])
+        finally:
+            self.__lock.release()
+        return ret
+
+    def reset_stats(self):
+        """ Zero the counters of `stats()` and `wait_stats()`
+        """
+        self.__lock.acquire()
+        try:
+            for k in self.__wstats:
+                self.__wstats[k] = 0
+            self.__wstats['wait_time'] = self.__wstats['max_wait'] = 0.0
+            self.__reset_counters()
+        finally:
+            self.__lock.release()
 
     def clear(self):
         """ Forgets about all resources.
         Warning: if you ever use this function, you must make sure that
         the iterable will catch up and restart iteration with more resources
+
+        The free resources are closed now, the used ones when they are
+        freed.
         """
         self.__lock.acquire()
-        self.__free_ones = []
-        self.__used_ones = []
+        self.__used_changing()
+        victims = [res for frees in self.__free_ones.values() for res, t in frees]
+        self.__counters['cleared'] += len(victims) + len(self.__used_ones)
+        self.__doomed.update(self.__used_ones)
+        self.__free_ones = {}
+        self.__used_ones = {}
+        self.__used_count = {}
+        self.__kinds = {}
+        self.__births = {}
+        self.__birth_heap = []
+        if self._fifo:
+            self.__signal_retry()
         self.__lock.notify_all() # Let them retry
         self.__lock.release()
+        self.__close(victims)
 
-    def expire(self, age=30.0):
-        """Forgets (deletes) resources that are older than `age` seconds
+    def expire(self, age=30.0, max_age=None):
+        """Forgets (deletes) resources that are older than `age` seconds, if set
 
             The age of a resource is measured as the time this has been
             idle in the "free_ones" pool. It does not depend on the object
             creation time or so.
+
+            Since the free ones are kept in the order they have been freed,
+            and the creation times in a heap, only the expired (or aged)
+            ones need to be visited.
+
+            @param max_age If given (default is the `max_age` of the pool),
+                resources created earlier than that are also dropped. The
+                used ones will be closed when freed.
+            @return the number of free resources removed
         """
+        if max_age is None:
+            max_age = self.max_age
+        victims = []
         self.__lock.acquire()
         try:
-            if self.__free_ones:
+            if age:
                 alz = time.time() - age
-                self.__free_ones = filter(lambda rt: rt[1] > alz, self.__free_ones)
+                for kind, frees in self.__free_ones.items():
+                    while frees and frees[0][1] <= alz:
+                        res = frees.popleft()[0]
+                        self.__forget(res)
+                        victims.append(res)
+                    if not frees:
+                        del self.__free_ones[kind]
+                self.__counters['expired'] += len(victims)
+            if max_age:
+                victims += self.__expire_old(time.time() - max_age)
+            if victims and self._fifo:
+                self.__signal_retry(len(victims))
         finally:
             self.__lock.release()
+        self.__close(victims)
+        return len(victims)
+
+    def __expire_old(self, born_before):
+        """ Drop the resources created before `born_before`, lock acquired
+
+            @return the free ones, that have been removed
+        """
+        ret = []
+        heap = self.__birth_heap
+        births = self.__births
+        while heap and heap[0][0] <= born_before:
+            entry = heapq.heappop(heap)
+            res = entry[2]
+            if births.get(res) != entry[:2]:
+                continue # forgotten already, or registered again since
+            kind = self.__kinds[res]
+            del births[res] # once, even if it is used now
+            self.__counters['aged'] += 1
+            if res in self.__used_ones:
+                self.__doomed.add(res)
+                continue
+            frees = self.__free_ones[kind]
+            for i, (fres, t) in enumerate(frees):
+                if fres is res:
+                    del frees[i]
+                    break
+            if not frees:
+                del self.__free_ones[kind]
+            self.__forget(res)
+            ret.append(res)
+        return ret
 
 #eof
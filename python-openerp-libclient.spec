@@ -16,6 +16,8 @@ BuildArch:	noarch
 Group:		Libraries
 BuildRequires:	python
 %py_requires -d
+# for openerp_libclient.async_session only
+Suggests:	python-trollius
 
 %description
 This library allows client applications connect and work 
@@ -1,6 +1,12 @@
 #!/usr/bin/env python
 
-from distutils.core import setup
+try:
+    from setuptools import setup
+    extra_kwargs = {'extras_require': {'async': ['trollius']}}
+except ImportError:
+    # distutils does not know about extras
+    from distutils.core import setup
+    extra_kwargs = {}
 
 name = 'openerp_libclient'
 version = '0.8'
@@ -29,4 +35,5 @@ setup(
           'Topic :: Software Development :: Libraries :: Python Modules',
           'Topic :: System :: Filesystems',
           ],
+    **extra_kwargs
     )
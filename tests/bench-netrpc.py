@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+""" Benchmark of the Net-RPC framing and pickle protocols
+
+    Compares `protocol_netrpc.mysocket` against the framing it had before
+    v0.9, which built the message by string concatenation, over a local
+    server thread that answers every request with `size` MB of records.
+
+    Then, compares the payload size and round-trip time of pickle protocol
+    0 (the default) with protocol 2, for a few typical payloads that are
+    sent and echoed back by the server.
+"""
+import sys
+import os
+import time
+import socket
+import cPickle
+import gc
+import threading
+
+sys.path.insert(0, os.path.abspath('.'))
+from openerp_libclient.protocol_netrpc import mysocket
+
+MB = 1024 * 1024
+
+class legacy_socket(mysocket):
+    """ The send/receive loops of mysocket, before v0.9
+    """
+    def mysend(self, msg, exception=False, traceback=None):
+        msg = cPickle.dumps([msg,traceback], self.pickle_protocol)
+        size = len(msg)
+        self.sock.send('%8d' % size)
+        self.sock.send(exception and "1" or "0")
+        totalsent = 0
+        while totalsent < size:
+            sent = self.sock.send(msg[totalsent:])
+            if sent == 0:
+                raise RuntimeError, "socket connection broken"
+            totalsent = totalsent + sent
+
+    def myreceive(self):
+        buf=''
+        while len(buf) < 8:
+            chunk = self.sock.recv(8 - len(buf))
+            if not chunk:
+                raise RuntimeError, "socket connection broken"
+            buf += chunk
+        size = int(buf)
+        buf = self.sock.recv(1)
+        msg = ''
+        while len(msg) < size:
+            chunk = self.sock.recv(size-len(msg))
+            if not chunk :
+                raise RuntimeError, "socket connection broken"
+            msg = msg + chunk
+        return cPickle.loads(msg)[0]
+
+def make_records(size):
+    rec = {'id': 0, 'name': 'x' * 90}
+    return [dict(rec, id=n) for n in xrange(size / 100)]
+
+def serve(lsock, answers):
+    """ Answer requests of (key, [payload]), in the protocol of the request
+    """
+    while True:
+        conn, addr = lsock.accept()
+        s = mysocket(conn)
+        try:
+            while True:
+                s.pickle_protocol = 0
+                # peek at the protocol of the request, like a server would
+                head = conn.recv(11, socket.MSG_PEEK | socket.MSG_WAITALL)
+                if len(head) == 11 and head[9] == '\x80':
+                    s.pickle_protocol = ord(head[10])
+                req = s.myreceive()
+                if len(req) > 1:
+                    s.mysend(req[1])
+                else:
+                    s.mysend(answers[req[0]])
+        except (RuntimeError, socket.error):
+            conn.close()
+
+def run(klass, port, req, loops, protocol=0):
+    s = klass()
+    s.pickle_protocol = protocol
+    s.connect('127.0.0.1', port)
+    best = None
+    for i in range(loops):
+        res = None
+        gc.collect()
+        gc.disable() # so that the collector does not dominate the timings
+        t0 = time.time()
+        s.mysend(req)
+        res = s.myreceive()
+        dt = time.time() - t0
+        gc.enable()
+        if best is None or dt < best:
+            best = dt
+    s.disconnect()
+    return len(res), best
+
+if __name__ == '__main__':
+    lsock = socket.socket()
+    lsock.bind(('127.0.0.1', 0))
+    lsock.listen(5)
+    port = lsock.getsockname()[1]
+    answers = {}
+    thr = threading.Thread(target=serve, args=(lsock, answers))
+    thr.daemon = True
+    thr.start()
+
+    print "Framing, receiving results of some MB"
+    print "%-8s %-7s %12s %12s %8s" % ('size', 'pickle', 'legacy ms', 'new ms', 'speedup')
+    for size in (1, 10, 50):
+        answers['records'] = make_records(size * MB)
+        for protocol in (0, 2):
+            n1, old = run(legacy_socket, port, ('records',), 3, protocol)
+            n2, new = run(mysocket, port, ('records',), 3, protocol)
+            assert n1 == n2
+            print "%-8s %-7d %12.1f %12.1f %7.1fx" % ('%dMB' % size, protocol,
+                        old * 1000, new * 1000, old / new)
+    del answers['records']
+
+    print
+    print "Pickle protocols, sending and receiving the payload"
+    payloads = [('ints', range(1000000)),
+                ('floats', [n * 0.5 for n in xrange(500000)]),
+                ('binary', os.urandom(5 * MB)),
+                ('records', make_records(10 * MB)),
+                ]
+    print "%-8s %12s %12s %10s %10s %8s" % ('payload', 'p0 bytes', 'p2 bytes',
+                'p0 ms', 'p2 ms', 'speedup')
+    for name, payload in payloads:
+        sizes = [len(cPickle.dumps([('echo', payload), None], p)) for p in (0, 2)]
+        n0, t0 = run(mysocket, port, ('echo', payload), 3, 0)
+        n2, t2 = run(mysocket, port, ('echo', payload), 3, 2)
+        print "%-8s %12d %12d %10.1f %10.1f %7.1fx" % (name, sizes[0], sizes[1],
+                    t0 * 1000, t2 * 1000, t0 / t2)
+
+#eof
@@ -0,0 +1,296 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+""" Micro-benchmark of utils.Pool borrow()/free() throughput
+
+    Compares the current pool against `LegacyPool`, a copy of the pool
+    before v0.9, which scanned its free and used lists at each `borrow()`:
+
+        session   one kind, a check_fn and a limit of 40, like the pool of
+                  `Session`; the current pool with and without `fifo`
+        kinds     8 kinds of resources, selected by `filter_fn` in the
+                  legacy pool and by `key_fn` (or `filter_fn`) in the new
+"""
+import sys
+import os
+import time
+import threading
+from threading import Condition
+from itertools import count
+
+sys.path.insert(0, os.path.abspath('.'))
+from openerp_libclient.utils import Pool
+
+class LegacyPool(object):
+    """ utils.Pool, as it was before v0.9: linear scans of the lists
+    """
+
+    def __init__(self, iter_constr, check_fn=None, filter_fn=None, setter_fn=None, limit=False):
+        """ Init the pool
+
+            @param iter_constr is an iterable, that can construct a new
+                resource in the pool. It will be called lazily, when more
+                resources are needed
+            @param check_fn A callable to use before borrow or after free,
+                which will let discard "bad" resources. If check_fn(res)
+                returns False, res will be removed from our lists.
+            @param filter_fn If set, a callable that will be called like:
+                `filter_fn(resource,**kwargs)` , where `kwargs` are the ones
+                supplied to `borrow()` and used to select /valid/ resources
+                for that `borrow()` call. See. `Usage with indexed resources`
+            @param setter_fn Strongly advised to use together with `filter_fn`,
+                in order to initialize new resource with our index.
+                Also called like: `setter_fn(resource, **kwargs)` in borrow
+            @param limit If set, a positive integer of max resources that can
+                be allowed in "used" list, before call to `borrow()` will fail.
+                `limit` does use the `filter_fn`, if the latter is set, to
+                apply the limitation only to similar resources.
+        """
+        self.__free_ones = [] #: list of (resource, time) tuples
+        self.__used_ones = []
+        self.__lock = Condition()
+        self.__iterc = iter_constr
+        assert self.__iterc
+        self.__check_fn = check_fn
+        self._filter_fn = filter_fn
+        self._setter_fn = setter_fn
+        self._limit = limit
+
+    def borrow(self, blocking=False, **kwargs):
+        """Return the next free member of the pool
+        """
+        self.__lock.acquire()
+        t2 = 0.0
+        while(True):
+            ret = None
+            idx = len(self.__free_ones)
+            while (idx > 0):
+                idx -= 1
+                if self._filter_fn:
+                    # Wrap around try block, because we want to test with the
+                    # lock acquired(), but must release on exception
+                    try:
+                        if not self._filter_fn(self.__free_ones[idx][0], **kwargs):
+                            continue
+                    except:
+                        self.__lock.release()
+                        raise
+                ret, tstamp = self.__free_ones.pop(idx)
+                if self.__check_fn is not None:
+                    self.__lock.release()
+                    if not self.__check_fn(ret):
+                        ret = None
+                    # An exception will also propagate from here,
+                    # with the lock released
+                    self.__lock.acquire()
+                if ret is None:
+                    continue # the while loop. Ret is at no list any more
+                self.__used_ones.append(ret)
+                self.__lock.release()
+                return ret
+
+            count = 0
+            # Before constructing a new one, count the limit
+            try:
+                if self._limit:
+                    for res in self.__used_ones:
+                        if self._filter_fn and not self._filter_fn(res, **kwargs):
+                            continue
+                        count += 1
+            except:
+                self.__lock.release()
+                raise
+
+            # no free one, try to construct a new one
+            try:
+                self.__lock.release()
+                if self._limit and (count >= self._limit):
+                    raise StopIteration()
+
+                ret = self.__iterc.next()
+                if ret is not None and self._setter_fn:
+                    self._setter_fn(ret, **kwargs)
+
+                # the iterator may temporarily return None, which
+                # means we should wait and retry the operation.
+                self.__lock.acquire()
+                if ret is not None:
+                    self.__used_ones.append(ret)
+                    self.__lock.release()
+                    return ret
+            except StopIteration:
+                if not blocking:
+                    raise ValueError("No free resource")
+                # else pass
+                self.__lock.acquire()
+
+            idx = len(self.__free_ones) # reset counter, scan all of them after waiting
+            if isinstance(blocking, (int, float)):
+                twait = blocking - t2
+            else:
+                twait = None
+            if (not twait) and not len(self.__free_ones):
+                twait = 10.0 # must continue cycle at some point!
+            if twait > 0.0:
+                t1 = time.time()
+                self.__lock.wait(twait) # As condition
+                t1 = time.time() - t1
+            if ((twait - t2) < 0) and not len(self.__free_ones):
+                self.__lock.release()
+                raise ValueError("Timed out waiting for a free resource")
+            t2 += t1
+            continue
+
+        raise RuntimeError("Should never reach here")
+
+    def free(self, res):
+        self.__lock.acquire()
+        try:
+            self.__used_ones.remove(res)
+        except ValueError:
+            self.__lock.release()
+            raise RuntimeError("Strange, freed pool item that was not in the list")
+        if self.__check_fn is not None:
+            self.__lock.release()
+            if not self.__check_fn(res):
+                res = None
+                # not append to free ones, but issue notification
+            # An exception will also propagate from here,
+            # with the lock released
+            self.__lock.acquire()
+        if res is not None:
+            self.__free_ones.append((res, time.time()))
+        self.__lock.notify_all()
+        self.__lock.release()
+
+    def push_used(self, res):
+        """ Register a foreign resource as a used one, in the pool.
+        """
+        self.__lock.acquire()
+        if (res in self.__used_ones):
+            self.__lock.release()
+            raise RuntimeError("Resource already in pool")
+        for r, t in self.__free_ones:
+            if res == r:
+                self.__lock.release()
+                raise RuntimeError("Resource already in pool")
+        self.__used_ones.append(res)
+        self.__lock.release()
+
+    def __len__(self):
+        return len(self.__free_ones) + len(self.__used_ones)
+
+    def __nonzero__(self):
+        return True
+
+    def count_free(self):
+        return len(self.__free_ones)
+
+    def clear(self):
+        """ Forgets about all resources.
+        Warning: if you ever use this function, you must make sure that
+        the iterable will catch up and restart iteration with more resources
+        """
+        self.__lock.acquire()
+        self.__free_ones = []
+        self.__used_ones = []
+        self.__lock.notify_all() # Let them retry
+        self.__lock.release()
+
+    def expire(self, age=30.0):
+        """Forgets (deletes) resources that are older than `age` seconds
+
+            The age of a resource is measured as the time this has been
+            idle in the "free_ones" pool. It does not depend on the object
+            creation time or so.
+        """
+        self.__lock.acquire()
+        try:
+            if self.__free_ones:
+                alz = time.time() - age
+                self.__free_ones = filter(lambda rt: rt[1] > alz, self.__free_ones)
+        finally:
+            self.__lock.release()
+
+class Res(object):
+    def __init__(self, n):
+        self.n = n
+        self.kind = None
+
+def set_kind(res, kind=None):
+    res.kind = kind
+
+def check(res):
+    return True
+
+def session_pool(variant, limit):
+    constr = (Res(n) for n in count())
+    if variant == 'legacy':
+        return LegacyPool(constr, check, limit=limit)
+    return Pool(constr, check, limit=limit, fifo=(variant == 'fifo'))
+
+def kinds_pool(variant, limit):
+    constr = (Res(n) for n in count())
+    filter_fn = lambda res, kind=None: res.kind == kind
+    if variant == 'legacy':
+        return LegacyPool(constr, filter_fn=filter_fn, setter_fn=set_kind, limit=limit)
+    elif variant == 'filter_fn':
+        return Pool(constr, filter_fn=filter_fn, setter_fn=set_kind, limit=limit)
+    return Pool(constr, key_fn=lambda kind=None: kind, setter_fn=set_kind, limit=limit)
+
+def worker(pool, kinds, loops):
+    nk = len(kinds)
+    for i in xrange(loops):
+        if nk:
+            res = pool.borrow(blocking=5.0, kind=kinds[i % nk])
+        else:
+            res = pool.borrow(blocking=5.0)
+        pool.free(res)
+
+def run(pool, nthreads, kinds, loops, held):
+    # keep `held` resources of each kind busy, so that the used list is long
+    busy = []
+    for kind in (kinds or [None]):
+        for h in range(held):
+            if kind is None:
+                busy.append(pool.borrow())
+            else:
+                busy.append(pool.borrow(kind=kind))
+    # and as many free ones
+    for r in busy[:len(busy)/2]:
+        pool.free(r)
+    thrs = [threading.Thread(target=worker, args=(pool, kinds, loops))
+                for n in range(nthreads)]
+    t0 = time.time()
+    for t in thrs:
+        t.start()
+    for t in thrs:
+        t.join()
+    dt = time.time() - t0
+    return (nthreads * loops) / dt
+
+def best_of(repeat, fn, *args):
+    return max([fn(*args) for r in range(repeat)])
+
+if __name__ == '__main__':
+    loops = 20000
+    repeat = 3
+    print "session pool: one kind, check_fn, limit 40 (ops/s, best of %d)" % repeat
+    print "%-8s %-6s %12s %12s %12s" % ('threads', 'held', 'legacy', 'current', 'fifo')
+    for nthreads in (1, 4, 16):
+        for held in (4, 20):
+            res = [best_of(repeat, lambda: run(session_pool(v, 40), nthreads, [], loops / nthreads, held))
+                    for v in ('legacy', 'current', 'fifo')]
+            print "%-8d %-6d %12.0f %12.0f %12.0f" % ((nthreads, held) + tuple(res))
+
+    kinds = ['k%d' % k for k in range(8)]
+    print
+    print "8 kinds (ops/s, best of %d)" % repeat
+    print "%-8s %-6s %12s %12s %12s" % ('threads', 'held', 'legacy', 'filter_fn', 'key_fn')
+    for nthreads in (1, 4, 16):
+        for held in (4, 30):
+            limit = held + nthreads + 1
+            res = [best_of(repeat, lambda: run(kinds_pool(v, limit), nthreads, kinds, loops / nthreads, held))
+                    for v in ('legacy', 'filter_fn', 'key_fn')]
+            print "%-8d %-6d %12.0f %12.0f %12.0f" % ((nthreads, held) + tuple(res))
+
+#eof
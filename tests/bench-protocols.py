@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+""" Throughput and latency of each protocol handler, against the stand-in server
+
+    For every combination of handler (RPC-JSON, XML-RPCv2, XML-RPCv1,
+    Net-RPC), workload, response size, response compression and number of
+    threads, the client calls the server in a loop for a few seconds. Each
+    case runs in its own process, so that its CPU time and peak RSS are
+    its own, and the server runs in another one (see `standin_server.py`).
+
+    Workloads:
+        rows    search_read of all records, with a text field
+        binary  read of all records, with a binary field
+
+    The response size is given as RECORDSxBYTES: the number of records
+    and the size of the text (or binary) field of each. By default, rows
+    is 200x100 and binary 2x262144.
+
+    The results are a JSON document, with one entry per case: ops/s,
+    latency percentiles (msec), CPU msec per call and peak RSS (KB).
+    Example::
+
+        python tests/bench-protocols.py --threads 1,16 --duration 3 -o bench.json
+        python tests/bench-protocols.py --workloads rows --threads 4 \
+                --sizes 10x100,1000x100,10x10000,1000x10000
+"""
+import sys
+import os
+import time
+import json
+import socket
+import platform
+import resource
+import threading
+import subprocess
+import optparse
+
+sys.path.insert(0, os.path.abspath('.'))
+
+HANDLERS = {'RPC-JSON': 'http', 'XML-RPCv2': 'http', 'XML-RPCv1': 'http', 'Net-RPC': 'socket'}
+
+def _rows_workload(records, size):
+    return ({'rows': records, 'payload_size': size},
+            ('res.partner', 'search_read', [[], ['name', 'data', 'sequence']]))
+
+def _binary_workload(records, size):
+    return ({'rows': records, 'binary_size': size},
+            ('res.partner', 'read', [range(1, records + 1), ['name', 'image']]))
+
+WORKLOADS = {
+    # default (records, bytes), and a function of them that gives the
+    # server options and the call that each thread repeats
+    'rows': ((200, 100), _rows_workload),
+    'binary': ((2, 256 * 1024), _binary_workload),
+}
+
+GZIP_MODES = {'on': [True], 'off': [False], 'both': [True, False]}
+
+def parse_size(value):
+    """ "RECORDSxBYTES" to a (records, bytes) tuple
+    """
+    records, size = value.lower().split('x')
+    return int(records), int(size)
+
+STANDIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'standin_server.py')
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class ServerProcess(object):
+    """ The stand-in server, in a child process
+    """
+    def __init__(self, workload, size, gzip):
+        self.port = free_port()
+        self.netrpc_port = free_port()
+        args = [sys.executable, STANDIN, '--port', str(self.port),
+                '--netrpc-port', str(self.netrpc_port)]
+        for k, v in WORKLOADS[workload][1](*size)[0].items():
+            args += ['--' + k.replace('_', '-'), str(v)]
+        if not gzip:
+            args.append('--no-gzip')
+        self.proc = subprocess.Popen(args, stderr=open(os.devnull, 'w'))
+        deadline = time.time() + 10.0
+        while True:
+            try:
+                socket.create_connection(('localhost', self.netrpc_port)).close()
+                break
+            except socket.error:
+                if time.time() > deadline or self.proc.poll() is not None:
+                    self.stop()
+                    raise RuntimeError("The stand-in server did not start")
+                time.sleep(0.05)
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.proc.wait()
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    idx = min(int(len(sorted_values) * pct / 100.0), len(sorted_values) - 1)
+    return sorted_values[idx]
+
+def run_case(case):
+    """ Run one case, in this process
+
+        @return the dict of results
+    """
+    from openerp_libclient import session, protocols
+    __hush_pyflakes = [ protocols, ]
+    handler, threads = case['handler'], case['threads']
+    proto = HANDLERS[handler]
+    sess = session.Session()
+    sess.session_limit = threads
+    kwargs = dict(proto=proto, host='localhost',
+            port=(proto == 'socket') and case['netrpc_port'] or case['port'],
+            dbname='test_bqi', user='admin', passwd='admin', superpass='admin')
+    if proto == 'http':
+        kwargs['allowed_handlers'] = [handler]
+    sess.open(**kwargs)
+    sess.login()
+    model, method, args = WORKLOADS[case['workload']][1](case['records'], case['record_size'])[1]
+    errors = [0]
+    latencies = []
+
+    def worker(stop_at, lats):
+        while time.time() < stop_at:
+            t0 = time.time()
+            try:
+                sess.call_orm(model, method, args, {}, notify=False, cache=False)
+            except Exception:
+                errors[0] += 1
+            lats.append(time.time() - t0)
+
+    # warm up: establish the connections, outside the measurement
+    warm_up = [threading.Thread(target=worker, args=(time.time() + 0.2, []))
+                for i in range(threads)]
+    for t in warm_up:
+        t.start()
+    for t in warm_up:
+        t.join()
+    errors[0] = 0
+
+    per_thread = [[] for i in range(threads)]
+    stop_at = time.time() + case['duration']
+    workers = [threading.Thread(target=worker, args=(stop_at, lats)) for lats in per_thread]
+    ru0 = resource.getrusage(resource.RUSAGE_SELF)
+    t0 = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.time() - t0
+    ru1 = resource.getrusage(resource.RUSAGE_SELF)
+    sess.logout()
+
+    for lats in per_thread:
+        latencies.extend(lats)
+    latencies.sort()
+    ops = len(latencies)
+    cpu = (ru1.ru_utime - ru0.ru_utime) + (ru1.ru_stime - ru0.ru_stime)
+    res = dict(case)
+    del res['port'], res['netrpc_port']
+    res.update({'ops': ops, 'errors': errors[0], 'elapsed': elapsed,
+            'ops_per_sec': ops / elapsed,
+            'latency_ms': dict([('p%d' % p, percentile(latencies, p) * 1000.0)
+                                for p in (50, 90, 95, 99)] +
+                            [('max', latencies[-1] * 1000.0)]) if ops else None,
+            'cpu_ms_per_call': ops and (cpu * 1000.0 / ops),
+            'peak_rss_kb': ru1.ru_maxrss,
+            })
+    return res
+
+def run_child(case):
+    """ Run one case in a fresh process, so that it has its own RSS
+    """
+    proc = subprocess.Popen([sys.executable, __file__, '--run-case', json.dumps(case)],
+                stdout=subprocess.PIPE)
+    out = proc.communicate()[0]
+    if proc.returncode:
+        raise RuntimeError("Case %r failed, exit code %d" % (case, proc.returncode))
+    return json.loads(out.strip().split('\n')[-1])
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]",
+            description="Benchmark the protocol handlers against the stand-in server")
+    parser.add_option('--handlers', default=','.join(sorted(HANDLERS)),
+            help="comma-separated, of: %s" % ', '.join(sorted(HANDLERS)))
+    parser.add_option('--workloads', default='rows,binary',
+            help="comma-separated, of: %s" % ', '.join(sorted(WORKLOADS)))
+    parser.add_option('--threads', default='1,4,16,64,256',
+            help="comma-separated numbers of concurrent threads")
+    parser.add_option('--sizes',
+            help="comma-separated response sizes, as RECORDSxBYTES (records, and bytes of "
+                "the text or binary field of each), default: one per workload")
+    parser.add_option('--gzip', default='both',
+            help="response compression: on, off or both (the default)")
+    parser.add_option('--duration', type='float', default=2.0, help="seconds per case")
+    parser.add_option('-o', '--output', help="write the JSON results to this file")
+    parser.add_option('--run-case', help=optparse.SUPPRESS_HELP)
+    opts, args = parser.parse_args()
+
+    if opts.run_case:
+        print json.dumps(run_case(json.loads(opts.run_case)))
+        return
+
+    handlers = opts.handlers.split(',')
+    for h in handlers:
+        if h not in HANDLERS:
+            parser.error("Unknown handler: %s" % h)
+    workloads = opts.workloads.split(',')
+    for w in workloads:
+        if w not in WORKLOADS:
+            parser.error("Unknown workload: %s" % w)
+    threads = [int(t) for t in opts.threads.split(',')]
+    sizes = None
+    if opts.sizes:
+        try:
+            sizes = [parse_size(sz) for sz in opts.sizes.split(',')]
+        except ValueError:
+            parser.error("Invalid sizes: %s, expected like 200x100" % opts.sizes)
+    if opts.gzip not in GZIP_MODES:
+        parser.error("Unknown gzip mode: %s, expected on, off or both" % opts.gzip)
+    gzips = GZIP_MODES[opts.gzip]
+
+    results = []
+    sys.stderr.write("%-8s %-12s %-10s %-4s %7s %10s %9s %9s %9s %8s %9s\n" % ('workload',
+            'size', 'handler', 'gzip', 'threads', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms',
+            'cpu ms', 'rss KB'))
+    for workload in workloads:
+        for size in (sizes or [WORKLOADS[workload][0]]):
+            for gzip in gzips:
+                server = ServerProcess(workload, size, gzip)
+                try:
+                    for handler in handlers:
+                        for nthreads in threads:
+                            res = run_child({'handler': handler, 'workload': workload,
+                                    'records': size[0], 'record_size': size[1],
+                                    'gzip': gzip, 'threads': nthreads,
+                                    'duration': opts.duration,
+                                    'port': server.port, 'netrpc_port': server.netrpc_port})
+                            results.append(res)
+                            lat = res['latency_ms'] or {}
+                            sys.stderr.write("%-8s %-12s %-10s %-4s %7d %10.1f %9.2f %9.2f %9.2f %8.3f %9d\n" % (
+                                    workload, '%dx%d' % size, handler, gzip and 'on' or 'off',
+                                    nthreads, res['ops_per_sec'], lat.get('p50', 0),
+                                    lat.get('p95', 0), lat.get('p99', 0),
+                                    res['cpu_ms_per_call'], res['peak_rss_kb']))
+                finally:
+                    server.stop()
+
+    doc = {'benchmark': 'protocols', 'time': time.time(),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'duration': opts.duration, 'results': results}
+    if opts.output:
+        fp = open(opts.output, 'wb')
+        json.dump(doc, fp, indent=1, sort_keys=True)
+        fp.close()
+    else:
+        print json.dumps(doc, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
+
+#eof
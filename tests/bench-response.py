@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+""" Benchmark of reading (and decompressing) large HTTP responses
+
+    Compares `protocol_xmlrpc.iter_response()`, which reads by the
+    Content-Length in growing chunks, against the 1024-byte reads that
+    the transports did before v0.9, for plain and gzip bodies.
+    The server is a local thread, so this measures the client side only.
+"""
+import sys
+import os
+import time
+import gzip
+import threading
+import SocketServer
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.abspath('.'))
+from openerp_libclient.protocol_xmlrpc import HTTPConnection2, iter_response
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+MB = 1024 * 1024
+bodies = {}
+
+def make_body(size, compress):
+    line = '<value><string>%s</string></value>\n'
+    text = ''.join([line % ('%08d' % n * 8) for n in xrange(size / 80 + 1)])[:size]
+    if not compress:
+        return text
+    sbuffer = StringIO()
+    gz = gzip.GzipFile(mode='wb', fileobj=sbuffer, compresslevel=1)
+    gz.write(text)
+    gz.close()
+    return sbuffer.getvalue()
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body, compress = bodies[self.path]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # a kept-alive request thread shall not keep the process alive
+    daemon_threads = True
+
+def read_legacy(response):
+    """ The read loop of _parse_response(), before v0.9
+    """
+    if response.msg.get('content-encoding') == 'gzip':
+        gzdata = StringIO()
+        while not response.isclosed():
+            rdata = response.read(1024)
+            if not rdata:
+                break
+            gzdata.write(rdata)
+        gzdata.seek(0)
+        rbuffer = gzip.GzipFile(mode='rb', fileobj=gzdata)
+        total = len(rbuffer.read())
+    else:
+        total = 0
+        while not response.isclosed():
+            rdata = response.read(1024)
+            if not rdata:
+                break
+            total += len(rdata)
+            if len(rdata) < 1024:
+                break
+    return total
+
+def read_new(response):
+    total = 0
+    for rdata in iter_response(response):
+        total += len(rdata)
+    return total
+
+def run(conn, path, reader, loops):
+    best = None
+    for i in range(loops):
+        t0 = time.time()
+        conn.request('GET', path)
+        total = reader(conn.getresponse())
+        dt = time.time() - t0
+        if best is None or dt < best:
+            best = dt
+    return total, best
+
+if __name__ == '__main__':
+    server = Server(('127.0.0.1', 0), Handler)
+    thr = threading.Thread(target=server.serve_forever)
+    thr.daemon = True
+    thr.start()
+    conn = HTTPConnection2('127.0.0.1', server.server_port)
+
+    print "%-8s %-5s %12s %12s %8s" % ('size', 'gzip', 'legacy MB/s', 'new MB/s', 'speedup')
+    for size in (1, 10, 100):
+        for compress in (False, True):
+            path = '/%d-%s' % (size, compress)
+            bodies[path] = (make_body(size * MB, compress), compress)
+            loops = (size < 100) and 5 or 2
+            tot1, old = run(conn, path, read_legacy, loops)
+            tot2, new = run(conn, path, read_new, loops)
+            assert tot1 == tot2 == size * MB, (tot1, tot2)
+            print "%-8s %-5s %12.1f %12.1f %7.1fx" % ('%dMB' % size, compress,
+                        size / old, size / new, old / new)
+            del bodies[path]
+    conn.close()
+    server.shutdown()
+    server.server_close()
+
+#eof
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+""" Benchmark of the str/unicode conversion of Net-RPC arguments and results
+
+    Compares the recursive `stringToUnicode()` and `unicodeToString()` that
+    Connection had before v0.9, which copied every container, against the
+    iterative converters of `tools`, on 100k rows of a read() result.
+"""
+import sys
+import os
+import time
+import copy
+import cPickle
+
+sys.path.insert(0, os.path.abspath('.'))
+from openerp_libclient.interface import Connection
+
+class legacy_conn(object):
+    """ The conversions of Connection, before v0.9
+    """
+    def stringToUnicode(self, result):
+        if isinstance(result, str):
+            return unicode( result, 'utf-8' )
+        elif isinstance(result, list):
+            return [self.stringToUnicode(x) for x in result]
+        elif isinstance(result, tuple):
+            return tuple([self.stringToUnicode(x) for x in result])
+        elif isinstance(result, dict):
+            newres = {}
+            for i in result.keys():
+                newres[i] = self.stringToUnicode(result[i])
+            return newres
+        else:
+            return result
+
+    def unicodeToString(self, result):
+        if isinstance(result, unicode):
+            return result.encode( 'utf-8' )
+        elif isinstance(result, list):
+            return [self.unicodeToString(x) for x in result]
+        elif isinstance(result, tuple):
+            return tuple([self.unicodeToString(x) for x in result])
+        elif isinstance(result, dict):
+            newres = {}
+            for i in result.keys():
+                newres[i] = self.unicodeToString(result[i])
+            return newres
+        else:
+            return result
+
+class new_conn(Connection):
+    def __init__(self):
+        pass
+
+def make_rows(num, text=str):
+    return [{'id': n, 'name': text('Partner #%d' % n), 'ref': text('P%05d' % n),
+            'active': True, 'credit': n * 0.5, 'parent_id': (n // 10, text('Parent #%d' % (n // 10))),
+            'category_id': [1, 2, 3], 'comment': False} for n in xrange(num)]
+
+def timeit(fn, data, loops=3):
+    """ Best time of fn(data), on a fresh copy of data each time
+    """
+    best = None
+    pickled = cPickle.dumps(data, 2)
+    for i in range(loops):
+        data = cPickle.loads(pickled)
+        t0 = time.time()
+        fn(data)
+        dt = time.time() - t0
+        if best is None or dt < best:
+            best = dt
+    return best
+
+if __name__ == '__main__':
+    old = legacy_conn()
+    new = new_conn()
+    cases = [
+        ('results, utf-8', make_rows(100000), old.stringToUnicode,
+                [('copy-on-write', new.stringToUnicode),
+                 ('in place', lambda r: new.stringToUnicode(r, inplace=True))]),
+        ('results, no strings', [[n, n * 2, (n, False)] for n in xrange(100000)], old.stringToUnicode,
+                [('copy-on-write', new.stringToUnicode),
+                 ('in place', lambda r: new.stringToUnicode(r, inplace=True))]),
+        ('args, unicode', make_rows(100000, unicode), old.unicodeToString,
+                [('copy-on-write', new.unicodeToString)]),
+        ('args, ids', range(100000), old.unicodeToString,
+                [('copy-on-write', new.unicodeToString)]),
+        ]
+    print "%-22s %-15s %10s %10s %8s" % ('100k rows', 'converter', 'legacy ms', 'new ms', 'speedup')
+    for name, data, old_fn, new_fns in cases:
+        t_old = timeit(old_fn, data)
+        for conv, fn in new_fns:
+            t_new = timeit(fn, data)
+            print "%-22s %-15s %10.1f %10.1f %7.1fx" % (name, conv, t_old * 1000,
+                        t_new * 1000, t_old / t_new)
+
+#eof
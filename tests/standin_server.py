@@ -0,0 +1,753 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    Copyright (c) 2010-2015 P. Christeas <xrg@hellug.gr>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+""" A local stand-in for the OpenERP server, for offline tests and benchmarks
+
+    It speaks XML-RPC v1 (/xmlrpc/...), XML-RPC v2 (/xmlrpc2/...), RPC-JSON
+    (/json/...) with HTTP Basic authentication realms, and the Net-RPC
+    pickled framing at a second port. Only a handful of in-memory models
+    are served, like `res.partner`, `stock.location` and `test_orm.slow1`,
+    with the ORM methods the library and the tests use.
+
+    Latency, payload sizes, gzip and fault injection are configurable, see
+    `ServerOptions`. Run it like::
+
+        python tests/standin_server.py --port 8169 --netrpc-port 8170
+
+    or start it in-process::
+
+        srv = StandinServer(ServerOptions(port=0, netrpc_port=0))
+        srv.start()
+        ...
+        srv.stop()
+
+    Its defaults are those of the other scripts of `tests/`, which can
+    connect to it as to a real server with the `test_bqi` database.
+"""
+
+import os
+import time
+import random
+import socket
+import threading
+import logging
+import optparse
+import base64
+import gzip
+import zlib
+import json
+import cPickle
+import traceback
+import xmlrpclib
+import SocketServer
+import BaseHTTPServer
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+SERVER_VERSION = '6.0.4'
+
+class ServerOptions(object):
+    """ Tunables of the stand-in server
+    """
+    host = 'localhost'
+    port = 8169             #: HTTP port, 0 for any free one
+    netrpc_port = 8170      #: Net-RPC port, 0 for any, None to disable
+    dbname = 'test_bqi'
+    user = 'admin'
+    passwd = 'admin'
+    superpass = 'admin'
+    latency = 0.0           #: seconds added to every call
+    slow_time = 2.0         #: seconds that `test_orm.slow1.do_slow()` takes
+    rows = 100              #: number of records of each model
+    payload_size = 0        #: bytes of the `data` text field of each record
+    binary_size = 0         #: bytes of the `image` binary field of each record
+    gzip = True             #: compress responses, if the client accepts that
+    gzip_min = 200          #: do not compress smaller responses
+    fault_rate = 0.0        #: probability of a server exception per call
+    drop_rate = 0.0         #: probability of closing a connection, per request
+    keep_alive = True       #: keep HTTP and Net-RPC connections open
+    idle_timeout = None     #: seconds after which idle HTTP connections close
+    options = ['exec_dict', 'xmlrpc-gzip', 'xmlrpc-multicall', 'json-batch',
+            'netrpc-pickle2']   #: advertised by get_options(), they do not change the server
+    netrpc_pickle = None    #: pickle protocol of Net-RPC responses, None for that of the request
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            if not hasattr(self, k):
+                raise AttributeError("No option %s" % k)
+            setattr(self, k, v)
+
+class ServerFault(Exception):
+    """ Exception raised by a server method, reported to the client
+    """
+    def __init__(self, msg, details='', origin='warning'):
+        Exception.__init__(self, msg, details)
+        self.msg = msg
+        self.details = details
+        self.origin = origin
+
+class AuthError(Exception):
+    pass
+
+# ---------------- Models ----------------
+
+class Model(object):
+    """ A trivial in-memory ORM model
+    """
+    _name = None
+
+    def __init__(self, server, nrows):
+        self.server = server
+        self.opts = server.opts
+        self._lock = threading.Lock()
+        self._records = {}
+        self._next_id = 1
+        for n in range(nrows):
+            self.create(self._default_record(n))
+
+    def _default_record(self, n):
+        rec = {'name': '%s #%d' % (self._name, n + 1), 'active': True,
+                'sequence': n }
+        if self.opts.payload_size:
+            rec['data'] = ('%s ' % rec['name'] * (self.opts.payload_size / 4 + 1))[:self.opts.payload_size]
+        if self.opts.binary_size:
+            rec['image'] = xmlrpclib.Binary(os.urandom(self.opts.binary_size))
+        return rec
+
+    def _columns(self):
+        return { 'id': 'integer', 'name': 'char', 'active': 'boolean',
+                'sequence': 'integer', 'data': 'text', 'image': 'binary' }
+
+    def _match(self, rec, domain):
+        for term in domain or []:
+            if not isinstance(term, (list, tuple)):
+                continue # '&', '|' operators are not supported
+            field, op, value = term
+            rv = rec.get(field, False)
+            if op == '=' and rv != value:
+                return False
+            elif op == '!=' and rv == value:
+                return False
+            elif op == 'in' and rv not in value:
+                return False
+            elif op == 'not in' and rv in value:
+                return False
+            elif op == 'ilike' and unicode(value).lower() not in unicode(rv).lower():
+                return False
+            elif op == '<' and not rv < value:
+                return False
+            elif op == '>' and not rv > value:
+                return False
+        return True
+
+    def search(self, domain=None, offset=0, limit=None, order=None, context=None, count=False):
+        with self._lock:
+            ids = sorted([rid for rid, rec in self._records.items()
+                        if self._match(dict(rec, id=rid), domain)])
+        if count:
+            return len(ids)
+        ids = ids[offset or 0:]
+        if limit:
+            ids = ids[:limit]
+        return ids
+
+    def read(self, ids, fields=None, context=None, load='_classic_read'):
+        single = isinstance(ids, (int, long))
+        if single:
+            ids = [ids]
+        res = []
+        with self._lock:
+            for rid in ids:
+                rec = self._records.get(rid)
+                if rec is None:
+                    continue
+                if fields:
+                    r = dict([(f, rec.get(f, False)) for f in fields])
+                else:
+                    r = rec.copy()
+                r['id'] = rid
+                res.append(r)
+        if single:
+            return res and res[0] or False
+        return res
+
+    def search_read(self, domain=None, fields=None, offset=0, limit=None, order=None, context=None):
+        return self.read(self.search(domain, offset, limit, order), fields)
+
+    def name_get(self, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        with self._lock:
+            return [(rid, self._records[rid]['name']) for rid in ids if rid in self._records]
+
+    def name_search(self, name='', args=None, operator='ilike', context=None, limit=100):
+        ids = self.search((args or []) + [('name', operator, name)], limit=limit)
+        return self.name_get(ids)
+
+    def exists(self, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        with self._lock:
+            return all([rid in self._records for rid in ids])
+
+    def create(self, vals, context=None):
+        with self._lock:
+            rid = self._next_id
+            self._next_id += 1
+            self._records[rid] = dict(vals)
+        return rid
+
+    def write(self, ids, vals, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        with self._lock:
+            for rid in ids:
+                if rid not in self._records:
+                    raise ServerFault("Record #%d does not exist" % rid)
+                self._records[rid].update(vals)
+        return True
+
+    def unlink(self, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        with self._lock:
+            for rid in ids:
+                self._records.pop(rid, None)
+        return True
+
+    def fields_get(self, fields=None, context=None):
+        res = {}
+        for fname, ftype in self._columns().items():
+            if fields and fname not in fields:
+                continue
+            res[fname] = {'type': ftype, 'string': fname.capitalize(), 'readonly': fname == 'id'}
+        return res
+
+    def fields_view_get(self, view_id=None, view_type='form', context=None, toolbar=False, submenu=False):
+        arch = '<%s string="%s">%s</%s>' % (view_type, self._name,
+                ''.join(['<field name="%s"/>' % f for f in sorted(self._columns())]), view_type)
+        return {'name': self._name, 'model': self._name, 'type': view_type,
+                'view_id': view_id or 1, 'arch': arch, 'fields': self.fields_get()}
+
+    def default_get(self, fields_list, context=None):
+        return {'active': True}
+
+    def fail(self, msg='Injected failure', context=None):
+        raise ServerFault(msg, "The stand-in server was asked to fail")
+
+class ResPartner(Model):
+    _name = 'res.partner'
+
+class StockLocation(Model):
+    _name = 'stock.location'
+
+    def _default_record(self, n):
+        rec = super(StockLocation, self)._default_record(n)
+        rec['stock_real'] = float(n * 10)
+        rec['stock_virtual'] = float(n * 10 + 5)
+        return rec
+
+class ResUsers(Model):
+    _name = 'res.users'
+
+    def context_get(self, context=None):
+        return {'lang': 'en_US', 'tz': False}
+
+class ResRequest(Model):
+    _name = 'res.request'
+
+    def request_get(self, context=None):
+        ids = self.search([], limit=5)
+        return ids, []
+
+class IrModule(Model):
+    _name = 'ir.module.module'
+
+    def _default_record(self, n):
+        return {'name': ['base', 'stock', 'test_orm'][n % 3], 'state': 'installed',
+                'latest_version': SERVER_VERSION + '.1'}
+
+class SlowModel(Model):
+    _name = 'test_orm.slow1'
+
+    def do_slow(self, ids, context=None):
+        time.sleep(self.opts.slow_time)
+        return True
+
+MODELS = [ResPartner, StockLocation, ResUsers, ResRequest, IrModule, SlowModel]
+
+# ---------------- Dispatching ----------------
+
+class Dispatcher(object):
+    """ Implements the services, common to all protocols
+    """
+    def __init__(self, opts):
+        self.opts = opts
+        self.models = {}
+        for klass in MODELS:
+            nrows = klass is IrModule and 3 or opts.rows
+            self.models[klass._name] = klass(self, nrows)
+        self.calls = 0
+        self._stats_lock = threading.Lock()
+
+    def _maybe_fail(self):
+        with self._stats_lock:
+            self.calls += 1
+        if self.opts.latency:
+            time.sleep(self.opts.latency)
+        if self.opts.fault_rate and random.random() < self.opts.fault_rate:
+            raise ServerFault("Injected fault", "Random fault of the stand-in server")
+
+    def check_login(self, dbname, user, passwd):
+        if dbname != self.opts.dbname:
+            raise ServerFault("Database %s does not exist" % dbname, origin='exception')
+        return user == self.opts.user and passwd == self.opts.passwd
+
+    def check_uid(self, dbname, uid, passwd):
+        if dbname != self.opts.dbname or uid != 1 or passwd != self.opts.passwd:
+            raise AuthError("Access denied")
+
+    def check_root(self, passwd):
+        if passwd != self.opts.superpass:
+            raise AuthError("Access denied")
+
+    def orm(self, model, method, args, kwargs=None):
+        self._maybe_fail()
+        obj = self.models.get(model)
+        if obj is None:
+            raise ServerFault("Object %s doesn't exist" % model, origin='exception')
+        if method.startswith('_') or not hasattr(obj, method):
+            raise ServerFault("Method %s.%s doesn't exist" % (model, method), origin='exception')
+        return getattr(obj, method)(*args, **(kwargs or {}))
+
+    def service(self, service, method, args):
+        """ Call of a service method, after authentication has been stripped
+
+            `args` for 'object' calls do not have the db, uid, passwd any more
+        """
+        if service == 'object':
+            if method == 'execute':
+                return self.orm(args[0], args[1], args[2:])
+            elif method == 'exec_dict':
+                return self.orm(args[0], args[1], args[2], args[3])
+        elif service == 'common':
+            if method == 'get_options':
+                return list(self.opts.options)
+            elif method == 'version':
+                return {'server_version': SERVER_VERSION}
+            elif method == 'get_os_time':
+                return list(os.times())
+        elif service == 'db':
+            if method == 'server_version':
+                return SERVER_VERSION
+            elif method == 'list':
+                return [self.opts.dbname]
+        raise ServerFault("Method %s/%s not found" % (service, method), origin='exception')
+
+    def netrpc_call(self, msg):
+        """ Dispatch a Net-RPC (or XML-RPC v1) message, with inline credentials
+        """
+        service, method = msg[0], msg[1]
+        args = list(msg[2:])
+        if service == 'common' and method == 'login':
+            self._maybe_fail()
+            return self.check_login(*args[:3]) and 1 or False
+        elif service == 'object':
+            self.check_uid(*args[:3])
+            return self.service(service, method, args[3:])
+        elif service == 'db' and method in ('list', 'drop', 'create'):
+            self.check_root(args[0])
+            return self.service(service, method, args[1:])
+        self._maybe_fail()
+        return self.service(service, method, args)
+
+# ---------------- HTTP ----------------
+
+class HttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'OpenERP-standin/' + SERVER_VERSION
+    wbufsize = -1 # headers and body in one go, flushed after each request
+
+    def setup(self):
+        self.timeout = self.server.opts.idle_timeout
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # bodies larger than the write buffer go out after the headers,
+        # which Nagle's algorithm would hold until the client's (delayed) ACK
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        self.server.log.debug(format, *args)
+
+    def _read_body(self):
+        length = int(self.headers.get('content-length', 0))
+        body = self.rfile.read(length)
+        if self.headers.get('content-encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def _send(self, code, body, content_type, extra_headers=None):
+        opts = self.server.opts
+        if opts.drop_rate and random.random() < opts.drop_rate:
+            # simulate a server that went away
+            self.close_connection = 1
+            return
+        self.send_response(code)
+        headers = extra_headers or []
+        if opts.gzip and len(body) > opts.gzip_min \
+                and 'gzip' in self.headers.get('accept-encoding', ''):
+            sbuffer = StringIO()
+            gz = gzip.GzipFile(mode='wb', fileobj=sbuffer)
+            gz.write(body)
+            gz.close()
+            body = sbuffer.getvalue()
+            headers.append(('Content-Encoding', 'gzip'))
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers:
+            self.send_header(k, v)
+        if not opts.keep_alive:
+            self.send_header('Connection', 'close')
+            self.close_connection = 1
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _auth(self, realm):
+        """ Check Basic authentication for `realm`
+
+            @return True, or False after having sent the 401 challenge
+        """
+        opts = self.server.opts
+        auth = self.headers.get('authorization', '')
+        if auth.startswith('Basic '):
+            user, passwd = base64.decodestring(auth[6:]).split(':', 1)
+            if realm == 'OpenERP Admin' and user == 'root' and passwd == opts.superpass:
+                return True
+            if realm == 'OpenERP User' and user == opts.user and passwd == opts.passwd:
+                return True
+        self._send(401, 'Authentication required', 'text/plain',
+                [('WWW-Authenticate', 'Basic realm="%s"' % realm)])
+        return False
+
+    def do_POST(self):
+        body = self._read_body()
+        path = self.path.strip('/').split('/')
+        try:
+            if path[0] == 'xmlrpc':
+                return self._do_xmlrpc(path[1:], body)
+            elif path[0] == 'xmlrpc2':
+                return self._do_xmlrpc2(path[1:], body)
+            elif path[0] == 'json':
+                return self._do_json(path[1:], body)
+        except Exception:
+            self.server.log.exception("Error at %s:", self.path)
+            return self._send(500, 'Internal error', 'text/plain')
+        self._send(404, 'Not found', 'text/plain')
+
+    def _split_auth_path(self, path):
+        """ Parse ['db', dbname, ...] or ['pub'|'root', ...] paths
+
+            @return (auth_level, dbname, rest of path) or None if the
+                authentication challenge has been sent
+        """
+        if path[0] == 'db':
+            if not self._auth('OpenERP User'):
+                return None
+            return 'db', path[1], path[2:]
+        elif path[0] == 'orm':
+            if not self._auth('OpenERP User'):
+                return None
+            return 'orm', path[1], path[2:]
+        elif path[0] == 'root':
+            if not self._auth('OpenERP Admin'):
+                return None
+            return 'root', None, path[1:]
+        return path[0], None, path[1:]
+
+    # XML-RPC
+
+    def _xml_fault(self, e, v2=False):
+        if isinstance(e, ServerFault):
+            if v2:
+                fstring = "X-Exception: %s\nX-ExcOrigin: %s\nX-ExcDetails: %s\nX-Traceback: %s" % \
+                        (e.msg, e.origin, e.details, '\n\t'.join(traceback.format_exc().split('\n')))
+                return xmlrpclib.Fault(1, fstring)
+            return xmlrpclib.Fault('%s -- %s\n\n%s' % (e.origin, e.msg, e.details), traceback.format_exc())
+        return xmlrpclib.Fault(1, '%s: %s' % (e.__class__.__name__, e))
+
+    def _xml_dispatch(self, body, dispatch_fn, v2=False):
+        params, method = xmlrpclib.loads(body, use_datetime=False)
+        try:
+            if method == 'system.multicall':
+                results = []
+                for call in params[0]:
+                    try:
+                        results.append([dispatch_fn(call['methodName'], call['params'])])
+                    except xmlrpclib.Fault, f:
+                        results.append({'faultCode': f.faultCode, 'faultString': f.faultString})
+                    except Exception, e:
+                        f = self._xml_fault(e, v2)
+                        results.append({'faultCode': f.faultCode, 'faultString': f.faultString})
+                resp = xmlrpclib.dumps((results,), methodresponse=1, allow_none=False)
+            else:
+                resp = xmlrpclib.dumps((dispatch_fn(method, params),), methodresponse=1, allow_none=False)
+        except xmlrpclib.Fault, f:
+            resp = xmlrpclib.dumps(f)
+        except Exception, e:
+            resp = xmlrpclib.dumps(self._xml_fault(e, v2))
+        self._send(200, resp, 'text/xml')
+
+    def _do_xmlrpc(self, path, body):
+        service = path[0]
+        disp = self.server.dispatcher
+        def _fn(method, params):
+            return disp.netrpc_call((service, method) + tuple(params))
+        self._xml_dispatch(body, _fn)
+
+    def _do_xmlrpc2(self, path, body):
+        ap = self._split_auth_path(path)
+        if ap is None:
+            return
+        auth_level, dbname, rest = ap
+        service = rest[0]
+        disp = self.server.dispatcher
+        def _fn(method, params):
+            if service == 'common' and method == 'login':
+                return disp.netrpc_call(('common', 'login') + tuple(params))
+            return disp.service(service, method, list(params))
+        self._xml_dispatch(body, _fn, v2=True)
+
+    # RPC-JSON
+
+    def _json_one(self, req, auth_level, dbname, rest):
+        disp = self.server.dispatcher
+        ret = {'version': '1.1', 'id': req.get('id')}
+        params = req.get('params', [])
+        args, kwargs = params, {}
+        if isinstance(params, dict):
+            args, kwargs = [], {}
+            pos = {}
+            for k, v in params.items():
+                if k.isdigit():
+                    pos[int(k)] = v
+                else:
+                    kwargs[str(k)] = v
+            args = [pos[k] for k in sorted(pos)]
+        method = req.get('method')
+        try:
+            if auth_level == 'orm':
+                ret['result'] = disp.orm(rest[0], method, args, kwargs)
+            elif rest[0] == 'common' and method == 'login':
+                ret['result'] = disp.netrpc_call(('common', 'login') + tuple(args))
+            else:
+                ret['result'] = disp.service(rest[0], method, args)
+        except ServerFault, e:
+            ret['error'] = {'message': e.msg, 'origin': e.origin, 'error': e.details,
+                        'traceback': traceback.format_exc()}
+        except Exception, e:
+            ret['error'] = {'message': '%s: %s' % (e.__class__.__name__, e),
+                        'origin': 'exception', 'traceback': traceback.format_exc()}
+        return ret
+
+    def _do_json(self, path, body):
+        ap = self._split_auth_path(path)
+        if ap is None:
+            return
+        auth_level, dbname, rest = ap
+        req = json.loads(body, object_hook=_json_hook)
+        if isinstance(req, list):
+            res = [self._json_one(r, auth_level, dbname, rest) for r in req]
+        else:
+            res = self._json_one(req, auth_level, dbname, rest)
+        self._send(200, json.dumps(res, cls=_JsonEncoder), 'application/json')
+
+def _json_hook(dct):
+    if '__binary__' in dct:
+        return xmlrpclib.Binary(base64.decodestring(dct['payload']))
+    return dct
+
+class _JsonEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, xmlrpclib.Binary):
+            return { '__binary__': True, 'payload': base64.encodestring(obj.data)}
+        return super(_JsonEncoder, self).default(obj)
+
+class HttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+
+# ---------------- Net-RPC ----------------
+
+class NetRpcHandler(SocketServer.BaseRequestHandler):
+    """ Speaks the pickled Net-RPC framing, many requests per connection
+    """
+    def _recv(self, size):
+        buf = []
+        while size:
+            chunk = self.request.recv(min(size, 65536))
+            if not chunk:
+                raise EOFError()
+            buf.append(chunk)
+            size -= len(chunk)
+        return ''.join(buf)
+
+    def handle(self):
+        opts = self.server.opts
+        disp = self.server.dispatcher
+        while True:
+            try:
+                size = int(self._recv(8))
+                self._recv(1) # exception flag
+                data = self._recv(size)
+                msg = cPickle.loads(data)[0]
+            except (EOFError, socket.error, ValueError):
+                return
+            if opts.drop_rate and random.random() < opts.drop_rate:
+                return
+            exc = False
+            try:
+                for i, m in enumerate(msg):
+                    if isinstance(m, xmlrpclib.Binary):
+                        msg = msg[:i] + (m.data,) + msg[i+1:]
+                res = [disp.netrpc_call(msg), None]
+            except ServerFault, e:
+                exc = True
+                res = [Exception('%s -- %s\n\n%s' % (e.origin, e.msg, e.details)), traceback.format_exc()]
+            except Exception, e:
+                exc = True
+                res = [Exception('%s: %s' % (e.__class__.__name__, e)), traceback.format_exc()]
+            req_proto = (data[:1] == '\x80') and ord(data[1]) or 0
+            pickles = self.server.pickle_protocols
+            pickles[req_proto] = pickles.get(req_proto, 0) + 1
+            proto = opts.netrpc_pickle
+            if proto is None:
+                proto = req_proto
+            data = cPickle.dumps(res, proto)
+            self.request.sendall('%8d%s%s' % (len(data), exc and '1' or '0', data))
+            if not opts.keep_alive:
+                return
+
+class NetRpcServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+
+# ---------------- Main ----------------
+
+class StandinServer(object):
+    """ The HTTP and Net-RPC servers, running in background threads
+    """
+    def __init__(self, opts=None):
+        self.opts = opts or ServerOptions()
+        self.log = logging.getLogger('standin')
+        self.dispatcher = Dispatcher(self.opts)
+        self.http = HttpServer((self.opts.host, self.opts.port), HttpHandler)
+        self.netrpc = None
+        if self.opts.netrpc_port is not None:
+            self.netrpc = NetRpcServer((self.opts.host, self.opts.netrpc_port), NetRpcHandler)
+            self.netrpc.pickle_protocols = {} #: count of requests, per pickle protocol
+        for srv in (self.http, self.netrpc):
+            if srv:
+                srv.opts = self.opts
+                srv.dispatcher = self.dispatcher
+                srv.log = self.log
+        self._threads = []
+
+    @property
+    def port(self):
+        return self.http.server_address[1]
+
+    @property
+    def netrpc_port(self):
+        return self.netrpc and self.netrpc.server_address[1]
+
+    def connect_args(self, proto='http'):
+        """ Arguments for `Session.open()` or `rpc.openSession()`
+        """
+        return dict(proto=proto, host=self.opts.host,
+                port=(proto == 'socket') and self.netrpc_port or self.port,
+                dbname=self.opts.dbname, user=self.opts.user,
+                passwd=self.opts.passwd, superpass=self.opts.superpass)
+
+    def start(self):
+        for srv in (self.http, self.netrpc):
+            if srv:
+                t = threading.Thread(target=srv.serve_forever, kwargs={'poll_interval': 0.1})
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+        return self
+
+    def stop(self):
+        for srv in (self.http, self.netrpc):
+            if srv:
+                srv.shutdown()
+                srv.server_close()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]",
+            description="Local stand-in OpenERP server, for offline tests")
+    defaults = ServerOptions()
+    parser.add_option('--host', default=defaults.host)
+    parser.add_option('--port', type='int', default=defaults.port)
+    parser.add_option('--netrpc-port', type='int', default=defaults.netrpc_port)
+    parser.add_option('--dbname', default=defaults.dbname)
+    parser.add_option('--latency', type='float', default=0.0, help="seconds per call")
+    parser.add_option('--slow-time', type='float', default=defaults.slow_time)
+    parser.add_option('--rows', type='int', default=defaults.rows, help="records per model")
+    parser.add_option('--payload-size', type='int', default=0, help="bytes of text per record")
+    parser.add_option('--binary-size', type='int', default=0, help="bytes of binary per record")
+    parser.add_option('--no-gzip', dest='gzip', action='store_false', default=True)
+    parser.add_option('--fault-rate', type='float', default=0.0)
+    parser.add_option('--drop-rate', type='float', default=0.0)
+    parser.add_option('--no-keep-alive', dest='keep_alive', action='store_false', default=True)
+    parser.add_option('--idle-timeout', type='float', default=None,
+            help="seconds after which idle HTTP connections are closed")
+    parser.add_option('--netrpc-pickle', type='int', default=None)
+    parser.add_option('--options', type='string', default=','.join(defaults.options),
+            help="comma-separated options that the server advertises")
+    parser.add_option('--debug', action='store_true', default=False)
+    copts, args = parser.parse_args()
+
+    logging.basicConfig(level=copts.debug and logging.DEBUG or logging.INFO)
+    kwargs = vars(copts).copy()
+    del kwargs['debug']
+    kwargs['options'] = filter(None, copts.options.split(','))
+    srv = StandinServer(ServerOptions(**kwargs))
+    srv.start()
+    logging.getLogger('standin').info("Serving HTTP at %s:%d, Net-RPC at %s",
+            copts.host, srv.port, srv.netrpc_port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        srv.stop()
+
+if __name__ == '__main__':
+    main()
+
+#eof
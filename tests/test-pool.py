@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+""" Concurrent behaviour of utils.Pool: FIFO hand-off, priorities,
+    reservations and the timeout of `borrow()`
+
+    Needs no server. The waiters are queued one at a time, each after
+    the previous one is seen blocked, so the expected order is exact.
+"""
+import sys
+import os
+import time
+import threading
+
+sys.path.insert(0, os.path.abspath('.'))
+from openerp_libclient.utils import Pool
+from openerp_libclient import session
+
+def make_pool(nres, fifo=True, **kwargs):
+    return Pool(iter(['res%d' % i for i in range(nres)]), fifo=fifo, **kwargs)
+
+def wait_for_waiters(pool, count):
+    deadline = time.time() + 5.0
+    while pool.wait_stats()['waiting'] < count:
+        assert time.time() < deadline, "waiters did not block"
+        time.sleep(0.005)
+
+def start_waiter(pool, name, order, priority=0, timeout=10.0):
+    """ A thread that borrows, records `name`, and frees at once
+    """
+    def _run():
+        res = pool.borrow(timeout, priority=priority)
+        order.append(name)
+        pool.free(res)
+    t = threading.Thread(target=_run, name=name)
+    t.daemon = True
+    t.start()
+    return t
+
+def run_queue(pool, waiters):
+    """ Queue `waiters` (name, priority) behind a held resource, release it
+
+        @return the names, in the order they got the resource
+    """
+    held = pool.borrow(False)
+    order = []
+    threads = []
+    for n, (name, priority) in enumerate(waiters):
+        threads.append(start_waiter(pool, name, order, priority))
+        wait_for_waiters(pool, n + 1)
+    pool.free(held)
+    for t in threads:
+        t.join(5.0)
+        assert not t.isAlive(), "waiter %s is stuck" % t.getName()
+    return order
+
+def check_fifo_order():
+    pool = make_pool(1)
+    order = run_queue(pool, [('a', 0), ('b', 0), ('c', 0), ('d', 0)])
+    assert order == ['a', 'b', 'c', 'd'], order
+    assert pool.wait_stats()['handoffs'] == 4, pool.wait_stats()
+    print "fifo order     OK"
+
+def check_priority():
+    pool = make_pool(1)
+    order = run_queue(pool, [('low1', -10), ('low2', -10), ('normal', 0), ('high', 10)])
+    assert order == ['high', 'normal', 'low1', 'low2'], order
+    print "priority       OK"
+
+def check_reserve():
+    for fifo in (True, False):
+        pool = make_pool(3, fifo=fifo)
+        pool.set_reserve(1, 10, capacity=3)
+        r1 = pool.borrow(False)
+        r2 = pool.borrow(False)
+        try:
+            pool.borrow(False, priority=0)
+            raise AssertionError("took the reserved resource")
+        except ValueError:
+            pass
+        r3 = pool.borrow(False, priority=10)
+        for res in (r1, r2, r3):
+            pool.free(res)
+
+    # a low priority waiter is served only when the reserve allows it
+    pool = make_pool(3)
+    pool.set_reserve(1, 10, capacity=3)
+    held = [pool.borrow(False) for i in range(2)]
+    order = []
+    t = start_waiter(pool, 'low', order, priority=0)
+    wait_for_waiters(pool, 1)
+    pool.free(held.pop())
+    t.join(5.0)
+    assert order == ['low'], order
+    pool.free(held.pop())
+
+    sess = session.Session()
+    sess.session_limit = 4
+    try:
+        sess.reserve_connections(4)
+        raise AssertionError("reserved all the connections")
+    except ValueError:
+        pass
+    sess.reserve_connections(1)
+    print "reserve        OK"
+
+def check_timeout():
+    for fifo in (True, False):
+        pool = make_pool(1, fifo=fifo)
+        held = pool.borrow(False)
+        # a long waiter ahead, so that the timer sleeps for its deadline
+        order = []
+        start_waiter(pool, 'long', order, timeout=30.0)
+        if fifo:
+            wait_for_waiters(pool, 1)
+        else:
+            time.sleep(0.05)
+        t0 = time.time()
+        try:
+            pool.borrow(0.1)
+            raise AssertionError("No timeout")
+        except ValueError:
+            pass
+        dt = time.time() - t0
+        assert 0.09 <= dt < 0.3, "fifo=%s: timed out after %.3fs" % (fifo, dt)
+        pool.free(held)
+        time.sleep(0.05)
+        assert order == ['long'], order
+    print "timeout        OK"
+
+def main():
+    check_fifo_order()
+    check_priority()
+    check_reserve()
+    check_timeout()
+
+if __name__ == '__main__':
+    main()
+
+#eof
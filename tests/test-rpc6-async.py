@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+""" Like test-rpc5-threading.py, but the slow calls run concurrently in
+    a single thread, through AsyncSession
+
+    Needs no OpenERP server: runs against `standin_server`, started
+    in-process, with each of the HTTP protocol handlers.
+"""
+import sys
+import os
+import ssl
+import time
+import logging
+import trollius as asyncio
+from trollius import From
+
+sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from standin_server import StandinServer, ServerOptions
+from openerp_libclient.async_session import AsyncSession
+
+logging.basicConfig(level=logging.WARNING)
+
+HANDLERS = ['RPC-JSON', 'XML-RPCv2', 'XML-RPCv1']
+
+num_calls = 70
+
+@asyncio.coroutine
+def check_handler(srv, handler):
+    sess = AsyncSession()
+    sess.session_limit = num_calls + 1
+    kwargs = srv.connect_args('http')
+    kwargs['allowed_handlers'] = [handler]
+    yield From(sess.open(**kwargs))
+    assert sess._proto.name == handler, sess._proto.name
+    if not (yield From(sess.login())):
+        raise Exception("Could not login!")
+
+    t0 = time.time()
+    calls = [sess.call_orm('test_orm.slow1', 'do_slow', [[]], {'context': {}})
+                for n in range(num_calls)]
+    # one call in between, to test
+    res = yield From(sess.call_orm('test_orm.slow1', 'exists', [[1]]))
+    assert res, res
+    assert time.time() - t0 < srv.opts.slow_time, "call waited for the slow ones"
+    yield From(asyncio.gather(*calls))
+    elapsed = time.time() - t0
+    assert elapsed < srv.opts.slow_time * 3, "slow calls did not run concurrently: %.2fs" % elapsed
+    print "%-10s OK, %d slow calls in %.2fs" % (handler, num_calls, elapsed)
+    sess.close()
+
+def check_ssl_context():
+    """ https verifies the certificate, unless explicitly told not to
+    """
+    sess = AsyncSession()
+    sess._host = 'localhost'
+    ctx = sess._make_ssl_context(None, True)
+    assert ctx.verify_mode == ssl.CERT_REQUIRED and ctx.check_hostname
+    ctx = sess._make_ssl_context(None, False)
+    assert ctx.verify_mode == ssl.CERT_NONE and not ctx.check_hostname
+    print "ssl        OK"
+
+def main():
+    srv = StandinServer(ServerOptions(port=0, netrpc_port=None, slow_time=1.0))
+    srv.start()
+    try:
+        loop = asyncio.get_event_loop()
+        for handler in HANDLERS:
+            loop.run_until_complete(check_handler(srv, handler))
+    finally:
+        srv.stop()
+    check_ssl_context()
+
+if __name__ == '__main__':
+    main()
+
+#eof
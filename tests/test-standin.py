@@ -0,0 +1,324 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+""" Exercise every protocol handler against the stand-in server
+
+    Needs no OpenERP server: starts `standin_server` in-process, at free
+    ports, and runs a few calls through each handler, with gzip, faults
+    and batches.
+"""
+import sys
+import os
+import time
+import socket
+import shutil
+import tempfile
+import logging
+
+sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from standin_server import StandinServer, ServerOptions
+from openerp_libclient import session, protocols, errors, rpc
+from openerp_libclient.protocol_netrpc import SocketClosed
+from openerp_libclient.metadata_cache import MetadataCache
+from openerp_libclient.tracing import RecordingTracer
+__hush_pyflakes = [ protocols, ]
+
+logging.basicConfig(level=logging.WARNING)
+
+HANDLERS = [('http', 'RPC-JSON'), ('http', 'XML-RPCv2'), ('http', 'XML-RPCv1'),
+        ('socket', 'Net-RPC')]
+
+def check_handler(srv, proto, handler):
+    sess = session.Session()
+    kwargs = srv.connect_args(proto)
+    if proto == 'http':
+        kwargs['allowed_handlers'] = [handler]
+    sess.open(**kwargs)
+    assert sess.login() == 1
+    conn = sess._borrow_connection()
+    assert conn.name == handler, conn.name
+    sess.connections.free(conn)
+
+    recs = sess.call_orm('res.partner', 'search_read', [[('id', '<', 4)], ['name', 'data']], {})
+    assert [r['id'] for r in recs] == [1, 2, 3], recs
+    assert len(recs[0]['data']) == srv.opts.payload_size
+    names = sess.call_orm('res.partner', 'name_get', [[2, 3]], {})
+    assert [tuple(n) for n in names] == [(2, u'res.partner #2'), (3, u'res.partner #3')], names
+
+    name = u'Ιωάννης, %s' % handler
+    assert sess.call_orm('res.partner', 'write', [[1], {'name': name}], {})
+    assert sess.call_orm('res.partner', 'read', [[1], ['name']], {})[0]['name'] == name
+
+    try:
+        sess.call_orm('res.partner', 'fail', [], {}, notify=False)
+        raise AssertionError("No exception from fail()")
+    except errors.RpcServerException, e:
+        assert 'Injected failure' in unicode(e.args), e.args
+
+    res = sess.call_many([('orm', 'res.partner', 'search', [[('id', '<', 3)]], {}),
+                    ('orm', 'res.partner', 'fail', [], {}),
+                    ('call', '/common', 'get_options', (), 'pub')])
+    assert res[0] == [1, 2], res
+    assert isinstance(res[1], errors.RpcServerException), res
+    assert list(res[2]) == srv.opts.options, res
+
+    recs = list(sess.call_orm_iter('stock.location', 'search_read', [[], ['stock_real']], {}))
+    assert len(recs) == srv.opts.rows, len(recs)
+    print "%-10s OK, %d connections" % (handler, len(sess.connections))
+    sess.logout()
+
+def check_max_age(srv):
+    """ `conn_max_age`, set on the instance, replaces old connections
+    """
+    sess = session.Session()
+    sess.conn_expire = None
+    sess.conn_max_age = 0.2
+    sess.open(**srv.connect_args('http'))
+    sess.login()
+    conn = sess._borrow_connection()
+    sess.connections.free(conn)
+    assert sess.loop_once(), "loop_once() shall be called again"
+    time.sleep(0.3)
+    sess.loop_once()
+    sess.call_orm('res.partner', 'search', [[]], {})
+    conn2 = sess._borrow_connection()
+    sess.connections.free(conn2)
+    assert conn2 is not conn, "connection not replaced"
+    assert sess.pool_stats()['aged'] >= 1, sess.pool_stats()
+    print "max age   OK"
+    sess.logout()
+
+def check_netrpc_retry(srv):
+    """ Net-RPC repeats a call only if the server closed the socket unanswered
+    """
+    sess = session.Session()
+    sess.open(**srv.connect_args('socket'))
+    sess.login()
+    conn = sess._borrow_connection()
+    conn.call('/db', 'server_version', (), auth_level='pub')
+    sent = []
+
+    def failing_receive(exc):
+        sock = conn._sock
+        def _mysend(msg, *args, **kwargs):
+            sent.append(msg)
+            return sock.__class__.mysend(sock, msg, *args, **kwargs)
+        def _myreceive():
+            sock.__class__.myreceive(sock)
+            raise exc
+        sock.mysend = _mysend
+        sock.myreceive = _myreceive
+
+    failing_receive(SocketClosed("socket connection closed"))
+    assert conn.call('/db', 'server_version', (), auth_level='pub')
+    assert len(sent) == 1, "old socket, closed unanswered, shall be retried"
+    assert 'myreceive' not in vars(conn._sock), "retried on the same socket"
+
+    del sent[:]
+    failing_receive(socket.error(104, 'Connection reset by peer'))
+    try:
+        conn.call('/db', 'server_version', (), auth_level='pub')
+        raise AssertionError("No exception from a reset socket")
+    except errors.RpcProtocolException:
+        pass
+    assert len(sent) == 1, "call repeated after a socket error"
+    assert conn._sock is None
+
+    # min_idle keeps a warmed-up socket ready
+    sess.min_idle = 1
+    sess.loop_once()
+    conn2 = sess._borrow_connection()
+    assert conn2 is not conn
+    assert conn2._sock is not None and conn2._sock_warm, "socket not opened by warm_up()"
+    sess.connections.free(conn2)
+    sess.connections.free(conn)
+    print "netrpc retry OK"
+    sess.logout()
+
+def check_netrpc_pickle(srv):
+    """ Net-RPC pickles with protocol 2 only for servers that advertise it
+    """
+    all_options = srv.opts.options
+    try:
+        for options, netrpc_pickle, expected in (
+                    (all_options, None, 2),
+                    ([o for o in all_options if o != 'netrpc-pickle2'], None, 0),
+                    (all_options, 0, 2)): # a server that answers in protocol 0
+            srv.opts.options = options
+            srv.opts.netrpc_pickle = netrpc_pickle
+            srv.netrpc.pickle_protocols.clear()
+            sess = session.Session()
+            sess.open(**srv.connect_args('socket'))
+            sess.login()
+            recs = sess.call_orm('res.partner', 'read', [[1, 2], ['name']], {})
+            assert [r['id'] for r in recs] == [1, 2], recs
+            assert isinstance(recs[0]['name'], unicode), recs
+            protos = srv.netrpc.pickle_protocols
+            # server_version and get_options precede the negotiation
+            assert protos.get(expected, 0) >= 2 and \
+                    sum(protos.values()) - protos.get(expected) <= 2, protos
+            sess.logout()
+    finally:
+        srv.opts.options = all_options
+        srv.opts.netrpc_pickle = None
+    print "netrpc pickle OK"
+
+def check_metadata_cache(srv):
+    """ The on-disk cache saves context_get at login, with a single connection
+    """
+    path = tempfile.mkdtemp(prefix='libcli-meta-')
+    try:
+        for run in ('cold', 'warm'):
+            sess = session.Session()
+            sess.session_limit = 1
+            sess.conn_timeout = 5.0
+            sess.orm_cache = MetadataCache(sess, path=path)
+            sess.open(**srv.connect_args('http'))
+            calls0 = srv.dispatcher.calls
+            assert sess.login() == 1
+            assert sess.context.get('lang'), sess.context
+            login_calls = srv.dispatcher.calls - calls0
+            assert login_calls == (run == 'cold' and 2 or 1), (run, login_calls)
+            calls0 = srv.dispatcher.calls
+            fields = sess.call_orm('res.partner', 'fields_get', [], {})
+            assert 'name' in fields, fields
+            # the installed modules, in one call, and fields_get if cold
+            assert srv.dispatcher.calls - calls0 == (run == 'cold' and 2 or 1), run
+            if run == 'cold':
+                sess.logout()
+
+        # other methods, without a parent cache, are not cached
+        assert sess.orm_cache.make_key('res.partner', 'read', [[1]], {}) is None
+        # a failed write leaves no temporary file behind
+        key = sess.orm_cache.make_key('res.partner', 'fields_get', [['name']], {})
+        ndir = os.path.dirname(sess.orm_cache._entry_path(key))
+        before = sorted(os.listdir(ndir))
+        sess.orm_cache.put(key, lambda: None)
+        assert sorted(os.listdir(ndir)) == before, os.listdir(ndir)
+        sess.logout()
+    finally:
+        shutil.rmtree(path, True)
+    print "metadata cache OK"
+
+def check_coalescer(srv):
+    """ A lone read through the ReadCoalescer does not wait for the window
+    """
+    sess = session.Session()
+    sess.open(**srv.connect_args('http'))
+    sess.login()
+    coalescer = rpc.ReadCoalescer(window=1.0)
+    proxy = rpc.RpcProxy('res.partner', session=sess, coalescer=coalescer)
+    t0 = time.time()
+    assert proxy.read(1, ['name'])['id'] == 1
+    assert time.time() - t0 < 0.5, "lone caller waited %.2fs" % (time.time() - t0)
+    assert coalescer.stats() == {'requests': 1, 'server_calls': 1}, coalescer.stats()
+    print "coalescer OK"
+    sess.logout()
+
+def check_propagation(srv):
+    """ Calls made in background threads keep the priority and span of the caller
+    """
+    sess = session.Session()
+    sess.open(**srv.connect_args('http'))
+    sess.login()
+    sess.tracer = RecordingTracer()
+    borrowed = []
+    orig_borrow = sess._borrow_connection
+    def _borrow_connection(priority=None):
+        borrowed.append(sess.get_priority(priority))
+        return orig_borrow(priority)
+    sess._borrow_connection = _borrow_connection
+
+    proxy = rpc.RpcProxy('stock.location', session=sess)
+    with sess.tracer.span('outer') as outer:
+        with sess.priority(session.PRIO_BATCH):
+            recs = proxy.iter_search_read([], ['name'], page_size=10)
+        n = len(list(recs))
+    assert n == srv.opts.rows, n
+    assert borrowed and borrowed == [session.PRIO_BATCH] * len(borrowed), borrowed
+    reads = [sp for sp in sess.tracer.spans if sp.attrs.get('method') == 'read']
+    assert len(reads) == (n + 9) // 10, len(reads)
+    assert [sp.parent_id for sp in reads] == [outer.span_id] * len(reads), "span lost"
+
+    del borrowed[:]
+    del sess.tracer.spans[:]
+    with sess.tracer.span('outer') as outer:
+        with sess.priority(session.PRIO_BATCH):
+            results = sess.imap_unordered('res.partner', 'name_get', [[1], [2], [3], [4]],
+                            concurrency=2, progress=False)
+        assert sorted(idx for idx, res in results) == [0, 1, 2, 3]
+    assert borrowed == [session.PRIO_BATCH] * 4, borrowed
+    calls = [sp for sp in sess.tracer.spans if sp.name == 'call_orm']
+    assert [sp.parent_id for sp in calls] == [outer.span_id] * 4, "span lost"
+    print "propagation OK"
+    sess.logout()
+
+def check_map_source_error(srv):
+    """ An error of the chunks iterable reaches the caller of map()
+    """
+    sess = session.Session()
+    sess.open(**srv.connect_args('http'))
+    sess.login()
+    def chunks():
+        yield [1]
+        yield [2]
+        raise IOError("no more chunks")
+    try:
+        sess.map('res.partner', 'name_get', chunks(), concurrency=1, progress=False)
+        raise AssertionError("map() returned")
+    except IOError, e:
+        assert e.args == ("no more chunks",), e.args
+    print "map source error OK"
+    sess.logout()
+
+def check_traced_flag(srv, proto):
+    """ The transports mark phases only while the session has a tracer
+    """
+    sess = session.Session()
+    sess.open(**srv.connect_args(proto))
+    sess.login()
+    conn = sess._borrow_connection()
+    assert not conn.traced
+    sess.connections.free(conn)
+
+    sess.tracer = RecordingTracer()
+    sess.call_orm('res.partner', 'search', [[]], {})
+    phases = [name for name, dur in sess.tracer.spans[-1].phases]
+    assert phases == ['pool', 'serialize', 'send', 'wait', 'parse'], (proto, phases)
+    conn = sess._borrow_connection()
+    assert conn.traced
+    sess.connections.free(conn)
+
+    sess.tracer = None
+    conn = sess._borrow_connection()
+    assert not conn.traced
+    sess.connections.free(conn)
+    print "traced %-6s OK" % proto
+    sess.logout()
+
+def main():
+    srv = StandinServer(ServerOptions(port=0, netrpc_port=0, rows=50, payload_size=1000))
+    srv.start()
+    try:
+        for proto, handler in HANDLERS:
+            check_handler(srv, proto, handler)
+        srv.opts.gzip = False
+        for proto, handler in HANDLERS:
+            check_handler(srv, proto, handler)
+        check_max_age(srv)
+        check_netrpc_retry(srv)
+        check_netrpc_pickle(srv)
+        check_metadata_cache(srv)
+        check_coalescer(srv)
+        check_propagation(srv)
+        check_map_source_error(srv)
+        check_traced_flag(srv, 'http')
+        check_traced_flag(srv, 'socket')
+    finally:
+        srv.stop()
+    print "Calls served:", srv.dispatcher.calls
+
+if __name__ == '__main__':
+    main()
+
+#eof